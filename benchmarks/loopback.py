@@ -0,0 +1,577 @@
+"""
+Loopback Benchmark - Throughput, latency and scaling of FileSender and FileReceiver
+
+Runs a receiver and senders in one process over 127.0.0.1 and sweeps file
+size, chunk size, files per batch, concurrent clients, parallel streams,
+receiver engine, delta updates and chain replication. Every run reports MB/s, files/s, time to
+first byte and CPU seconds per GB, and every file it received is checked to
+be byte-identical to the file it was sent from. Results can be written as JSON and compared
+against an earlier run to catch regressions between commits:
+
+    python -m benchmarks.loopback --output before.json
+    python -m benchmarks.loopback --output after.json --compare before.json
+
+The CPU figure is process CPU time, so it covers the sender and the receiver together.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network.sender import FileSender
+from network.receiver import FileReceiver
+from network.async_receiver import AsyncFileReceiver
+from network.protocol import STATUS_OK
+from network.tuning import PROFILES
+from utils.hashing import hash_file
+
+DEFAULT_PORT = 50900
+
+DEFAULT_SIZES = ["1K", "64K", "1M", "64M", "1G"]
+QUICK_SIZES = ["1K", "1M", "64M"]
+DEFAULT_CHUNKS = ["16K", "256K", "1M", "4M"]
+DEFAULT_BATCHES = [1, 100, 1000]
+DEFAULT_CLIENTS = [1, 4, 16]
+MANY_CLIENTS = [10, 100, 1000]
+DEFAULT_STREAMS = [1, 2, 4]
+
+# Size of the files in batch and client runs
+BATCH_FILE_SIZE = 4 * 1024
+CLIENT_FILE_SIZE = 16 * 1024 * 1024
+MANY_CLIENT_FILE_SIZE = 1024 * 1024
+
+# Test files are one random block of this size written over and over, each copy
+# stamped with its offset, so creating even a 10G file costs little CPU while every
+# byte of it is real data on disk, which the sender and receiver have to move
+GENERATED_BLOCK_SIZE = 1024 * 1024
+
+# Rate limits checked by the rate run, how long each run lasts at its limit,
+# and how far off the limit a run may end up
+DEFAULT_RATE_LIMITS = ["10M", "50M"]
+RATE_SECONDS = 2
+RATE_TOLERANCE = 0.1
+
+# Receivers in the chain run, and how far above the bench's port the extra ones listen
+DEFAULT_CHAIN_HOPS = 3
+CHAIN_PORT_OFFSET = 10
+
+# Fractions of the file changed before a delta run
+DEFAULT_DELTA_CHANGES = [0.001, 0.01, 0.1]
+
+# Size of each changed block of a delta run
+DELTA_BLOCK_SIZE = 64 * 1024
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parse_size(text):
+    """Parse a size such as '64K', '1M' or '10G' into bytes"""
+    text = str(text).strip().upper().rstrip("B")
+    unit = text[-1] if text and text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+def make_file(path, size):
+    """Create a test file of `size` bytes"""
+    with open(path, "wb") as file:
+        block = bytearray(os.urandom(min(size, GENERATED_BLOCK_SIZE)))
+        remaining = size
+        while remaining:
+            # Each block starts with its offset, so data written to the wrong place is caught
+            block[:8] = (size - remaining).to_bytes(8, "little")[:len(block)]
+            count = min(remaining, len(block))
+            file.write(block[:count])
+            remaining -= count
+
+class Bench:
+    """
+    One receiver engine listening on loopback, and the measurements taken around it
+    """
+
+    def __init__(self, receiver_class, port, work_dir, socket_profile="default", save_dir=None):
+        self.receiver_class = receiver_class
+        self.port = port
+        self.socket_profile = socket_profile
+        self.save_dir = save_dir or os.path.join(work_dir, "received")
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.first_byte = None
+        self.lock = threading.Lock()
+        self.receiver = receiver_class()
+        self.receiver.set_socket_profile(socket_profile)
+        self.receiver.start_receiving(port, self.save_dir, self._on_log)
+
+    def _on_log(self, message):
+        # The receiver logs a transfer as soon as its header arrives
+        if message.startswith(("Receiving file", "Receiving delta")):
+            with self.lock:
+                if self.first_byte is None:
+                    self.first_byte = time.perf_counter()
+
+    def stop(self):
+        self.receiver.stop_receiving()
+
+    def sender(self, **options):
+        """FileSender with the bench's socket profile, without the hash cache so every run hashes"""
+        return FileSender(use_hash_cache=False, socket_profile=self.socket_profile, **options)
+
+    def measure(self, name, params, total_bytes, files, run, outputs, clear=True):
+        """
+        Time one run, then check what it received
+
+        Args:
+            name: Kind of run, e.g. 'size' or 'clients'
+            params: Dict of the swept parameters
+            total_bytes: Payload bytes the run moves
+            files: Number of files the run moves
+            run: Function performing the transfers
+            outputs: List of (source path, name saved as on the receiver) of every file the run sends
+            clear: If True, remove the outputs of earlier runs first, so they can not pass for this one's
+
+        Returns:
+            Result dict
+
+        Raises:
+            RuntimeError: If a received file is missing or differs from its source
+        """
+        if clear:
+            for _, saved_name in outputs:
+                saved_path = os.path.join(self.save_dir, saved_name)
+                if os.path.exists(saved_path):
+                    os.remove(saved_path)
+        self.first_byte = None
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - started
+        cpu_seconds = time.process_time() - cpu_started
+        self.verify(outputs)
+        gigabytes = total_bytes / UNITS["G"]
+        return {
+            "name": name,
+            "engine": self.receiver_class.__name__,
+            "params": params,
+            "bytes": total_bytes,
+            "files": files,
+            "seconds": round(seconds, 6),
+            "mb_per_s": round(total_bytes / UNITS["M"] / seconds, 3) if seconds else None,
+            "files_per_s": round(files / seconds, 3) if seconds else None,
+            "ttfb_ms": round((self.first_byte - started) * 1000, 3) if self.first_byte else None,
+            "cpu_s_per_gb": round(cpu_seconds / gigabytes, 4) if gigabytes else None,
+            "verified": len(outputs),
+        }
+
+    def verify(self, outputs):
+        """
+        Check that every received file is byte-identical to the file it was sent from,
+        by comparing their digests
+
+        Args:
+            outputs: List of (source path, name saved as on the receiver)
+
+        Raises:
+            RuntimeError: If a file is missing or differs from its source
+        """
+        digests = {}
+        for source_path, saved_name in outputs:
+            if source_path not in digests:
+                digests[source_path] = hash_file(source_path)
+            saved_path = os.path.join(self.save_dir, saved_name)
+            if not os.path.isfile(saved_path) or hash_file(saved_path) != digests[source_path]:
+                raise RuntimeError(f"Received '{saved_name}' is not identical to its source '{source_path}'")
+
+def run_sizes(bench, work_dir, sizes, repeat):
+    results = []
+    sender = bench.sender(sparse=False)
+    for size in sizes:
+        path = os.path.join(work_dir, f"size_{size}.bin")
+        make_file(path, size)
+        for _ in range(repeat):
+            results.append(bench.measure(
+                "size", {"size": format_size(size)}, size, 1,
+                lambda: sender.send_file(path, "127.0.0.1", bench.port, "size.bin"), [(path, "size.bin")]
+            ))
+        os.remove(path)
+    return results
+
+def run_chunks(bench, work_dir, chunks, size, repeat):
+    results = []
+    path = os.path.join(work_dir, "chunk.bin")
+    make_file(path, size)
+    for chunk in [None] + chunks:
+        # None stands for the kernel sendfile path, the others for buffered reads of that size
+        sender = bench.sender(use_sendfile=chunk is None, buffer_size=chunk or UNITS["M"])
+        for _ in range(repeat):
+            results.append(bench.measure(
+                "chunk", {"chunk": format_size(chunk) if chunk else "sendfile", "size": format_size(size)}, size, 1,
+                lambda: sender.send_file(path, "127.0.0.1", bench.port, "chunk.bin"), [(path, "chunk.bin")]
+            ))
+    os.remove(path)
+    return results
+
+def run_batches(bench, work_dir, batches, repeat):
+    results = []
+    sender = bench.sender()
+    batch_dir = os.path.join(work_dir, "batch")
+    os.makedirs(batch_dir, exist_ok=True)
+    paths = []
+    for count in batches:
+        while len(paths) < count:
+            path = os.path.join(batch_dir, f"f{len(paths)}.bin")
+            make_file(path, BATCH_FILE_SIZE)
+            paths.append(path)
+
+        def run(count=count):
+            with sender.open_session("127.0.0.1", bench.port) as session:
+                for index, path in enumerate(paths[:count]):
+                    session.send(path, f"batch_{index}.bin")
+
+        for _ in range(repeat):
+            results.append(bench.measure(
+                "batch", {"files": count, "file_size": format_size(BATCH_FILE_SIZE)}, count * BATCH_FILE_SIZE, count, run,
+                [(path, f"batch_{index}.bin") for index, path in enumerate(paths[:count])]
+            ))
+    shutil.rmtree(batch_dir)
+    return results
+
+def run_clients(bench, work_dir, clients, repeat, file_size=CLIENT_FILE_SIZE):
+    results = []
+    path = os.path.join(work_dir, "client.bin")
+    make_file(path, file_size)
+    for count in clients:
+        def run(count=count):
+            errors = []
+
+            def client(index):
+                try:
+                    bench.sender().send_file(path, "127.0.0.1", bench.port, f"client_{index}.bin")
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=client, args=(index,)) for index in range(count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+
+        for _ in range(repeat):
+            results.append(bench.measure(
+                "clients", {"clients": count, "file_size": format_size(file_size)}, count * file_size, count, run,
+                [(path, f"client_{index}.bin") for index in range(count)]
+            ))
+    os.remove(path)
+    return results
+
+def run_streams(bench, work_dir, streams, size, repeat):
+    results = []
+    path = os.path.join(work_dir, "streams.bin")
+    make_file(path, size)
+    sender = bench.sender()
+    for count in streams:
+        for _ in range(repeat):
+            results.append(bench.measure(
+                "streams", {"streams": count, "size": format_size(size)}, size, 1,
+                lambda: sender.send_file(path, "127.0.0.1", bench.port, "streams.bin", streams=count),
+                [(path, "streams.bin")]
+            ))
+    os.remove(path)
+    return results
+
+def run_delta(bench, work_dir, size, changes, repeat):
+    base_path = os.path.join(work_dir, "delta_base.bin")
+    path = os.path.join(work_dir, "delta.bin")
+    make_file(base_path, size)
+    sender = bench.sender()
+
+    results = []
+    for change in changes:
+        # Change scattered blocks of a copy, then send only the difference
+        shutil.copyfile(base_path, path)
+        with open(path, "r+b") as file:
+            step = max(1, round(1 / change)) * DELTA_BLOCK_SIZE
+            for offset in range(0, size, step):
+                file.seek(offset)
+                file.write(os.urandom(min(DELTA_BLOCK_SIZE, size - offset)))
+
+        for _ in range(repeat):
+            # The receiver's copy has to be the old version again before every run
+            sender.send_file(base_path, "127.0.0.1", bench.port, "delta.bin")
+            results.append(bench.measure(
+                "delta", {"size": format_size(size), "changed": change}, size, 1,
+                lambda: sender.send_file(path, "127.0.0.1", bench.port, "delta.bin", delta=True),
+                [(path, "delta.bin")], clear=False
+            ))
+    os.remove(path)
+    os.remove(base_path)
+    return results
+
+def run_rate(bench, work_dir, limits, repeat):
+    """
+    How closely rate limits are held, on the receiver and on the sender, both steady and
+    changed halfway through a transfer: 'rate_error_pct' is the achieved rate's deviation
+    from the limit, and a run off by more than RATE_TOLERANCE fails.
+
+    A changed limit starts at half the limit and rises to one and a half times it after
+    half of RATE_SECONDS, so the whole transfer should still average the limit.
+    """
+    results = []
+    sender = bench.sender()
+    path = os.path.join(work_dir, "rate.bin")
+    for limit in limits:
+        size = limit * RATE_SECONDS
+        make_file(path, size)
+        for side in ("receiver", "sender"):
+            for changed in (False, True):
+                for _ in range(repeat):
+                    params = {"limit": format_size(limit), "side": side}
+                    if changed:
+                        params["change"] = f"{format_size(limit // 2)}->{format_size(limit * 3 // 2)}"
+                    result = bench.measure(
+                        "rate", params, size, 1, lambda: send_limited(bench, sender, path, limit, side, changed),
+                        [(path, "rate.bin")]
+                    )
+                    result["rate_error_pct"] = round((result["mb_per_s"] * UNITS["M"] - limit) / limit * 100, 2)
+                    if abs(result["rate_error_pct"]) > RATE_TOLERANCE * 100:
+                        raise RuntimeError(f"Rate limit {params} missed by {result['rate_error_pct']:+.1f}%")
+                    results.append(result)
+        os.remove(path)
+    return results
+
+def send_limited(bench, sender, path, limit, side, changed):
+    """Send `path` under a rate limit on the receiver or the sender, changed halfway through if asked"""
+    if side == "receiver":
+        set_rate = bench.receiver.set_rate_limit
+        throttle = None
+    else:
+        throttle = sender.create_throttle()
+        set_rate = throttle.set_rate
+    set_rate(limit // 2 if changed else limit)
+    timer = threading.Timer(RATE_SECONDS / 2, set_rate, (limit * 3 // 2,)) if changed else None
+    try:
+        if timer:
+            timer.start()
+        sender.send_file(path, "127.0.0.1", bench.port, "rate.bin", throttle=throttle)
+    finally:
+        if timer:
+            timer.cancel()
+            timer.join()
+        if side == "receiver":
+            bench.receiver.set_rate_limit(None)
+
+def run_chain(bench, work_dir, hop_count, size, repeat):
+    """
+    Chain replication through the bench's receiver and hop_count - 1 more on the following ports.
+    Every hop's copy is checked, then a middle hop is stopped and the chain has to report it
+    and every hop after it as failed.
+    """
+    hops = [bench]
+    try:
+        for index in range(1, hop_count):
+            hops.append(Bench(FileReceiver, bench.port + CHAIN_PORT_OFFSET + index, work_dir, bench.socket_profile,
+                              os.path.join(work_dir, f"hop_{index}")))
+        addresses = [("127.0.0.1", hop.port) for hop in hops]
+        path = os.path.join(work_dir, "chain.bin")
+        make_file(path, size)
+        sender = bench.sender()
+        outputs = [(path, "chain.bin")]
+
+        def run():
+            chain = sender.send_chain(path, addresses, "chain.bin")
+            failed = [address for address, status in chain if status != STATUS_OK]
+            if failed:
+                raise RuntimeError(f"Chain replication failed at {failed}")
+
+        results = []
+        for _ in range(repeat):
+            for hop in hops[1:]:
+                saved_path = os.path.join(hop.save_dir, "chain.bin")
+                if os.path.exists(saved_path):
+                    os.remove(saved_path)
+            result = bench.measure("chain", {"hops": hop_count, "size": format_size(size)}, size, 1, run, outputs)
+            for hop in hops[1:]:
+                hop.verify(outputs)
+            result["verified"] = hop_count
+            results.append(result)
+
+        # A dead hop must be reported, along with every hop the chain could not reach past it
+        dead = hop_count // 2
+        if dead:
+            hops[dead].stop()
+            statuses = [status for _, status in sender.send_chain(path, addresses, "chain.bin")]
+            if any(status != STATUS_OK for status in statuses[:dead]) or STATUS_OK in statuses[dead:]:
+                raise RuntimeError(f"Chain with hop {dead} stopped reported statuses {statuses}")
+        os.remove(path)
+        return results
+    finally:
+        for hop in hops[1:]:
+            hop.stop()
+
+def git_commit():
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """
+    Print how each result changed against a baseline run
+
+    Returns:
+        List of (key, old MB/s, new MB/s) of the runs that got more than 10% slower
+    """
+    def key(result):
+        return (result["name"], result["engine"], json.dumps(result["params"], sort_keys=True))
+
+    before = {}
+    for result in baseline["results"]:
+        before.setdefault(key(result), []).append(result)
+
+    regressions = []
+    for result in results:
+        previous = before.get(key(result))
+        if not previous or not result["mb_per_s"]:
+            continue
+        old = max(item["mb_per_s"] or 0 for item in previous)
+        change = (result["mb_per_s"] - old) / old * 100 if old else 0.0
+        print(f"{key(result)[0]:8} {key(result)[1]:18} {key(result)[2]:48} {old:10.1f} -> {result['mb_per_s']:10.1f} MB/s ({change:+.1f}%)")
+        if change < -10:
+            regressions.append((key(result), old, result["mb_per_s"]))
+    return regressions
+
+def best_results(results):
+    """Keep the fastest of the repeated runs of each configuration"""
+    best = {}
+    for result in results:
+        key = (result["name"], result["engine"], json.dumps(result["params"], sort_keys=True))
+        if key not in best or (result["mb_per_s"] or 0) > (best[key]["mb_per_s"] or 0):
+            best[key] = result
+    return list(best.values())
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of FileSender and FileReceiver.")
+    parser.add_argument("--quick", action="store_true", help="smaller sweeps, for a run of well under a minute")
+    parser.add_argument("--sizes", help="comma-separated file sizes, e.g. 1K,1M,10G")
+    parser.add_argument("--chunks", help="comma-separated buffer sizes of the buffered send path")
+    parser.add_argument("--batches", help="comma-separated numbers of files per session")
+    parser.add_argument("--clients", help="comma-separated numbers of concurrent clients")
+    parser.add_argument("--many-clients", action="store_true",
+                        help=f"also run {', '.join(map(str, MANY_CLIENTS))} concurrent clients, "
+                             f"sending {format_size(MANY_CLIENT_FILE_SIZE)} each")
+    parser.add_argument("--streams", help="comma-separated numbers of parallel streams")
+    parser.add_argument("--rate-limits", help="comma-separated rate limits per second for the rate run, e.g. 10M,50M")
+    parser.add_argument("--delta-change",
+                        help="comma-separated fractions of the file changed before a delta run, e.g. 0.001,0.01,0.1")
+    parser.add_argument("--chain-hops", type=int, default=DEFAULT_CHAIN_HOPS,
+                        help="receivers in the chain replication run")
+    parser.add_argument("--engines", default="threads,async", help="receiver engines to run: threads, async")
+    parser.add_argument("--socket-profile", default="default", choices=list(PROFILES),
+                        help="socket profile of the sender and receiver (see network.tuning)")
+    parser.add_argument("--only", help="comma-separated runs to do: size, chunk, batch, clients, streams, delta, chain, "
+                                       "and rate, which checks the accuracy of rate limits and only runs when asked for")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per configuration, the fastest is kept")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="loopback port to use")
+    parser.add_argument("--dir", help="directory for the test files (default: a temporary directory)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    def values(text, default, parse=parse_size):
+        return [parse(item) for item in text.split(",")] if text else [parse(item) for item in default]
+
+    sizes = values(args.sizes, QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    chunks = values(args.chunks, DEFAULT_CHUNKS[1:3] if args.quick else DEFAULT_CHUNKS)
+    batches = values(args.batches, DEFAULT_BATCHES[:2] if args.quick else DEFAULT_BATCHES, int)
+    clients = values(args.clients, DEFAULT_CLIENTS[:2] if args.quick else DEFAULT_CLIENTS, int)
+    streams = values(args.streams, DEFAULT_STREAMS, int)
+    changes = values(args.delta_change, DEFAULT_DELTA_CHANGES, float)
+    limits = values(args.rate_limits, DEFAULT_RATE_LIMITS)
+    large = 64 * UNITS["M"] if args.quick else 256 * UNITS["M"]
+    only = set(args.only.split(",")) if args.only else {"size", "chunk", "batch", "clients", "streams", "delta", "chain"}
+    repeat = 1 if args.quick else args.repeat
+
+    engines = {"threads": FileReceiver, "async": AsyncFileReceiver}
+    work_dir = tempfile.mkdtemp(prefix="fileshare-bench-", dir=args.dir)
+    results = []
+    try:
+        for offset, engine in enumerate(args.engines.split(",")):
+            receiver_class = engines[engine]
+            bench = Bench(receiver_class, args.port + offset, work_dir, args.socket_profile)
+            try:
+                if "size" in only:
+                    results += run_sizes(bench, work_dir, sizes, repeat)
+                if "chunk" in only:
+                    results += run_chunks(bench, work_dir, chunks, large, repeat)
+                if "batch" in only:
+                    results += run_batches(bench, work_dir, batches, repeat)
+                if "clients" in only:
+                    results += run_clients(bench, work_dir, clients, repeat)
+                    if args.many_clients:
+                        results += run_clients(bench, work_dir, MANY_CLIENTS, repeat, MANY_CLIENT_FILE_SIZE)
+                # The asyncio engine serves single files and sessions only
+                if "streams" in only and receiver_class is FileReceiver:
+                    results += run_streams(bench, work_dir, streams, large, repeat)
+                if "delta" in only and receiver_class is FileReceiver:
+                    results += run_delta(bench, work_dir, large, changes, repeat)
+                if "chain" in only and receiver_class is FileReceiver:
+                    results += run_chain(bench, work_dir, args.chain_hops, large, repeat)
+                if "rate" in only:
+                    results += run_rate(bench, work_dir, limits, repeat)
+            finally:
+                bench.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = best_results(results)
+    for result in results:
+        params = ", ".join(f"{key}={value}" for key, value in result["params"].items())
+        ttfb = f"{result['ttfb_ms']:.2f}" if result["ttfb_ms"] is not None else "-"
+        cpu = f"{result['cpu_s_per_gb']:.2f}" if result["cpu_s_per_gb"] is not None else "-"
+        accuracy = f"  off limit {result['rate_error_pct']:+.1f}%" if "rate_error_pct" in result else ""
+        print(f"{result['name']:8} {result['engine']:18} {params:36} {result['mb_per_s']:10.1f} MB/s "
+              f"{result['files_per_s']:10.1f} files/s  ttfb {ttfb:>8} ms  cpu {cpu:>6} s/GB{accuracy}")
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "socket_profile": args.socket_profile,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file))
+        if regressions:
+            print(f"{len(regressions)} configuration(s) more than 10% slower")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,355 @@
+"""
+Command Line Interface - Headless send, receive and daemon modes
+
+    python main.py send FILE_OR_FOLDER... --host HOST [--port 9999]
+    python main.py receive --dir DIR [--count N]
+    python main.py daemon --dir DIR [--log-file PATH]
+    python main.py gui
+
+Add --stats to print where the time went per stage (disk, hashing, network)
+when the command ends, and --profile to profile it. Receivers can also serve
+their stats and profiling controls locally with --metrics-port.
+
+Only the modules a command needs are imported, and never Tk, so the headless
+commands start quickly and run on machines without a display. With --json,
+progress and results are written to stdout as JSON lines, one object per
+event, for scripts to consume.
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+DEFAULT_PORT = 9999
+
+# Names of the network.tuning profiles, listed here so parsing arguments imports no network code
+SOCKET_PROFILES = ["system", "default", "lan", "wan", "auto"]
+
+class Output:
+    """
+    Writes events either as JSON lines on stdout or as readable lines on stderr
+    """
+
+    def __init__(self, json_lines):
+        self.json_lines = json_lines
+        self.lock = threading.Lock()
+        self.progress_line = False  # A progress line is showing on the terminal
+
+    def emit(self, event, **fields):
+        """
+        Write one event
+
+        Args:
+            event: Event name, e.g. 'sent', 'failed', 'log', 'progress'
+            fields: JSON-serializable details
+        """
+        with self.lock:
+            if self.json_lines:
+                sys.stdout.write(json.dumps(dict({"event": event, "time": round(time.time(), 3)}, **fields)) + "\n")
+                sys.stdout.flush()
+                return
+            if self.progress_line:
+                sys.stderr.write("\n")
+                self.progress_line = False
+            sys.stderr.write(self._describe(event, fields) + "\n")
+            sys.stderr.flush()
+
+    def progress(self, events):
+        """Progress bus subscriber, called at most once per tick"""
+        if self.json_lines:
+            for event in events:
+                self.emit("progress", **event)
+            return
+
+        # On a terminal, keep rewriting one line with the latest progress
+        if not sys.stderr.isatty():
+            return
+        from utils.helpers import format_file_size, format_duration
+        active = [event for event in events if not event["finished"]]
+        if not active:
+            return
+        event = active[-1]
+        with self.lock:
+            sys.stderr.write(
+                f"\r{event['name']}: {event['percent']:5.1f}% "
+                f"({format_file_size(event['rate'])}/s, {format_duration(event['eta'])} left)\033[K"
+            )
+            sys.stderr.flush()
+            self.progress_line = True
+
+    @staticmethod
+    def _describe(event, fields):
+        if event == "log":
+            return fields["message"]
+        if event == "sent":
+            skipped = f", {fields['skipped_bytes']} already there" if fields.get("skipped_bytes") else ""
+            holes = f", {fields['hole_bytes']} in holes" if fields.get("hole_bytes") else ""
+            return (f"Sent '{fields['name']}' to {fields['host']}:{fields['port']} "
+                    f"({fields['bytes']} bytes in {fields['seconds']:.2f}s{skipped}{holes})")
+        if event == "failed":
+            return f"Failed to send '{fields['name']}': {fields['error']}"
+        if event == "ready":
+            return f"Ready in {fields['startup_seconds'] * 1000:.0f} ms"
+        if event == "stats":
+            lines = ["Stage timings:"]
+            for stage in fields["stages"]:
+                rate = f"{stage['mb_per_s']:10.1f} MB/s" if stage["mb_per_s"] is not None else " " * 15
+                lines.append(f"  {stage['direction']:8} {stage['stage']:9} {stage['seconds']:9.3f}s {rate} "
+                             f"{stage['calls']:8} calls {stage['stalls']:6} stalls")
+            return "\n".join(lines)
+        if event == "profile":
+            return fields["report"]
+        if event == "metrics":
+            return f"Serving metrics on {fields['url']}"
+        details = ", ".join(f"{key}={value}" for key, value in fields.items())
+        return f"{event}: {details}" if details else event
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py", description="Send and receive files over the local network.")
+    parser.add_argument("--json", action="store_true", help="write progress and results to stdout as JSON lines")
+    parser.add_argument("--stats", action="store_true", help="time each transfer stage and report the totals on exit")
+    parser.add_argument("--profile", choices=["sample", "cprofile"], help="profile the command and report on exit")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send = commands.add_parser("send", help="send files and folders to a receiver")
+    send.add_argument("paths", nargs="+", help="files and folders to send")
+    send.add_argument("--host", default="auto", help="receiver address, or 'auto' to discover one (default: auto)")
+    send.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"receiver port (default: {DEFAULT_PORT})")
+    send.add_argument("--name", help="name to save a single file or folder as on the receiver")
+    send.add_argument("--hash", default=None, help="integrity hash algorithm (default: sha256)")
+    send.add_argument("--compression", choices=["zlib", "bz2", "lzma"], help="compress data on the wire")
+    send.add_argument("--level", type=int, help="compression level")
+    send.add_argument("--limit", type=float, help="bandwidth limit in MB/s")
+    send.add_argument("--priority", choices=["high", "normal", "low"], default="normal", help="transfer priority")
+    send.add_argument("--streams", type=int, default=1, help="parallel connections per file, 0 to choose from the size")
+    send.add_argument("--resume", action="store_true", help="continue interrupted transfers")
+    send.add_argument("--delta", action="store_true", help="send only the parts that changed")
+    send.add_argument("--no-sparse", action="store_true", help="send holes in sparse files as data")
+    send.add_argument("--socket-profile", choices=SOCKET_PROFILES, default="default",
+                      help="socket buffers, timeouts and keepalive: system, default, lan, wan or auto (default: default)")
+
+    for name, description in (("receive", "receive files, then exit"), ("daemon", "keep receiving files until stopped")):
+        receive = commands.add_parser(name, help=description)
+        receive.add_argument("--dir", default=os.getcwd(), help="directory to save files to (default: current)")
+        receive.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+        receive.add_argument("--limit", type=float, help="bandwidth limit in MB/s")
+        receive.add_argument("--fsync", choices=["never", "commit", "always"], default="commit",
+                             help="when received files are forced to disk (default: commit)")
+        receive.add_argument("--async-io", action="store_true", help="serve all connections from one event loop")
+        receive.add_argument("--socket-profile", choices=SOCKET_PROFILES, default="default",
+                             help="socket buffers, timeouts, keepalive and backlog (default: default)")
+        receive.add_argument("--metrics-port", type=int,
+                             help="serve stats on 127.0.0.1 at this port (/metrics, /stats, /profile/start, /profile/stop)")
+        if name == "receive":
+            receive.add_argument("--count", type=int, default=1, help="transfers to receive before exiting (default: 1)")
+        else:
+            receive.add_argument("--log-file", help="also write the log to this file, rotated as it grows")
+
+    commands.add_parser("gui", help="start the graphical interface")
+    return parser
+
+def resolve_host(host, port, paths, output):
+    """
+    Returns:
+        Tuple of (host, port) to send to, or (None, port) if no receiver was found
+    """
+    if host != "auto":
+        return host, port
+
+    from network.discovery import get_peer_registry, choose_receiver, BEACON_INTERVAL
+    from utils.helpers import discover_file_server_ip, discover_file_servers_info, path_size
+
+    # Wait at most one beacon interval for an announcement, then ask on the network
+    required_bytes = sum(path_size(path) for path in paths)
+    peer = get_peer_registry().resolve(timeout=BEACON_INTERVAL, required_bytes=required_bytes)
+    if not peer:
+        peer = choose_receiver(discover_file_servers_info(), required_bytes)
+    if peer:
+        host, port = peer["host"], peer["port"]
+    else:
+        host = discover_file_server_ip()
+    if host:
+        output.emit("discovered", host=host, port=port)
+    return host, port
+
+def run_send(args, output, started):
+    from network.sender import FileSender
+    from network.throttle import PRIORITIES
+    from network.protocol import TransferError, ProtocolError
+    from utils.helpers import path_size
+    from utils.progress import get_progress_bus
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            output.emit("failed", name=path, error="No such file or directory")
+            return 2
+
+    options = {"compression": args.compression, "compression_level": args.level, "sparse": not args.no_sparse,
+               "socket_profile": args.socket_profile}
+    if args.hash:
+        options["hash_algorithm"] = args.hash
+    try:
+        sender = FileSender(**options)
+    except ValueError as e:
+        output.emit("failed", name=None, error=str(e))
+        return 2
+    throttle = sender.create_throttle(args.limit * 1024 * 1024 if args.limit else None, PRIORITIES[args.priority])
+
+    host, port = resolve_host(args.host, args.port, args.paths, output)
+    if not host:
+        output.emit("failed", name=None, error="No receiver found on the local network")
+        return 1
+
+    bus = get_progress_bus()
+    bus.subscribe(output.progress)
+    output.emit("ready", command="send", startup_seconds=round(time.perf_counter() - started, 4))
+
+    failed = 0
+    for path in args.paths:
+        name = args.name if args.name and len(args.paths) == 1 else os.path.basename(os.path.normpath(path))
+        try:
+            with bus.track(name, path_size(path)) as tracker:
+                if os.path.isdir(path):
+                    summary = sender.send_archive(path, host, port, name, tracker, throttle)
+                else:
+                    summary = sender.send_file(path, host, port, name, tracker, streams=args.streams or None,
+                                               resume=args.resume, delta=args.delta, throttle=throttle)
+            output.emit("sent", name=name, host=host, port=port, **summary)
+        except (OSError, TransferError, ProtocolError) as e:
+            failed += 1
+            output.emit("failed", name=name, error=str(e))
+
+    # Let the last progress events out before exiting
+    time.sleep(bus.interval * 2)
+    bus.unsubscribe(output.progress)
+    return 1 if failed else 0
+
+def run_receive(args, output, started, daemon=False):
+    from utils.progress import get_progress_bus
+
+    if args.async_io:
+        from network.async_receiver import AsyncFileReceiver as receiver_class
+    else:
+        from network.receiver import FileReceiver as receiver_class
+
+    if not os.path.isdir(args.dir):
+        output.emit("failed", name=None, error=f"'{args.dir}' is not a directory")
+        return 2
+
+    log = output.emit
+    log_buffer = None
+    if daemon and args.log_file:
+        from utils.log_buffer import LogBuffer
+        log_buffer = LogBuffer(max_lines=1, spill_path=args.log_file)  # Only its rotating file is used
+
+        def log(event, **fields):
+            log_buffer.append(fields["message"])
+            output.emit(event, **fields)
+
+    receiver = receiver_class()
+    receiver.set_fsync_policy(args.fsync)
+    receiver.set_socket_profile(args.socket_profile)
+    if args.limit:
+        receiver.set_rate_limit(args.limit * 1024 * 1024)
+
+    stop = threading.Event()
+    counts = {"received": 0, "failed": 0}
+
+    def on_progress(events):
+        output.progress(events)
+        for event in events:
+            if event["direction"] == "receive" and event["finished"]:
+                counts["failed" if event["error"] else "received"] += 1
+                if not daemon and counts["received"] + counts["failed"] >= args.count:
+                    stop.set()
+
+    bus = get_progress_bus()
+    bus.subscribe(on_progress)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    try:
+        receiver.start_receiving(args.port, os.path.abspath(args.dir), lambda message: log("log", message=message))
+    except OSError as e:
+        output.emit("failed", name=None, error=f"Could not listen on port {args.port}: {e}")
+        return 1
+    metrics = None
+    if args.metrics_port is not None:
+        from utils.metrics import MetricsServer
+        metrics = MetricsServer(receiver.stats, args.metrics_port)
+        try:
+            metrics.start()
+        except OSError as e:
+            receiver.stop_receiving()
+            output.emit("failed", name=None, error=f"Could not serve metrics on port {args.metrics_port}: {e}")
+            return 1
+        output.emit("metrics", url=f"http://{metrics.host}:{metrics.port}/metrics")
+
+    output.emit("ready", command="daemon" if daemon else "receive", port=args.port, dir=os.path.abspath(args.dir),
+                startup_seconds=round(time.perf_counter() - started, 4))
+
+    try:
+        while not stop.wait(0.5):
+            pass
+    finally:
+        receiver.stop_receiving()
+        if metrics:
+            metrics.stop()
+        bus.unsubscribe(on_progress)
+        output.emit("stopped", **counts)
+        if log_buffer:
+            log_buffer.close()
+    return 1 if counts["failed"] else 0
+
+def run_gui():
+    from gui.main_window import FileTransferApp
+    app = FileTransferApp()
+    app.run()
+    return 0
+
+def main(argv=None, started=None):
+    """
+    Run a command
+
+    Args:
+        argv: Command line arguments, without the program name
+        started: time.perf_counter() value when the process started, for the reported startup time
+
+    Returns:
+        Process exit code
+    """
+    started = started if started is not None else time.perf_counter()
+    args = build_parser().parse_args(argv)
+    output = Output(args.json)
+
+    stats = None
+    if args.stats or args.profile:
+        from utils.stats import get_stats
+        stats = get_stats()
+        stats.enable()
+        if args.profile:
+            stats.start_profiling(args.profile)
+
+    try:
+        if args.command == "send":
+            return run_send(args, output, started)
+        if args.command == "receive":
+            return run_receive(args, output, started)
+        if args.command == "daemon":
+            return run_receive(args, output, started, daemon=True)
+        return run_gui()
+    finally:
+        if stats:
+            report = stats.stop_profiling()
+            if report:
+                output.emit("profile", report=report)
+            if args.stats:
+                snapshot = stats.snapshot()
+                output.emit("stats", stages=snapshot["stages"], totals=snapshot["totals"], recent=snapshot["recent"])
+
+if __name__ == "__main__":
+    sys.exit(main())
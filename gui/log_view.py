@@ -0,0 +1,106 @@
+"""
+Log View - Virtualized view of a LogBuffer
+
+The text box only ever holds the lines that fit on screen. A scrollbar of its
+own maps onto the whole buffer, and new lines are picked up on a timer in
+one batch instead of one widget update per message.
+"""
+
+import customtkinter as ctk
+
+# Milliseconds between checks for new lines
+FLUSH_INTERVAL_MS = 200
+
+# Lines scrolled per mouse wheel step
+WHEEL_LINES = 3
+
+class LogView:
+    def __init__(self, parent, root, log_buffer, flush_interval_ms=FLUSH_INTERVAL_MS):
+        """
+        Args:
+            parent: Widget to place the view in
+            root: Main window, used for the flush timer
+            log_buffer: LogBuffer to show
+            flush_interval_ms: Milliseconds between checks for new lines
+        """
+        self.root = root
+        self.log_buffer = log_buffer
+        self.flush_interval_ms = flush_interval_ms
+        self.top = 0            # Number of the first line shown (see LogBuffer)
+        self.follow = True      # Keep showing the newest lines as they arrive
+        self.rendered = None    # (appended, top, rows) of the last render
+
+        self.frame = ctk.CTkFrame(parent, fg_color="transparent")
+        self.font = ctk.CTkFont()
+        self.textbox = ctk.CTkTextbox(self.frame, height=150, font=self.font, wrap="none", activate_scrollbars=False)
+        self.scrollbar = ctk.CTkScrollbar(self.frame, command=self._on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.textbox.pack(side="left", fill="both", expand=True)
+
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.textbox.bind(sequence, self._on_wheel)
+        self.textbox.bind("<Configure>", lambda event: self.refresh())
+
+        self.root.after(self.flush_interval_ms, self._flush)
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def refresh(self):
+        """Render the visible window of the buffer, if anything changed"""
+        rows = self._rows()
+        appended = self.log_buffer.appended
+        first = self.log_buffer.first
+        total = appended - first
+
+        if self.follow:
+            self.top = max(appended - rows, first)
+        self.top = min(max(self.top, first), max(appended - rows, first))
+
+        state = (appended, self.top, rows)
+        if state == self.rendered:
+            return
+        self.rendered = state
+
+        lines = self.log_buffer.window(self.top, rows)
+        self.textbox.delete("1.0", "end")
+        self.textbox.insert("1.0", "\n".join(lines))
+        # The row estimate may be off by a line, keep the relevant edge in view
+        self.textbox.see("end" if self.follow else "1.0")
+
+        if total:
+            self.scrollbar.set((self.top - first) / total, (self.top - first + len(lines)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def _rows(self):
+        height = self.textbox.winfo_height()
+        return max(1, height // max(1, self.font.metrics("linespace")))
+
+    def _scroll_to(self, top):
+        first = self.log_buffer.first
+        last_top = max(self.log_buffer.appended - self._rows(), first)
+        self.top = min(max(int(top), first), last_top)
+        self.follow = self.top >= last_top
+        self.refresh()
+
+    def _on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            total = self.log_buffer.appended - self.log_buffer.first
+            self._scroll_to(self.log_buffer.first + float(amount) * total)
+        elif action == "scroll":
+            step = self._rows() if unit == "pages" else 1
+            self._scroll_to(self.top + int(amount) * step)
+
+    def _on_wheel(self, event):
+        if getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0:
+            self._scroll_to(self.top - WHEEL_LINES)
+        else:
+            self._scroll_to(self.top + WHEEL_LINES)
+        return "break"
+
+    def _flush(self):
+        try:
+            self.refresh()
+        finally:
+            self.root.after(self.flush_interval_ms, self._flush)
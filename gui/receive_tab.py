@@ -6,8 +6,10 @@ import customtkinter as ctk
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import os
-import time
 from network.receiver import FileReceiver
+from utils.helpers import format_file_size, format_duration
+from utils.log_buffer import LogBuffer, default_log_path
+from .log_view import LogView
 
 class ReceiveTab:
     pass
@@ -15,8 +17,10 @@ class ReceiveTab:
         self.parent = parent
         self.root = root
         self.receiver = FileReceiver()
+        self.log_buffer = LogBuffer()  # Only the latest lines are kept, optionally all of them on disk
 
         self.setup_ui()
+        self.receiver.progress_bus.subscribe(self._on_progress)
 
     def setup_ui(self):
         # Server section
@@ -90,9 +94,21 @@ class ReceiveTab:
             font=ctk.CTkFont(size=14, weight="bold")
         ).pack(pady=(10, 5))
 
-        # Status text box
-        self.status_textbox = ctk.CTkTextbox(status_section, height=150)
-        self.status_textbox.pack(fill="both", padx=10, pady=(5, 10), expand=True)
+        # Progress of the transfers being received
+        self.progress_var = tk.StringVar(value="")
+        ctk.CTkLabel(status_section, textvariable=self.progress_var).pack(padx=10, anchor="w")
+
+        # Status log, showing only the lines on screen
+        self.log_view = LogView(status_section, self.root, self.log_buffer)
+        self.log_view.pack(fill="both", padx=10, pady=(5, 5), expand=True)
+
+        self.keep_log_var = tk.BooleanVar(value=False)
+        ctk.CTkCheckBox(
+            status_section,
+            text=f"Keep full log in {default_log_path()}",
+            variable=self.keep_log_var,
+            command=self.toggle_log_file
+        ).pack(padx=10, pady=(0, 10), anchor="w")
         self.log_message("Ready to receive files...")
     
     def browse_directory(self):
@@ -108,9 +124,9 @@ class ReceiveTab:
         save_dir = self.save_dir_var.get()
 
         try:
-            # Setup callbacks
+            # Setup callbacks, the log view picks new lines up on its own timer
             def log_callback(message):
-                self.root.after(0, lambda m=message: self.log_message(m))
+                self.log_message(message)
             
             def ui_callback(action, state=None):
                 if action == "server_started":
@@ -136,7 +152,31 @@ class ReceiveTab:
     def stop_receiving(self):
         self.receiver.stop_receiving()
 
+    def _on_progress(self, events):
+        # Called from the progress bus thread at most once per tick
+        events = [event for event in events if event["direction"] == "receive"]
+        if events:
+            self.root.after(0, lambda: self._show_progress(events))
+
+    def _show_progress(self, events):
+        active = [event for event in events if not event["finished"]]
+        if not active:
+            self.progress_var.set("")
+            return
+        event = active[-1]
+        text = (f"Receiving '{event['name']}'... {event['percent']:.1f}% "
+                f"({format_file_size(event['rate'])}/s, {format_duration(event['eta'])} left)")
+        if len(active) > 1:
+            text += f" and {len(active) - 1} more"
+        self.progress_var.set(text)
+
+    def toggle_log_file(self):
+        try:
+            self.log_buffer.set_spill(default_log_path() if self.keep_log_var.get() else None)
+        except OSError as e:
+            self.keep_log_var.set(False)
+            messagebox.showerror("Error", f"Failed to open log file: {e}")
+
     def log_message(self, message):
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-        self.status_textbox.insert("end", f"[{timestamp}] {message}\n")
-        self.status_textbox.see("end")
\ No newline at end of file
+        # Safe to call from any thread
+        self.log_buffer.append(message)
\ No newline at end of file
@@ -9,16 +9,28 @@ import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog
 from tkinterdnd2 import DND_FILES, TkinterDnD
 from network.sender import FileSender
-from utils.helpers import discover_file_server_ip, discover_all_file_servers
+from network.fanout import FanOutSender
+from network.discovery import get_peer_registry, rank_receivers, choose_receiver, BEACON_INTERVAL
+from network.compression import available_codecs
+from network.throttle import TokenBucket, PRIORITIES
+from network.protocol import STATUS_OK, STATUS_ERROR, TransferError
+from utils.helpers import (
+    discover_file_server_ip, discover_all_file_servers, discover_file_servers_info, format_file_size, format_duration, path_size
+)
+from utils.progress import get_progress_bus
 
 class SendTab:
     def __init__(self, parent, root):
         self.parent = parent
         self.root = root
         self.selected_files = []  # Store multiple selected files
-        self.sender = FileSender()  # Initialize FileSender
+        self.rate_limiter = TokenBucket()  # Shared by every transfer started from this tab
+        self.sender = FileSender(rate_limiter=self.rate_limiter)  # Initialize FileSender
+        self.peer_registry = get_peer_registry()  # Starts listening for receiver beacons right away
+        self.progress_bus = get_progress_bus()
 
         self.setup_ui()
+        self.progress_bus.subscribe(self._on_progress)
 
     def setup_ui(self):
         # File selection frame
@@ -68,7 +80,7 @@ class SendTab:
         host_frame.pack(fill="x", padx=20, pady=5)
 
         ctk.CTkLabel(host_frame, text="Host:").pack(side="left", padx=(10, 5))
-        self.host_entry = ctk.CTkEntry(host_frame, placeholder_text="Enter host address (or 'auto' for discovery)")
+        self.host_entry = ctk.CTkEntry(host_frame, placeholder_text="Enter host address, several separated by commas (or 'auto' for discovery)")
         self.host_entry.pack(side="left", fill="x", expand=True, padx=5)
         self.host_entry.insert(0, "auto")
 
@@ -91,6 +103,40 @@ class SendTab:
         self.port_entry.pack(side="left", fill="x", expand=True, padx=5)
         self.port_entry.insert(0, "9999")
 
+        # Compression choice
+        compression_frame = ctk.CTkFrame(conn_section)
+        compression_frame.pack(fill="x", padx=20, pady=5)
+
+        ctk.CTkLabel(compression_frame, text="Compression:").pack(side="left", padx=(10, 5))
+        self.compression_var = tk.StringVar(value="Off")
+        self.compression_menu = ctk.CTkOptionMenu(
+            compression_frame,
+            values=["Off"] + available_codecs(),
+            variable=self.compression_var,
+            width=100
+        )
+        self.compression_menu.pack(side="left", padx=5)
+
+        # Bandwidth limit and priority, the limit can be changed while sending
+        limit_frame = ctk.CTkFrame(conn_section)
+        limit_frame.pack(fill="x", padx=20, pady=5)
+
+        ctk.CTkLabel(limit_frame, text="Limit (MB/s):").pack(side="left", padx=(10, 5))
+        self.rate_limit_entry = ctk.CTkEntry(limit_frame, placeholder_text="unlimited", width=100)
+        self.rate_limit_entry.pack(side="left", padx=5)
+        self.rate_limit_entry.bind("<Return>", self.apply_rate_limit)
+        self.rate_limit_entry.bind("<FocusOut>", self.apply_rate_limit)
+
+        ctk.CTkLabel(limit_frame, text="Priority:").pack(side="left", padx=(10, 5))
+        self.priority_var = tk.StringVar(value="normal")
+        self.priority_menu = ctk.CTkOptionMenu(
+            limit_frame,
+            values=list(PRIORITIES),
+            variable=self.priority_var,
+            width=100
+        )
+        self.priority_menu.pack(side="left", padx=5)
+
         # Destination filename input
         dest_frame = ctk.CTkFrame(conn_section)
         dest_frame.pack(fill="x", padx=20, pady=(5, 15))
@@ -139,14 +185,56 @@ class SendTab:
             self.dest_filename_entry.delete(0, 'end')
             self.dest_filename_entry.insert(0, os.path.basename(files[0]))
     
+    def apply_rate_limit(self, event=None):
+        text = self.rate_limit_entry.get().strip()
+        try:
+            rate = float(text) * 1024 * 1024 if text else None
+        except ValueError:
+            self.send_status_var.set("Limit must be a number of MB/s")
+            return
+        if rate is not None and rate <= 0:
+            rate = None
+        self.rate_limiter.set_rate(rate)
+        self.send_status_var.set(f"Limit set to {text} MB/s" if rate else "Limit removed")
+
     def discover_hosts(self):
         self.send_status_var.set("Scanning for hosts on local network...")
         self.discover_button.configure(state="disabled")  # Disable button
         def do_discover():
-            hosts = discover_all_file_servers()
+            # Receivers that announced themselves are known already, scan only if none did
+            peers = self.peer_registry.peers() or discover_file_servers_info()
+            if peers:
+                # Least busy receivers first, with enough room for the selected files
+                hosts = [self._describe_peer(peer) for peer in rank_receivers(peers, self._selected_size())]
+            else:
+                hosts = discover_all_file_servers()
             self.root.after(0, lambda: self.show_host_selection(hosts))
         threading.Thread(target=do_discover, daemon=True).start()
 
+    def _describe_peer(self, peer):
+        details = []
+        if peer.get("active_transfers") is not None:
+            details.append(f"{peer['active_transfers']} active")
+        if peer.get("free_bytes") is not None:
+            details.append(f"{format_file_size(peer['free_bytes'])} free")
+        return f"{peer['host']} ({', '.join(details)})" if details else peer["host"]
+
+    def _selected_size(self):
+        """Total size of the selected files and folders, in bytes"""
+        return sum(path_size(path) for path in self.selected_files)
+
+    def _on_progress(self, events):
+        # Called from the progress bus thread at most once per tick
+        events = [event for event in events if event["direction"] == "send" and not event["finished"]]
+        if events:
+            self.root.after(0, lambda: self._show_progress(events[-1]))
+
+    def _show_progress(self, event):
+        self.send_status_var.set(
+            f"Sending '{event['name']}'... {event['percent']:.1f}% "
+            f"({format_file_size(event['rate'])}/s, {format_duration(event['eta'])} left)"
+        )
+
     def show_host_selection(self, hosts):
         self.discover_button.configure(state="normal")  # Re-enable button
 
@@ -161,7 +249,9 @@ class SendTab:
             "Discovered hosts:\n" + "\n".join(hosts) + "\n\nEnter the IP to use:",
             initialvalue=hosts[0]
         )
-        if selected and selected in hosts:
+        if selected:
+            selected = selected.split(" (")[0].strip()  # Drop the load details
+        if selected and selected in [host.split(" (")[0] for host in hosts]:
             self.host_entry.delete(0, 'end')
             self.host_entry.insert(0, selected)
             self.send_status_var.set(f"Selected host: {selected}")
@@ -191,40 +281,151 @@ class SendTab:
         try:
             host = self.host_entry.get().strip() or "auto"
             port = int(self.port_entry.get() or 9999)
-
-            for file_path in self.selected_files:
-                dest_filename = os.path.basename(file_path)
-
-                # Set up progress callback
-                def progress_callback(progress):
-                    self.root.after(0, lambda p=progress: self.send_status_var.set(f"Sending... {p:.1f}%"))
-
-                # Auto-discovery visual feedback
-                if host == "auto":
-                    self.root.after(0, lambda: self.send_status_var.set("Discovering host on local network..."))
+            total = len(self.selected_files)
+            compression = self.compression_var.get()
+            self.sender = FileSender(compression=None if compression == "Off" else compression, rate_limiter=self.rate_limiter)
+            throttle = self.sender.create_throttle(priority=PRIORITIES[self.priority_var.get()])
+
+            # Hosts separated by '>' form a relay chain, each passing the files on to the next
+            if ">" in host:
+                self._send_chain([item.strip() for item in host.split(">") if item.strip()], port)
+                return
+
+            # A comma-separated list of hosts sends everything to all of them at once
+            hosts = [item.strip() for item in host.split(",") if item.strip()]
+            if len(hosts) > 1:
+                self._send_to_hosts(hosts, port, throttle)
+                return
+
+            # Auto-discovery visual feedback
+            if host == "auto":
+                self.root.after(0, lambda: self.send_status_var.set("Discovering host on local network..."))
+                # Wait at most one beacon interval for an announcement, then ask on the network.
+                # The least busy receiver with room for the files is picked.
+                required_bytes = self._selected_size()
+                peer = self.peer_registry.resolve(timeout=BEACON_INTERVAL, required_bytes=required_bytes)
+                if not peer:
+                    peer = choose_receiver(discover_file_servers_info(), required_bytes)
+                if peer:
+                    discovered_host, port = peer["host"], peer["port"]
+                else:
                     discovered_host = discover_file_server_ip()
-                    if not discovered_host:
-                        self.root.after(0, lambda: self.send_status_var.set("No file server found on local network."))
-                        self.root.after(0, lambda: self.send_button.configure(state="normal"))
-                        return
-                    self.root.after(0, lambda: self.send_status_var.set(f"Discovered host: {discovered_host}"))
-                    host = discovered_host
-
-                # Send the file
-                self.sender.send_file(
-                    file_path,
-                    host,
-                    port,
-                    dest_filename,
-                    progress_callback
-                )
-
-                # Update UI on success
-                self.root.after(0, lambda: self.send_status_var.set("File sent successfully!"))
-                self.root.after(0, lambda: messagebox.showinfo("Success", f"File sent successfully as '{dest_filename}'"))
+                if not discovered_host:
+                    self.root.after(0, lambda: self.send_status_var.set("No file server found on local network."))
+                    return
+                self.root.after(0, lambda: self.send_status_var.set(f"Discovered host: {discovered_host}"))
+                host = discovered_host
+
+            folders = [path for path in self.selected_files if os.path.isdir(path)]
+            files = [path for path in self.selected_files if not os.path.isdir(path)]
+            failed = []
+            summaries = []
+
+            # Folders go over as streamed archives
+            for folder in folders:
+                dest_name = os.path.basename(os.path.normpath(folder))
+                try:
+                    with self.progress_bus.track(dest_name, path_size(folder)) as tracker:
+                        summaries.append(self.sender.send_archive(folder, host, port, dest_name, tracker, throttle))
+                except TransferError:
+                    failed.append(dest_name)
+
+            # Stream every file over a single connection
+            if files:
+                with self.sender.open_session(host, port, throttle=throttle) as session:
+                    for file_path in files:
+                        dest_filename = os.path.basename(file_path)
+                        with self.progress_bus.track(dest_filename, path_size(file_path)) as tracker:
+                            session.send(file_path, dest_filename, tracker)
+
+                failed += [name for name, status in session.results if status != STATUS_OK]
+                summaries.append(session.summary())
+
+            # Report the whole batch once
+            if failed:
+                summary = f"{total - len(failed)} of {total} items sent. Failed: {', '.join(failed)}"
+                self.root.after(0, lambda: self.send_status_var.set(summary))
+                self.root.after(0, lambda: messagebox.showerror("Error", summary))
+            else:
+                summary = f"{total} item{'s' if total != 1 else ''} sent successfully!"
+                if self.sender.compression:
+                    raw_bytes = sum(item["bytes"] for item in summaries)
+                    wire_bytes = sum(item["wire_bytes"] for item in summaries)
+                    time_saved = sum(item["time_saved"] for item in summaries)
+                    ratio = raw_bytes / wire_bytes if wire_bytes else 1.0
+                    summary += f"\nCompressed {ratio:.2f}x, about {time_saved:.1f}s saved"
+                self.root.after(0, lambda: self.send_status_var.set(summary))
+                self.root.after(0, lambda: messagebox.showinfo("Success", summary))
 
         except Exception as e:
             self.root.after(0, lambda: self.send_status_var.set(f"Error: {str(e)}"))
             self.root.after(0, lambda: messagebox.showerror("Error", "Failed to send file"))
         finally:
-            self.root.after(0, lambda: self.send_button.configure(state="normal"))
\ No newline at end of file
+            self.root.after(0, lambda: self.send_button.configure(state="normal"))
+
+    def _send_chain(self, hosts, port):
+        files = [path for path in self.selected_files if not os.path.isdir(path)]
+        if len(files) != len(self.selected_files):
+            self.root.after(0, lambda: messagebox.showerror("Error", "Folders can not be sent down a relay chain."))
+            return
+
+        hops = [(host, port) for host in hosts]
+        failed = {host: [] for host in hosts}
+        for file_path in files:
+            dest_filename = os.path.basename(file_path)
+            try:
+                with self.progress_bus.track(dest_filename, path_size(file_path)) as tracker:
+                    chain = self.sender.send_chain(file_path, hops, dest_filename, tracker)
+            except TransferError:
+                # The first receiver failed the file, the rest of the chain did not report
+                chain = [(hop, STATUS_ERROR) for hop in hops]
+            for (host, _), status in chain:
+                if status != STATUS_OK:
+                    failed[host].append(dest_filename)
+
+        lines = [f"{host}: {'OK' if not names else 'failed ' + ', '.join(names)}" for host, names in failed.items()]
+        summary = f"Relayed to {sum(not names for names in failed.values())} of {len(hosts)} hosts"
+        details = summary + "\n" + "\n".join(lines)
+        self.root.after(0, lambda: self.send_status_var.set(summary))
+        if any(failed.values()):
+            self.root.after(0, lambda: messagebox.showerror("Error", details))
+        else:
+            self.root.after(0, lambda: messagebox.showinfo("Success", details))
+
+    def _send_to_hosts(self, hosts, port, throttle):
+        folders = [path for path in self.selected_files if os.path.isdir(path)]
+        files = [path for path in self.selected_files if not os.path.isdir(path)]
+        failed = {host: [] for host in hosts}
+
+        # Folders are streamed to each host in turn
+        for folder in folders:
+            dest_name = os.path.basename(os.path.normpath(folder))
+            for host in hosts:
+                self.root.after(0, lambda h=host: self.send_status_var.set(f"Sending folder '{dest_name}' to {h}..."))
+                try:
+                    self.sender.send_archive(folder, host, port, dest_name, throttle=throttle)
+                except (OSError, TransferError):
+                    failed[host].append(dest_name)
+
+        # Files go to every host concurrently, each file read from disk once
+        throughput = 0.0
+        if files:
+            def status_callback(host, message):
+                self.root.after(0, lambda: self.send_status_var.set(f"{host}: {message}"))
+
+            result = FanOutSender(self.sender).send(files, hosts, port, status_callback, throttle)
+            throughput = result["throughput"]
+            for host, host_result in result["hosts"].items():
+                failed[host] += host_result["failed"]
+
+        # Report every host once
+        lines = [f"{host}: {'OK' if not names else 'failed ' + ', '.join(names)}" for host, names in failed.items()]
+        summary = f"Sent to {sum(not names for names in failed.values())} of {len(hosts)} hosts"
+        if throughput:
+            summary += f" ({throughput / (1024 * 1024):.1f} MB/s overall)"
+        details = summary + "\n" + "\n".join(lines)
+        self.root.after(0, lambda: self.send_status_var.set(summary))
+        if any(failed.values()):
+            self.root.after(0, lambda: messagebox.showerror("Error", details))
+        else:
+            self.root.after(0, lambda: messagebox.showinfo("Success", details))
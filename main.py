@@ -1,9 +1,20 @@
 """
 File Transfer GUI - Main Entry Point
+
+Without arguments the GUI starts. With a command (send, receive, daemon) the
+file transfer runs headless, without ever loading Tk; see `python main.py --help`.
 """
 
-from gui.main_window import FileTransferApp
+import sys
+import time
+
+STARTED = time.perf_counter()
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        from cli import main
+        sys.exit(main(sys.argv[1:], STARTED))
+
+    from gui.main_window import FileTransferApp
     app = FileTransferApp()
-    app.run()
\ No newline at end of file
+    app.run()
@@ -0,0 +1,322 @@
+"""
+Archive - Streams directory trees as tar archives inside payload frames
+"""
+
+import os
+import tarfile
+from utils.hashing import create_hasher
+from network.protocol import pack_frame_header, read_payload
+from network.writer import create_temp_file, sync_directory, sync_filesystem, FSYNC_COMMIT, FSYNC_ALWAYS
+
+# Largest payload frame of an archive stream
+ARCHIVE_BUFFER_SIZE = 1024 * 1024
+
+class FrameWriter:
+    """
+    File-like object that sends everything written to it as payload frames,
+    hashing the stream on the way out. Small writes are coalesced into frames
+    of up to `buffer_size` bytes, compressed when a ChunkCompressor is given.
+    """
+
+    def __init__(self, client, hasher, on_sent=None, buffer_size=ARCHIVE_BUFFER_SIZE, compressor=None):
+        self.client = client
+        self.hasher = hasher
+        self.on_sent = on_sent
+        self.compressor = compressor
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.written = 0
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """Send whatever is buffered as one frame"""
+        if not self.buffer:
+            return
+        if self.compressor:
+            frame_type, data = self.compressor.compress(bytes(self.buffer))
+            self.client.sendall(pack_frame_header(len(data), frame_type))
+            self.client.sendall(data)
+        else:
+            self.client.sendall(pack_frame_header(len(self.buffer)))
+            self.client.sendall(self.buffer)
+        self.hasher.update(self.buffer)
+        self.written += len(self.buffer)
+        if self.on_sent:
+            self.on_sent(len(self.buffer))
+        self.buffer.clear()
+
+class FrameReader:
+    """
+    File-like object reading the payload frames of a transfer as one continuous stream,
+    hashing it as it is consumed
+    """
+
+    def __init__(self, reader, hasher, buffer_size=ARCHIVE_BUFFER_SIZE, decompress=None, on_read=None):
+        self.frames = read_payload(reader, bytearray(buffer_size), decompress)
+        self.hasher = hasher
+        self.on_read = on_read  # Called with the size of every frame consumed
+        self.pending = b""
+        self.position = 0
+        self.received = 0
+
+    def read(self, size=-1):
+        chunks = []
+        while size:
+            if self.position == len(self.pending):
+                data = next(self.frames, None)
+                if data is None:
+                    break
+                self.hasher.update(data)
+                self.received += len(data)
+                if self.on_read:
+                    self.on_read(len(data))
+                self.pending = bytes(data)
+                self.position = 0
+
+            end = len(self.pending) if size < 0 else min(len(self.pending), self.position + size)
+            chunks.append(self.pending[self.position:end])
+            if size > 0:
+                size -= end - self.position
+            self.position = end
+        return b"".join(chunks)
+
+    def drain(self):
+        """Consume whatever is left of the payload, such as tar end-of-archive padding"""
+        while self.read(ARCHIVE_BUFFER_SIZE):
+            pass
+
+def archive_members(source):
+    """
+    List what an archive of `source` contains
+
+    Args:
+        source: A directory, whose contents are archived, or a list of files and directories,
+            each archived under its own name
+
+    Returns:
+        List of (path, arcname) tuples
+    """
+    if isinstance(source, (str, os.PathLike)):
+        if not os.path.isdir(source):
+            raise NotADirectoryError(f"'{source}' is not a directory.")
+        with os.scandir(source) as entries:
+            return [
+                (entry.path, entry.name)
+                for entry in sorted(entries, key=lambda entry: entry.name)
+                if entry.is_dir(follow_symlinks=False) or entry.is_file(follow_symlinks=False)
+            ]
+
+    members = []
+    for path in source:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File '{path}' does not exist.")
+        members.append((path, os.path.basename(os.path.normpath(path))))
+    return members
+
+def content_size(members):
+    """
+    Returns:
+        Total size in bytes of the regular files in an archive
+    """
+    return sum(
+        stat_result.st_size
+        for path, arcname in members
+        for _, _, stat_result, is_dir in iter_tree(path, arcname)
+        if not is_dir
+    )
+
+def _tar_info(path, arcname, stat_result, is_dir):
+    """Build a minimal tar header, skipping the owner lookups tarfile.gettarinfo does per file"""
+    info = tarfile.TarInfo(arcname)
+    info.mtime = int(stat_result.st_mtime)  # Whole seconds keep pax headers out of the stream
+    info.mode = stat_result.st_mode & 0o7777
+    if is_dir:
+        info.type = tarfile.DIRTYPE
+    else:
+        info.size = stat_result.st_size
+    return info
+
+def iter_tree(path, arcname):
+    """
+    Walk a file or directory tree in archive order
+
+    Yields:
+        Tuples of (path, arcname, stat_result, is_dir) for regular files and directories.
+        Symlinks and special files are left out.
+    """
+    stat_result = os.stat(path)
+    if os.path.isfile(path):
+        yield path, arcname, stat_result, False
+        return
+
+    yield path, arcname, stat_result, True
+    with os.scandir(path) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        child_arcname = f"{arcname}/{entry.name}"
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_tree(entry.path, child_arcname)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path, child_arcname, entry.stat(), False
+
+def write_archive(writer, members):
+    """
+    Stream a tar archive of `members` into a FrameWriter. Files are read as the
+    archive is produced, nothing is staged on disk.
+    """
+    with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for member_path, member_arcname in members:
+            for path, arcname, stat_result, is_dir in iter_tree(member_path, member_arcname):
+                info = _tar_info(path, arcname, stat_result, is_dir)
+                if is_dir:
+                    tar.addfile(info)
+                else:
+                    with open(path, "rb") as file:
+                        tar.addfile(info, file)
+    writer.flush()
+
+def safe_member_path(root, name, checked_dirs=None):
+    """
+    Map an archive member name to a path below `root`
+
+    Args:
+        root: Real path of the extraction root
+        name: Member name from the archive
+        checked_dirs: Optional set of directories already known to lie below `root`
+
+    Returns:
+        Destination path, or None if the name is absolute or climbs out of `root`
+    """
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or name.startswith(("/", "\\")) or ".." in parts or ":" in parts[0]:
+        return None
+
+    path = os.path.join(root, *parts)
+
+    # Guard against directories in the destination that are symlinks pointing elsewhere
+    parent = os.path.dirname(path)
+    if checked_dirs is None or parent not in checked_dirs:
+        if os.path.commonpath([root, os.path.realpath(parent)]) != root:
+            return None
+        if checked_dirs is not None:
+            checked_dirs.add(parent)
+    return path
+
+class StagedArchive:
+    """
+    Files unpacked from an archive under temporary names next to their real ones,
+    kept there until the archive's digest has been checked. Committing moves them
+    all into place; discarding removes them, leaving any existing files untouched.
+    """
+
+    def __init__(self, fsync_policy=FSYNC_COMMIT):
+        self.fsync_policy = fsync_policy
+        self.files = []         # (temporary path, real path) of every file unpacked
+        self.directories = []   # (path, mtime) of every directory, in archive order
+        self.digests = {}       # Relative path with '/' separators -> hex digest of the content unpacked
+        self.count = 0
+
+    def add_file(self, temp_path, path):
+        self.files.append((temp_path, path))
+        self.count += 1
+
+    def commit(self):
+        """
+        Move every unpacked file to its real name, replacing any file there
+
+        Raises:
+            OSError: If syncing or renaming fails; the files not yet moved are removed
+        """
+        try:
+            # One call forces all of them to disk, instead of a sync per file
+            if self.fsync_policy == FSYNC_COMMIT:
+                sync_filesystem()
+            for temp_path, path in self.files:
+                os.replace(temp_path, path)
+                if self.fsync_policy == FSYNC_ALWAYS:
+                    sync_directory(path)
+        finally:
+            self.discard()  # Only finds the files a failure left unmoved
+
+        # Directory times change while their contents are written, so restore them last
+        for path, mtime in reversed(self.directories):
+            os.utime(path, (mtime, mtime))
+
+    def discard(self):
+        """Remove the files not moved to their real names"""
+        for temp_path, _ in self.files:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.files = []
+
+def _copy_member(source, target, hasher=None):
+    # The target is unbuffered, so a write may take only part of the data
+    while True:
+        data = source.read(ARCHIVE_BUFFER_SIZE)
+        if not data:
+            return
+        if hasher:
+            hasher.update(data)
+        view = memoryview(data)
+        while len(view):
+            view = view[target.write(view):]
+
+def extract_archive(frame_reader, root, log_callback=None, fsync_policy=FSYNC_COMMIT, hash_algorithm=None):
+    """
+    Unpack a tar stream as it arrives. Only regular files and directories are
+    created, members with unsafe paths are skipped, and modification times are kept.
+    Files are written under temporary names and only take their real names once
+    the caller commits the result, after checking the archive's digest.
+
+    Args:
+        frame_reader: FrameReader of the archive stream
+        root: Directory to unpack into
+        log_callback: Function to call with log messages
+        fsync_policy: One of the FSYNC_* constants of network.writer
+        hash_algorithm: If given, every file is hashed with it as it is unpacked, see StagedArchive.digests
+
+    Returns:
+        StagedArchive to commit or discard
+    """
+    os.makedirs(root, exist_ok=True)
+    root = os.path.realpath(root)
+    checked_dirs = set()
+    staged = StagedArchive(fsync_policy)
+
+    try:
+        with tarfile.open(fileobj=frame_reader, mode="r|") as tar:
+            for member in tar:
+                path = safe_member_path(root, member.name, checked_dirs)
+                if path is None or not (member.isfile() or member.isdir()):
+                    if log_callback:
+                        log_callback(f"Skipping archive entry '{member.name}'")
+                    continue
+
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    staged.directories.append((path, member.mtime))
+                    continue
+
+                if os.path.dirname(path) not in checked_dirs or not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                target, temp_path = create_temp_file(path, member.size)
+                staged.add_file(temp_path, path)
+                hasher = create_hasher(hash_algorithm) if hash_algorithm else None
+                with tar.extractfile(member) as source, target:
+                    _copy_member(source, target, hasher)
+                    if fsync_policy == FSYNC_ALWAYS:
+                        os.fsync(target.fileno())
+                os.utime(temp_path, (member.mtime, member.mtime))
+                if hasher:
+                    staged.digests[os.path.relpath(path, root).replace(os.sep, "/")] = hasher.hexdigest()
+
+        frame_reader.drain()
+    except BaseException:
+        staged.discard()
+        raise
+    return staged
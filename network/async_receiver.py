@@ -0,0 +1,341 @@
+"""
+Async File Receiver - Serves all connections from a single asyncio event loop
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.helpers import safe_filename
+from utils.hashing import create_hasher, update_with_zeros
+from network.receiver import FileReceiver, MAX_FRAME_SIZE
+from network.writer import WriteBehindFile, sync_filesystem, FSYNC_COMMIT
+from network.throttle import Throttle
+from network.compression import CODEC_NAMES, available_codecs, chunk_decompressor
+from network.protocol import (
+    unpack_header, pack_ack, pack_batch_ack, HEADER, FRAME, TRAILER, COMPRESSION, FRAME_DATA, FRAME_COMPRESSED,
+    FRAME_HOLE, FileHeader, KIND_FILE, KIND_BATCH_ACK, FLAG_DEFER_ACK, FLAG_COMPRESSED, FLAG_SPARSE, ProtocolError,
+    STATUS_OK, STATUS_CHECKSUM_MISMATCH, STATUS_ERROR, STATUS_UNSUPPORTED
+)
+
+# Connections served at the same time, further connections wait their turn
+DEFAULT_MAX_CONNECTIONS = 256
+
+# Threads performing disk writes for all connections
+DEFAULT_DISK_WORKERS = 4
+
+# Largest amount of data read from a connection before it is written to disk.
+# Reads stop while a write is pending, so TCP flow control pushes back on the sender.
+CHUNK_SIZE = 256 * 1024
+
+async def read_exact_async(reader, size):
+    """
+    Read exactly `size` bytes from an asyncio stream
+
+    Raises:
+        ConnectionError: If the peer closes the connection first
+    """
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed mid-transfer")
+
+async def read_header_async(reader):
+    """
+    Read a transfer header from an asyncio stream
+
+    Returns:
+        FileHeader, or None if the peer closed the connection cleanly before sending one
+    """
+    try:
+        data = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed mid-header")
+
+    kind, flags, hash_algorithm, name_length, file_size = unpack_header(data)
+    filename = (await read_exact_async(reader, name_length)).decode()
+    return FileHeader(kind, flags, hash_algorithm, filename, file_size)
+
+class AsyncFileReceiver(FileReceiver):
+    """
+    Drop-in replacement for FileReceiver that handles every connection as a
+    coroutine on one event loop instead of starting a thread per connection.
+
+    At most `max_connections` transfers run at once and disk writes go through a
+    bounded pool of `disk_workers` threads. It handles single files and sessions;
+    parallel-range and resumable transfers are answered with STATUS_UNSUPPORTED.
+    """
+
+    FEATURES = ["batch_ack", "compression", "sparse"]
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, disk_workers=DEFAULT_DISK_WORKERS):
+        super().__init__()
+        self.max_connections = max_connections
+        self.disk_workers = disk_workers
+        self.loop = None
+        self.stop_event = None
+        self.executor = None
+        self.loop_finished = threading.Event()
+
+    def stop_receiving(self):
+        """
+        Stop the file receiver server
+        """
+
+        if self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+            self.loop_finished.wait(timeout=5)
+        super().stop_receiving()
+
+    def _receive_files_thread(self):
+        """
+        Thread running the event loop that accepts and serves all connections
+        """
+
+        self.loop_finished.clear()
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._serve())
+        except Exception as e:
+            if self.is_receiving and self.log_callback:
+                self.log_callback(f"Error accepting connection: {e}")
+        finally:
+            self.loop.close()
+            self.loop = None
+            self.loop_finished.set()
+
+    async def _serve(self):
+        self.stop_event = asyncio.Event()
+        slots = asyncio.Semaphore(self.max_connections)
+        connections = set()  # Tasks serving the open connections
+
+        async def serve_connection(reader, writer):
+            async with slots:
+                self._transfer_started()
+                try:
+                    await self._handle_connection(reader, writer)
+                finally:
+                    self._transfer_finished()
+
+        async def on_connection(reader, writer):
+            # The connection is served in a task of its own, as asyncio reports the task
+            # it runs this callback in as failed if that task is cancelled
+            task = asyncio.get_running_loop().create_task(serve_connection(reader, writer))
+            connections.add(task)
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass  # Aborted by stop_receiving()
+            finally:
+                connections.discard(task)
+
+        with ThreadPoolExecutor(max_workers=self.disk_workers) as executor:
+            self.executor = executor
+            # asyncio listens on the socket again, so it is given the profile's backlog too
+            server = await asyncio.start_server(on_connection, sock=self.server_socket, limit=CHUNK_SIZE,
+                                                backlog=self.socket_profile.backlog)
+            await self.stop_event.wait()
+            server.close()
+
+            # Abort transfers still in progress
+            tasks = list(connections)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Serve every transfer sent over one connection
+        """
+
+        addr = writer.get_extra_info("peername")
+        if self.log_callback:
+            self.log_callback(f"Connection from {addr[0]}:{addr[1]}")
+
+        deferred = []  # Statuses of transfers sent with FLAG_DEFER_ACK, not yet reported
+
+        # Reads are paced by the rate limits, TCP flow control then slows the sender down
+        throttle = Throttle(self.rate_limiter, self.transfer_rate_limit)
+        self.throttles.add(throttle)
+
+        try:
+            # The event loop owns the socket, so it gets no timeout of its own
+            self.socket_profile.apply(writer.get_extra_info("socket"), addr[0], blocking=False)
+
+            while True:
+                header = await read_header_async(reader)
+                if header is None:
+                    break
+
+                if header.kind == KIND_BATCH_ACK:
+                    writer.write(await self._batch_ack_async(deferred))
+                    deferred.clear()
+                    await writer.drain()
+                    continue
+
+                flags = header.flags & ~FLAG_DEFER_ACK & ~FLAG_SPARSE
+                if header.kind == KIND_FILE and not flags:
+                    status = await self._receive_file_async(reader, header, throttle)
+                elif header.kind == KIND_FILE and flags == FLAG_COMPRESSED:
+                    codec_id, level = COMPRESSION.unpack(await read_exact_async(reader, COMPRESSION.size))
+                    codec = CODEC_NAMES.get(codec_id)
+                    if codec in available_codecs():
+                        status = await self._receive_file_async(
+                            reader, header, throttle, chunk_decompressor(codec, MAX_FRAME_SIZE)
+                        )
+                    else:
+                        status = STATUS_UNSUPPORTED
+                else:
+                    status = STATUS_UNSUPPORTED
+
+                if header.flags & FLAG_DEFER_ACK:
+                    deferred.append(status)
+                else:
+                    writer.write(pack_ack(status))
+                await writer.drain()
+
+                if status in (STATUS_ERROR, STATUS_UNSUPPORTED):
+                    # The payload was not consumed, so the stream can not be followed any further
+                    if deferred:
+                        writer.write(await self._batch_ack_async(deferred))
+                        await writer.drain()
+                    break
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.log_callback:
+                self.log_callback(f"Error receiving file: {str(e)}")
+
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass  # The peer is already gone
+
+    async def _batch_ack_async(self, deferred):
+        """Sync the files of a batch to disk on the disk executor, then pack their batch ack"""
+        if deferred and self.fsync_policy == FSYNC_COMMIT:
+            await asyncio.get_running_loop().run_in_executor(self.executor, sync_filesystem)
+        return pack_batch_ack(deferred)
+
+    async def _receive_file_async(self, reader, header, throttle, decompress=None):
+        """
+        Receive the payload and trailer of a single file
+        Args:
+            throttle: Throttle of the connection, pacing its reads
+            decompress: Function unpacking compressed frames, if the sender compresses
+        Returns:
+            Ack status code for the sender
+        """
+
+        loop = asyncio.get_running_loop()
+        filename = safe_filename(header.filename)
+        filesize = header.file_size
+        hasher = create_hasher(header.hash_algorithm)
+
+        if self.log_callback:
+            self.log_callback(f"Receiving file '{filename}' ({filesize} bytes)")
+
+        # Written to a preallocated temporary file, renamed once verified. The disk executor
+        # already overlaps writes with reads, so the file gets no write-behind thread of its own.
+        save_path = os.path.join(self.save_dir, filename)
+        sparse = bool(header.flags & FLAG_SPARSE)
+        file = await loop.run_in_executor(
+            self.executor, lambda: WriteBehindFile(save_path, filesize, self._file_fsync_policy(header), sparse=sparse,
+                                          write_behind=False)
+        )
+        with self.stats.transfer(filename, "receive", filesize) as timing:
+            tracker = self.progress_bus.track(filename, filesize, "receive")
+            try:
+                received = 0
+                while True:
+                    frame_type, length = FRAME.unpack(await read_exact_async(reader, FRAME.size))
+                    if frame_type == FRAME_COMPRESSED and decompress and length:
+                        # Unpacking is CPU work, so it runs on the disk executor together with the write
+                        data = await read_exact_async(reader, length)
+                        await self._pace(throttle, length)
+                        unpacked = await loop.run_in_executor(self.executor, self._write_compressed, file, hasher, decompress, data)
+                        self._log_progress(filename, received, received + unpacked, filesize)
+                        received += unpacked
+                        tracker.advance(unpacked)
+                        continue
+                    if frame_type == FRAME_HOLE and sparse and length:
+                        await loop.run_in_executor(self.executor, self._write_hole, file, hasher, length)
+                        self._log_progress(filename, received, received + length, filesize)
+                        received += length
+                        tracker.advance(length)
+                        continue
+                    if frame_type != FRAME_DATA:
+                        raise ProtocolError(f"Unexpected frame type {frame_type}")
+                    if not length:
+                        break
+
+                    while length:
+                        t = timing.clock()
+                        data = await read_exact_async(reader, throttle.slice_size(min(length, CHUNK_SIZE)))
+                        await self._pace(throttle, len(data))
+                        t = timing.record("receive", t, len(data))
+                        # Hashing runs with the write on the disk executor, and is part of the write stage
+                        await loop.run_in_executor(self.executor, self._write_chunk, file, hasher, data)
+                        timing.record("write", t, len(data))
+                        length -= len(data)
+                        self._log_progress(filename, received, received + len(data), filesize)
+                        received += len(data)
+                        tracker.advance(len(data))
+
+                # Receive checksum
+                (digest_length,) = TRAILER.unpack(await read_exact_async(reader, TRAILER.size))
+                received_checksum = await read_exact_async(reader, digest_length)
+                local_checksum = hasher.digest()
+                if received != filesize or received_checksum != local_checksum:
+                    if self.log_callback:
+                        self.log_callback(f"Checksum mismatch for '{filename}'!\nExpected: {received_checksum.hex()}\nGot: {local_checksum.hex()}")
+                    tracker.fail("checksum mismatch")
+                    timing.fail("checksum mismatch")
+                    return STATUS_CHECKSUM_MISMATCH
+                t = timing.clock()
+                await loop.run_in_executor(self.executor, file.commit)
+                timing.record("commit", t)
+            except BaseException as e:
+                tracker.fail(str(e) or "transfer aborted")
+                raise
+            finally:
+                tracker.finish(tracker.error)
+                await loop.run_in_executor(self.executor, file.discard)  # Nothing left to drop once committed
+
+        if self.log_callback:
+            self.log_callback(f"Checksum OK for '{filename}'")
+            self.log_callback(f"File '{filename}' received successfully")
+        return STATUS_OK
+
+    @staticmethod
+    async def _pace(throttle, count):
+        """Wait until the rate limits allow `count` more bytes, without blocking the event loop"""
+        delay = throttle.reserve(count)
+        if delay:
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _write_chunk(file, hasher, data):
+        """Write and hash one chunk, run on the disk executor so the event loop never blocks"""
+        file.write(data)
+        hasher.update(data)
+
+    @staticmethod
+    def _write_hole(file, hasher, length):
+        """Leave a hole in the file, hashed as the zeros it reads as"""
+        file.skip(length)
+        update_with_zeros(hasher, length)
+
+    @staticmethod
+    def _write_compressed(file, hasher, decompress, data):
+        """Unpack, write and hash one compressed frame, returning its unpacked size"""
+        data = decompress(data)
+        file.write(data)
+        hasher.update(data)
+        return len(data)
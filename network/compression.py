@@ -0,0 +1,194 @@
+"""
+Compression - Optional per-frame payload compression with an automatic raw bypass
+
+Each payload frame is compressed on its own, so a frame that does not shrink
+can simply be sent as a plain data frame instead. Already compressed data
+(media, archives) quickly stops being tried at all, so it costs almost no CPU.
+"""
+
+import time
+import zlib
+
+try:
+    import bz2
+except ImportError:  # Python built without libbz2
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
+
+from network.protocol import FRAME_DATA, FRAME_COMPRESSED, ProtocolError
+
+# Codec identifiers used on the wire
+CODEC_IDS = {"zlib": 1, "bz2": 2, "lzma": 3}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+
+# Level used when none is given, and the accepted range, per codec
+DEFAULT_LEVELS = {"zlib": 6, "bz2": 9, "lzma": 6}
+LEVEL_RANGES = {"zlib": (0, 9), "bz2": (1, 9), "lzma": (0, 9)}
+
+# A frame is only sent compressed when it shrinks to at most this fraction of its size
+MIN_SAVING_RATIO = 0.95
+
+# Larger frames are first probed by compressing only this much of their start
+PROBE_SIZE = 64 * 1024
+
+# After this many frames in a row fail to shrink, the next BYPASS_FRAMES frames are sent
+# raw without trying. Each further failure doubles the bypass, up to MAX_BYPASS_FRAMES.
+BYPASS_AFTER = 2
+BYPASS_FRAMES = 4
+MAX_BYPASS_FRAMES = 256
+
+def available_codecs():
+    """
+    Codecs this Python build supports
+
+    Returns:
+        List of codec names, fastest first
+    """
+    return [name for name, module in (("zlib", zlib), ("bz2", bz2), ("lzma", lzma)) if module]
+
+def validate_codec(codec, level=None):
+    """
+    Check a codec and level, filling in the default level
+
+    Returns:
+        Tuple of (codec, level)
+
+    Raises:
+        ValueError: If the codec is unknown or unavailable, or the level is out of range
+    """
+    if codec not in available_codecs():
+        raise ValueError(f"Unsupported compression codec: {codec}")
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    low, high = LEVEL_RANGES[codec]
+    if not low <= level <= high:
+        raise ValueError(f"Compression level for {codec} must be between {low} and {high}")
+    return codec, level
+
+def _compress(codec, level, data):
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "bz2":
+        return bz2.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+def _decompressor(codec):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+class ChunkCompressor:
+    """
+    Compresses payload frames one at a time, backing off from data that does not compress
+    """
+
+    def __init__(self, codec, level=None):
+        self.codec, self.level = validate_codec(codec, level)
+        self.codec_id = CODEC_IDS[self.codec]
+        self.failures = 0       # Frames in a row that did not shrink
+        self.bypass = 0         # Frames still to be sent raw without trying
+        self.bypass_length = BYPASS_FRAMES
+        self.raw_bytes = 0      # Payload bytes handed in
+        self.wire_bytes = 0     # Payload bytes actually sent
+        self.seconds = 0.0      # Time spent compressing
+
+    def compress(self, data):
+        """
+        Prepare one frame of payload
+
+        Args:
+            data: Raw frame contents
+
+        Returns:
+            Tuple of (frame_type, frame contents)
+        """
+
+        self.raw_bytes += len(data)
+        if self.bypass:
+            self.bypass -= 1
+            self.wire_bytes += len(data)
+            return FRAME_DATA, data
+
+        started = time.perf_counter()
+        packed = None
+        if len(data) <= PROBE_SIZE or self._shrinks(data[:PROBE_SIZE]):
+            packed = _compress(self.codec, self.level, data)
+        self.seconds += time.perf_counter() - started
+
+        if packed is not None and self._shrinks_to(data, packed):
+            self.failures = 0
+            self.bypass_length = BYPASS_FRAMES
+            self.wire_bytes += len(packed)
+            return FRAME_COMPRESSED, packed
+
+        self.failures += 1
+        if self.failures >= BYPASS_AFTER:
+            self.bypass = self.bypass_length
+            self.bypass_length = min(self.bypass_length * 2, MAX_BYPASS_FRAMES)
+        self.wire_bytes += len(data)
+        return FRAME_DATA, data
+
+    def _shrinks(self, sample):
+        return self._shrinks_to(sample, _compress(self.codec, self.level, sample))
+
+    @staticmethod
+    def _shrinks_to(data, packed):
+        return len(packed) <= len(data) * MIN_SAVING_RATIO
+
+def chunk_decompressor(codec, limit):
+    """
+    Build the function that unpacks compressed frames on the receiving side
+
+    Args:
+        codec: Codec name announced by the sender
+        limit: Largest accepted size of one unpacked frame, guarding against decompression bombs
+
+    Returns:
+        Function taking the frame contents and returning the unpacked bytes
+    """
+
+    def decompress(data):
+        decompressor = _decompressor(codec)
+        unpacked = decompressor.decompress(data, limit)
+        if not decompressor.eof:
+            raise ProtocolError("Compressed frame is truncated or too large")
+        return unpacked
+
+    return decompress
+
+def transfer_summary(raw_bytes, wire_bytes, seconds, compress_seconds=0.0):
+    """
+    Describe a finished transfer
+
+    The time saved is an estimate: the network time actually spent is scaled up to
+    what the raw data would have taken at the same rate, minus the time the transfer took.
+
+    Only covers compression: data that was not sent at all, because the receiver
+    already had it or it is a hole, is reported by the caller under keys of its own.
+
+    Args:
+        raw_bytes: Payload size before compression
+        wire_bytes: Payload bytes actually sent
+        seconds: Wall-clock duration of the transfer
+        compress_seconds: Part of that duration spent compressing
+
+    Returns:
+        Dict with 'bytes', 'wire_bytes', 'seconds', 'compression_ratio' and 'time_saved'
+    """
+
+    ratio = raw_bytes / wire_bytes if wire_bytes else 1.0
+    network_seconds = max(seconds - compress_seconds, 0.0)
+    time_saved = network_seconds * ratio - seconds if wire_bytes != raw_bytes else 0.0
+    return {
+        "bytes": raw_bytes,
+        "wire_bytes": wire_bytes,
+        "seconds": seconds,
+        "compression_ratio": ratio,
+        "time_saved": time_saved,
+    }
@@ -0,0 +1,334 @@
+"""
+Delta - rsync-style rolling checksum delta encoding
+
+The receiver describes the copy of a file it already has as a list of block
+signatures: a weak Adler-32 checksum that can be rolled one byte at a time,
+and a strong hash to confirm a match. The sender slides a window over its
+version of the file, and wherever the window matches a block the receiver
+already has it sends a reference to that block instead of the data.
+"""
+
+import hashlib
+import math
+import struct
+import zlib
+from network.protocol import FRAME, FRAME_DATA, FRAME_COPY, ProtocolError, pack_frame_header, read_exact, read_into
+
+COPY = struct.Struct("!QI")                 # first block index, number of blocks (payload of a FRAME_COPY)
+SIGNATURE_HEADER = struct.Struct("!IQI")    # block size, basis file size, block count
+SIGNATURE = struct.Struct("!I16s")          # weak checksum, strong hash
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 256 * 1024
+
+# Source data is read this much at a time; literal data is sent in frames of up to LITERAL_FLUSH bytes
+DELTA_READ_SIZE = 4 * 1024 * 1024
+LITERAL_FLUSH = 256 * 1024
+
+ADLER_MOD = 65521
+
+# After a mismatch, this many following block-aligned windows are checked before rolling
+LOOKAHEAD_BLOCKS = 8
+
+# Rolling byte by byte is given up after this many blocks without a match, and
+# retried after RESYNC_BLOCKS blocks have been skipped whole
+MAX_ROLL_BLOCKS = 8
+RESYNC_BLOCKS = 64
+
+def choose_block_size(file_size):
+    """
+    Pick a block size for a basis file, growing with the square root of its size
+    so the number of signatures stays manageable for very large files
+
+    Returns:
+        Block size in bytes, a multiple of 1 KB between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE
+    """
+    size = int(math.sqrt(file_size)) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def compute_signatures(path, file_size):
+    """
+    Compute the block signatures of a basis file
+
+    Returns:
+        Tuple of (block_size, list of (weak, strong) per block). The last block may be short.
+    """
+    block_size = choose_block_size(file_size)
+    signatures = []
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            signatures.append((zlib.adler32(block), strong_hash(block)))
+    return block_size, signatures
+
+def pack_signatures(block_size, basis_size, signatures):
+    """Serialize block signatures for the wire"""
+    header = SIGNATURE_HEADER.pack(block_size, basis_size, len(signatures))
+    return header + b"".join(SIGNATURE.pack(weak, strong) for weak, strong in signatures)
+
+def unpack_signatures(data):
+    """
+    Returns:
+        Tuple of (block_size, basis_size, list of (weak, strong))
+    """
+    block_size, basis_size, count = SIGNATURE_HEADER.unpack_from(data)
+    if len(data) != SIGNATURE_HEADER.size + count * SIGNATURE.size:
+        raise ProtocolError("Malformed block signatures")
+    return block_size, basis_size, list(SIGNATURE.iter_unpack(memoryview(data)[SIGNATURE_HEADER.size:]))
+
+class DeltaEncoder:
+    """
+    Turns a source file into a stream of literal and block-copy frames
+    against the receiver's block signatures
+    """
+
+    def __init__(self, client, block_size, basis_size, signatures):
+        self.client = client
+        self.block_size = block_size
+        self.signatures = signatures
+
+        # Only full blocks can match a full window, the short tail block is handled at the end
+        full_blocks = basis_size // block_size if block_size else 0
+        self.table = {}
+        for index in range(full_blocks):
+            self.table.setdefault(signatures[index][0], []).append(index)
+
+        self.literal = bytearray()
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+
+    def encode(self, file, hasher, on_sent):
+        """
+        Stream the delta of `file` to the receiver, hashing the source as it is read
+
+        Args:
+            on_sent: Function to call with the number of source bytes processed
+        """
+
+        block_size = self.block_size
+        table = self.table
+        if not table:
+            # Nothing to match against, the whole file is literal data
+            while True:
+                chunk = file.read(DELTA_READ_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                self._add_literal(chunk)
+                on_sent(len(chunk))
+            self._flush()
+            return
+
+        data = bytearray()
+        position = 0
+        eof = False
+        weak = a = b = None
+        rolled = 0      # Bytes rolled through since the last match
+        skipped = 0     # Blocks skipped without rolling since rolling was last given up
+
+        while True:
+            # Keep at least one window plus the byte after it in memory
+            if len(data) - position <= block_size and not eof:
+                if position >= DELTA_READ_SIZE:
+                    del data[:position]
+                    position = 0
+                chunk = file.read(DELTA_READ_SIZE)
+                if chunk:
+                    hasher.update(chunk)
+                    data += chunk
+                    on_sent(len(chunk))
+                else:
+                    eof = True
+                continue
+
+            if len(data) - position < block_size:
+                break
+
+            if weak is None:
+                weak = zlib.adler32(data[position:position + block_size])
+                a, b = weak & 0xFFFF, weak >> 16
+
+            indices = table.get(weak)
+            if indices:
+                index = self._find_block(indices, data[position:position + block_size])
+                if index is not None:
+                    self._add_copy(index)
+                    position += block_size
+                    weak = None
+                    rolled = skipped = 0
+                    continue
+
+            # In-place edits leave the following aligned blocks intact, find those at C speed first
+            index, skip = self._match_ahead(data, position)
+            if index is not None:
+                self._add_literal(data[position:position + skip])
+                self._add_copy(index)
+                position += skip + block_size
+                weak = None
+                rolled = 0
+                continue
+
+            if rolled >= MAX_ROLL_BLOCKS * block_size and len(data) - position > 2 * block_size:
+                # Long unmatched stretch, most likely rewritten data: stop rolling byte by byte and
+                # skip whole blocks, rolling again every RESYNC_BLOCKS to pick up shifted matches
+                self._add_literal(data[position:position + block_size])
+                position += block_size
+                weak = None
+                skipped += 1
+                if skipped >= RESYNC_BLOCKS:
+                    rolled = skipped = 0
+                continue
+
+            limit = min(len(data) - block_size, position + block_size)
+            if position == limit:
+                # No byte left to roll in: wait for more data or, at the very end, give up on this window
+                if eof:
+                    self._add_literal(data[position:position + 1])
+                    position += 1
+                    weak = None
+                continue
+
+            # Roll the window forward until the weak checksum hits or a block's worth of bytes has passed
+            start = position
+            while position < limit:
+                out = data[position]
+                a = (a - out + data[position + block_size]) % ADLER_MOD
+                b = (b - block_size * out + a - 1) % ADLER_MOD
+                weak = (b << 16) | a
+                position += 1
+                if weak in table:
+                    break
+            self._add_literal(data[start:position])
+            rolled += position - start
+
+        # Whatever is left is shorter than a block: it may match the receiver's short tail block
+        tail = bytes(data[position:])
+        if tail and self.signatures and len(tail) < block_size:
+            weak_tail, strong_tail = self.signatures[-1]
+            if zlib.adler32(tail) == weak_tail and strong_hash(tail) == strong_tail:
+                self._add_copy(len(self.signatures) - 1)
+                tail = b""
+        self._add_literal(tail)
+        self._flush()
+
+    def _match_ahead(self, data, position):
+        """
+        Check the block-aligned windows after `position` for a match
+
+        Returns:
+            Tuple of (block index, distance from position), or (None, 0)
+        """
+        block_size = self.block_size
+        for step in range(1, LOOKAHEAD_BLOCKS + 1):
+            start = position + step * block_size
+            if start + block_size > len(data):
+                break
+            window = data[start:start + block_size]
+            indices = self.table.get(zlib.adler32(window))
+            if indices:
+                index = self._find_block(indices, window)
+                if index is not None:
+                    return index, step * block_size
+        return None, 0
+
+    def _find_block(self, indices, window):
+        strong = strong_hash(window)
+        for index in indices:
+            if self.signatures[index][1] == strong:
+                return index
+        return None
+
+    def _add_copy(self, index):
+        self._flush_literal()
+        if self.copy_start is not None and self.copy_start + self.copy_count == index:
+            self.copy_count += 1
+        else:
+            self._flush_copy()
+            self.copy_start, self.copy_count = index, 1
+
+    def _add_literal(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        self.literal += data
+        if len(self.literal) >= LITERAL_FLUSH:
+            self._flush_literal()
+
+    def _flush_copy(self):
+        if self.copy_start is None:
+            return
+        self.client.sendall(pack_frame_header(COPY.size, FRAME_COPY) + COPY.pack(self.copy_start, self.copy_count))
+        self.copied_bytes += self.copy_count * self.block_size
+        self.copy_start, self.copy_count = None, 0
+
+    def _flush_literal(self):
+        if not self.literal:
+            return
+        self.client.sendall(pack_frame_header(len(self.literal)))
+        self.client.sendall(self.literal)
+        self.literal_bytes += len(self.literal)
+        self.literal.clear()
+
+    def _flush(self):
+        self._flush_copy()
+        self._flush_literal()
+
+def apply_delta(reader, basis, target, block_size, hasher, buffer, on_write=None):
+    """
+    Rebuild a file from a delta payload
+
+    Args:
+        reader: Buffered reader positioned at the first frame
+        basis: The receiver's existing copy, opened for reading
+        target: File object the new version is written to
+        block_size: Block size of the signatures the delta was made against
+        hasher: Hash object updated with the rebuilt content
+        buffer: Reusable bytearray for copying
+        on_write: Called with the size of every chunk written, literal or copied
+
+    Returns:
+        Tuple of (bytes written, literal bytes received)
+    """
+    view = memoryview(buffer)
+    written = literal = 0
+    while True:
+        frame_type, length = FRAME.unpack(read_exact(reader, FRAME.size))
+
+        if frame_type == FRAME_DATA:
+            if not length:
+                return written, literal
+            literal += length
+            while length:
+                chunk = view[:min(length, len(buffer))]
+                read_into(reader, chunk)
+                target.write(chunk)
+                hasher.update(chunk)
+                length -= len(chunk)
+                written += len(chunk)
+                if on_write:
+                    on_write(len(chunk))
+
+        elif frame_type == FRAME_COPY and length == COPY.size:
+            index, count = COPY.unpack(read_exact(reader, COPY.size))
+            basis.seek(index * block_size)
+            remaining = count * block_size
+            while remaining:
+                chunk_length = basis.readinto(view[:min(remaining, len(buffer))])
+                if not chunk_length:
+                    break  # The short tail block
+                target.write(view[:chunk_length])
+                hasher.update(view[:chunk_length])
+                remaining -= chunk_length
+                written += chunk_length
+                if on_write:
+                    on_write(chunk_length)
+
+        else:
+            raise ProtocolError(f"Unexpected frame type {frame_type}")
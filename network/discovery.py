@@ -0,0 +1,315 @@
+"""
+Discovery - Receiver announce beacons and a sender-side registry of live peers
+
+Receivers announce themselves every few seconds with a small JSON beacon sent
+to a multicast group on every network interface, and as a broadcast for
+networks that drop multicast. Senders keep a registry of the receivers heard
+recently, so finding a receiver is an in-memory lookup instead of a blocking
+broadcast round trip.
+
+Beacons also describe the receiver's load (free disk space, active transfers)
+and supported features, so senders can pick the least busy receiver.
+"""
+
+import json
+import socket
+import threading
+import time
+import uuid
+from utils.helpers import local_ipv4_addresses, broadcast_addresses
+
+BEACON_GROUP = "239.255.70.83"
+BEACON_PORT = 9998
+BEACON_MAGIC = "FSHR_ANNOUNCE"
+
+# Seconds between beacons, and how long a receiver stays listed after its last one
+BEACON_INTERVAL = 2.0
+PEER_TTL = 3 * BEACON_INTERVAL
+
+def pack_beacon(peer_id, port, leaving=False, info=None):
+    """
+    Build an announce beacon
+
+    Args:
+        peer_id: Identifier of the receiver, the same on every interface it announces on
+        port: TCP port the receiver listens on
+        leaving: If True, tell registries the receiver is shutting down
+        info: Dict of further details, such as FileReceiver.status()
+
+    Returns:
+        Bytes ready to be sent
+    """
+    beacon = dict(info or {})
+    beacon.update({"magic": BEACON_MAGIC, "id": peer_id, "port": port, "name": socket.gethostname()})
+    if leaving:
+        beacon["leaving"] = True
+    return json.dumps(beacon).encode()
+
+def unpack_beacon(data):
+    """
+    Decode an announce beacon
+
+    Returns:
+        Beacon dict, or None if the datagram is not a valid beacon
+    """
+    try:
+        beacon = json.loads(data.decode())
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(beacon, dict) or beacon.get("magic") != BEACON_MAGIC:
+        return None
+    if not isinstance(beacon.get("id"), str) or not isinstance(beacon.get("port"), int):
+        return None
+    return beacon
+
+class Announcer:
+    """
+    Background thread announcing a receiver on every network interface
+    """
+
+    def __init__(self, port, interval=BEACON_INTERVAL, group=BEACON_GROUP, beacon_port=BEACON_PORT, info_callback=None):
+        """
+        Args:
+            port: TCP port the receiver listens on
+            info_callback: Function returning a dict of details to add to every beacon
+            interval: Seconds between beacons
+            group: Multicast group to announce to
+            beacon_port: UDP port registries listen on
+        """
+        self.port = port
+        self.interval = interval
+        self.group = group
+        self.beacon_port = beacon_port
+        self.info_callback = info_callback
+        self.peer_id = uuid.uuid4().hex
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop announcing and tell registries the receiver is gone"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=self.interval + 1)
+            self.thread = None
+        self._send(pack_beacon(self.peer_id, self.port, leaving=True))
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            info = None
+            if self.info_callback:
+                try:
+                    info = self.info_callback()
+                except Exception:
+                    info = None  # Still announce the receiver, just without details
+            self._send(pack_beacon(self.peer_id, self.port, info=info))
+            self.stop_event.wait(self.interval)
+
+    def _send(self, beacon):
+        # Interfaces can come and go, so they are looked up again for every beacon
+        for address in local_ipv4_addresses():
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+                    s.sendto(beacon, (self.group, self.beacon_port))
+            except OSError:
+                continue
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            for address in broadcast_addresses():
+                try:
+                    s.sendto(beacon, (address, self.beacon_port))
+                except OSError:
+                    continue
+
+class PeerRegistry:
+    """
+    Background listener keeping track of the receivers that announced themselves recently.
+
+    A receiver is heard once per interface and once per beacon route (multicast and
+    broadcast); all of these are merged into one entry keyed by its identifier.
+    """
+
+    def __init__(self, ttl=PEER_TTL, group=BEACON_GROUP, beacon_port=BEACON_PORT):
+        """
+        Args:
+            ttl: Seconds a receiver stays listed after its last beacon
+            group: Multicast group to join
+            beacon_port: UDP port to listen on
+        """
+        self.ttl = ttl
+        self.group = group
+        self.beacon_port = beacon_port
+        self.entries = {}  # peer id -> peer dict
+        self.condition = threading.Condition()
+        self.sock = None
+        self.running = False
+
+    def start(self):
+        """
+        Start listening for beacons
+
+        Raises:
+            OSError: If the beacon port can not be bound
+        """
+        if self.running:
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # Lets every sender process on the machine hear the beacons
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(("", self.beacon_port))
+        self._join_group()
+        self.sock.settimeout(1)
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def peers(self):
+        """
+        Receivers heard from within the TTL
+
+        Returns:
+            List of peer dicts with 'id', 'host', 'port', 'name', 'addresses' and
+            'last_seen', plus whatever details the receiver announces ('free_bytes',
+            'active_transfers', 'features', ...), most recently heard first
+        """
+        with self.condition:
+            self._expire()
+            return sorted((dict(peer) for peer in self.entries.values()), key=lambda peer: -peer["last_seen"])
+
+    def resolve(self, timeout=0, required_bytes=0, feature=None):
+        """
+        Pick the least busy live receiver, waiting up to `timeout` seconds for one to announce itself
+
+        Args:
+            required_bytes: Free disk space the receiver must have
+            feature: Protocol feature the receiver must support, or None
+
+        Returns:
+            Peer dict (see peers()), or None if no suitable receiver was heard
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self._expire()
+                peer = choose_receiver(self.entries.values(), required_bytes, feature)
+                if peer:
+                    return dict(peer)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def update(self, beacon, address):
+        """
+        Record a beacon heard from `address`
+        """
+        with self.condition:
+            if beacon.get("leaving"):
+                self.entries.pop(beacon["id"], None)
+                return
+            peer = self.entries.get(beacon["id"])
+            if peer is None:
+                peer = self.entries[beacon["id"]] = {"id": beacon["id"], "host": address, "addresses": []}
+            if address not in peer["addresses"]:
+                peer["addresses"].append(address)
+            peer.update((key, value) for key, value in beacon.items() if key not in ("magic", "id"))
+            peer.setdefault("name", "")
+            peer["last_seen"] = time.monotonic()
+            self.condition.notify_all()
+
+    def _join_group(self):
+        membership = socket.inet_aton(self.group)
+        joined = False
+        for address in local_ipv4_addresses():
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership + socket.inet_aton(address))
+                joined = True
+            except OSError:
+                continue
+        if not joined:
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership + socket.inet_aton("0.0.0.0"))
+            except OSError:
+                pass  # No multicast here, broadcast beacons still arrive
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        for peer_id in [peer_id for peer_id, peer in self.entries.items() if peer["last_seen"] < cutoff]:
+            del self.entries[peer_id]
+
+    def _run(self):
+        while self.running:
+            try:
+                data, (address, _) = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            beacon = unpack_beacon(data)
+            if beacon:
+                self.update(beacon, address)
+
+def rank_receivers(peers, required_bytes=0, feature=None):
+    """
+    Order receivers from most to least suitable: receivers without enough free space
+    or lacking `feature` are dropped, the rest sorted by active transfers, then by
+    free space. Details a receiver does not announce are not held against it.
+
+    Args:
+        peers: Peer dicts (see PeerRegistry.peers) or discovery replies
+        required_bytes: Free disk space a receiver must have
+        feature: Protocol feature a receiver must support, or None
+
+    Returns:
+        List of the suitable peers, best first
+    """
+    suitable = []
+    for peer in peers:
+        free_bytes = peer.get("free_bytes")
+        if free_bytes is not None and free_bytes < required_bytes:
+            continue
+        if feature and "features" in peer and feature not in peer["features"]:
+            continue
+        suitable.append(peer)
+    return sorted(suitable, key=lambda peer: (peer.get("active_transfers") or 0, -(peer.get("free_bytes") or 0)))
+
+def choose_receiver(peers, required_bytes=0, feature=None):
+    """
+    Returns:
+        The most suitable receiver (see rank_receivers), or None
+    """
+    ranked = rank_receivers(peers, required_bytes, feature)
+    return ranked[0] if ranked else None
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+def get_peer_registry():
+    """
+    Returns:
+        The process-wide PeerRegistry, listening from first use. If the beacon port
+        can not be bound the registry simply stays empty.
+    """
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = PeerRegistry()
+            try:
+                _default_registry.start()
+            except OSError:
+                pass
+        return _default_registry
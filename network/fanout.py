@@ -0,0 +1,211 @@
+"""
+Fan-out - Sends files to many hosts at once over a bounded worker pool
+"""
+
+import mmap
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.hashing import create_hasher
+from network.sender import FileSender
+from network.protocol import TransferError, ProtocolError, STATUS_UNSUPPORTED
+
+# Transfers running at once, over all hosts
+DEFAULT_MAX_WORKERS = 8
+
+# Transfers running at once to any single host
+DEFAULT_PER_HOST_LIMIT = 2
+
+# Failed transfers are retried this many times, waiting DEFAULT_BACKOFF seconds before
+# the first retry and twice as long before each further one, up to MAX_BACKOFF
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+class SharedSource:
+    """
+    A file mapped into memory once and read by every outgoing stream, so it is
+    read from disk a single time however many hosts it goes to. Its digest is
+    computed once, from the same mapping.
+    """
+
+    def __init__(self, file_path, hash_algorithm, hash_cache=None, buffer_size=1024 * 1024):
+        """
+        Args:
+            file_path: File to share
+            hash_algorithm: Algorithm of the digest sent to every host
+            hash_cache: HashCache to take the digest from when the file is unchanged, or None
+            buffer_size: Amount of data hashed per step
+        """
+        self.file_path = file_path
+        self.file = open(file_path, "rb")
+        stat_result = os.fstat(self.file.fileno())
+        self.size = stat_result.st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.map) if self.map else memoryview(b"")
+
+        self.digest = hash_cache.lookup(file_path, hash_algorithm, stat_result) if hash_cache else None
+        if self.digest is None:
+            hasher = create_hasher(hash_algorithm)
+            for offset in range(0, self.size, buffer_size):
+                hasher.update(self.view[offset:offset + buffer_size])
+            self.digest = hasher.digest()
+            if hash_cache:
+                hash_cache.store(file_path, hash_algorithm, self.digest, stat_result)
+
+    def close(self):
+        self.view.release()
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+class FanOutSender:
+    """
+    Pushes a set of files to a set of hosts concurrently.
+
+    Every (file, host) pair is one transfer. At most `max_workers` transfers run
+    at once, and no more than `per_host_limit` of them go to the same host, so a
+    slow host can not take over the pool. Failed transfers are retried with
+    exponential backoff.
+    """
+
+    def __init__(self, sender=None, max_workers=DEFAULT_MAX_WORKERS, per_host_limit=DEFAULT_PER_HOST_LIMIT,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        """
+        Args:
+            sender: FileSender whose settings (hashing, compression, rate limits) every transfer uses
+            max_workers: Transfers running at once, over all hosts
+            per_host_limit: Transfers running at once to a single host
+            retries: Further attempts after a transfer fails
+            backoff: Seconds to wait before the first retry, doubled for each further one
+        """
+        self.sender = sender or FileSender()
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.backoff = backoff
+
+    def send(self, file_paths, hosts, port, status_callback=None, throttle=None):
+        """
+        Send every file to every host
+
+        Args:
+            file_paths: Files to send, each saved under its base name
+            hosts: Target host addresses
+            port: Target port number, the same on every host
+            status_callback: Function called with (host, message) as transfers start, finish or fail
+            throttle: Throttle from FileSender.create_throttle() shared by all transfers
+
+        Returns:
+            Dict with per-host results under 'hosts' (each a dict with 'sent', 'failed',
+            'bytes', 'attempts' and 'error'), and the aggregate 'bytes', 'seconds'
+            and 'throughput' in bytes per second
+        """
+
+        for file_path in file_paths:
+            if not os.path.isfile(file_path):
+                raise FileNotFoundError(f"File '{file_path}' does not exist.")
+
+        hosts = list(dict.fromkeys(hosts))
+        results = {host: {"sent": 0, "failed": [], "bytes": 0, "attempts": 0, "error": None} for host in hosts}
+        queues = {host: deque(file_paths) for host in hosts}
+        lock = threading.Lock()
+        sources_lock = threading.Lock()
+        remaining = [len(file_paths) * len(hosts)]
+        finished = threading.Event()
+        sources = {}
+        started = time.perf_counter()
+
+        def report(host, message):
+            if status_callback:
+                status_callback(host, message)
+
+        def source_for(file_path):
+            # Every host shares one mapping of each file, created by whichever transfer needs it first
+            with sources_lock:
+                if file_path not in sources:
+                    sources[file_path] = SharedSource(
+                        file_path, self.sender.hash_algorithm, self.sender.hash_cache, self.sender.buffer_size
+                    )
+                return sources[file_path]
+
+        def run(pool, host, file_path):
+            dest_filename = os.path.basename(file_path)
+            size = 0
+            attempts = 0
+            try:
+                source = source_for(file_path)
+                size = source.size
+                attempts, error = self._send_with_retries(source, host, port, dest_filename, throttle, report)
+            except Exception as e:
+                error = e  # The file could not be opened, so no attempt was made
+
+            with lock:
+                result = results[host]
+                result["attempts"] += attempts
+                if error is None:
+                    result["sent"] += 1
+                    result["bytes"] += size
+                else:
+                    result["failed"].append(dest_filename)
+                    result["error"] = str(error)
+
+                # Keep the host busy with its next file
+                if queues[host]:
+                    pool.submit(run, pool, host, queues[host].popleft())
+
+                remaining[0] -= 1
+                if not remaining[0]:
+                    finished.set()
+
+        try:
+            if remaining[0]:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                    with lock:
+                        for host in hosts:
+                            for _ in range(min(self.per_host_limit, len(queues[host]))):
+                                pool.submit(run, pool, host, queues[host].popleft())
+                    finished.wait()
+        finally:
+            for source in sources.values():
+                source.close()
+
+        seconds = time.perf_counter() - started
+        total = sum(result["bytes"] for result in results.values())
+        return {
+            "hosts": results,
+            "bytes": total,
+            "seconds": seconds,
+            "throughput": total / seconds if seconds else 0.0,
+        }
+
+    def _send_with_retries(self, source, host, port, dest_filename, throttle, report):
+        """
+        Send one file to one host, retrying failed attempts. Connection errors, rejected
+        transfers and garbled replies, which a dropped connection can cause, are retried;
+        a receiver that does not support the transfer, or any other error, ends it at once.
+
+        Returns:
+            Tuple of (number of attempts, exception of the last failed attempt or None)
+        """
+
+        delay = self.backoff
+        for attempt in range(1, self.retries + 2):
+            report(host, f"Sending '{dest_filename}'" + (f" (attempt {attempt})" if attempt > 1 else ""))
+            try:
+                self.sender.send_shared(source, host, port, dest_filename, throttle=throttle)
+                report(host, f"Sent '{dest_filename}'")
+                return attempt, None
+            except (OSError, TransferError, ProtocolError) as e:
+                report(host, f"Failed to send '{dest_filename}': {e}")
+                if isinstance(e, TransferError) and e.status == STATUS_UNSUPPORTED:
+                    return attempt, e
+                if attempt > self.retries:
+                    return attempt, e
+            except Exception as e:
+                report(host, f"Failed to send '{dest_filename}': {e}")
+                return attempt, e
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
@@ -0,0 +1,385 @@
+"""
+Protocol - Binary wire format shared by sender and receiver
+
+Every transfer starts with a fixed-size header followed by the UTF-8 encoded
+file name. The file contents follow as a sequence of frames, terminated by a
+zero-length frame, and a trailer carrying the digest. The receiver answers
+each transfer with an ack.
+
+    header   magic(4) version(1) kind(1) flags(2) hash(1) name_len(2) file_size(8)
+    frame    type(1) length(4), then `length` bytes of data
+    trailer  digest_len(1), then the raw digest
+    ack      magic(4) status(1)
+
+A KIND_RANGE transfer carries one byte range of a file sent over several
+parallel connections. Its name is followed by a range extension:
+
+    range    transfer_id(16) offset(8) length(8)
+
+The trailer of every range carries the digest of the whole file.
+
+A KIND_FILE header with FLAG_RESUME set is followed by the digest of the
+whole file (in trailer format). The receiver answers with the byte ranges it
+is still missing and the sender's payload carries only those ranges, back to
+back in file order:
+
+    ranges   count(4), then count x offset(8) length(8)
+
+Several transfers may follow each other on one connection. Transfers sent
+with FLAG_DEFER_ACK are not acknowledged individually; instead the sender
+sends a KIND_BATCH_ACK header (empty name, zero size) and the receiver
+answers with the statuses of every deferred transfer since the last one:
+
+    batch    magic(4) count(4), then count x status(1)
+
+A KIND_ARCHIVE transfer streams a tar archive of a directory tree. The name
+is the directory to unpack into, the size is the total size of the files it
+contains (for progress only), and the payload and digest cover the tar stream.
+
+A KIND_SYNC transfer updates a directory on the receiver to match one on the
+sender. The receiver first answers the header with its manifest as a blob
+(a payload of its own); the sender replies with a blob describing deletions
+and the hashes of the files it is about to send, followed by an archive
+payload of just those files and the trailer. FLAG_DELETE asks the receiver
+to remove files the sender does not have.
+
+A KIND_DELTA transfer updates a file the receiver already has. The receiver
+answers the header with the block signatures of its copy as a blob; the
+payload then mixes literal data frames with FRAME_COPY frames referencing
+runs of the receiver's blocks (see network.delta). The digest covers the
+rebuilt file.
+
+A KIND_FILE or KIND_ARCHIVE header with FLAG_COMPRESSED set is followed by a
+compression extension naming the codec (see network.compression):
+
+    compress codec(1) level(1)
+
+Frames of its payload are then either FRAME_DATA frames carrying raw data or
+FRAME_COMPRESSED frames each holding one independently compressed chunk.
+The digest always covers the uncompressed data.
+
+A KIND_FILE header with FLAG_RELAY set (and no other flag) asks the receiver
+to keep a copy and pass the file on down a chain of further receivers. The
+name is followed by the hops still to go:
+
+    relay    count(1), then count x host_len(1) host port(2)
+
+The receiver forwards the header (minus its own hop), every frame and the
+trailer to the next hop as they arrive, and verifies the digest itself. Its
+ack is followed by the statuses of every node from itself to the end of the
+chain, in batch ack format.
+
+A KIND_FILE header with FLAG_SPARSE set (alone or with FLAG_COMPRESSED) sends
+a file with holes. Its payload may then contain FRAME_HOLE frames standing
+for `length` zero bytes; no data follows them. The receiver leaves those
+ranges unallocated, and the digest covers the full contents, holes included.
+"""
+
+import struct
+from collections import namedtuple
+
+MAGIC = b"FSHR"
+VERSION = 1
+
+# Message kinds
+KIND_FILE = 1
+KIND_RANGE = 2
+KIND_BATCH_ACK = 3
+KIND_ARCHIVE = 4
+KIND_SYNC = 5
+KIND_DELTA = 6
+
+# Header flags
+FLAG_RESUME = 0x0001
+FLAG_DEFER_ACK = 0x0002
+FLAG_DELETE = 0x0004
+FLAG_COMPRESSED = 0x0008
+FLAG_RELAY = 0x0010
+FLAG_SPARSE = 0x0020
+
+# Frame types
+FRAME_DATA = 0
+FRAME_COPY = 1          # Delta transfers only: a run of the receiver's blocks
+FRAME_COMPRESSED = 2    # Compressed transfers only: one compressed chunk
+FRAME_HOLE = 3          # Sparse transfers only: `length` zero bytes, with no data following
+
+# Ack status codes
+STATUS_OK = 0
+STATUS_CHECKSUM_MISMATCH = 1
+STATUS_ERROR = 2
+STATUS_UNSUPPORTED = 3
+
+STATUS_MESSAGES = {
+    STATUS_OK: "OK",
+    STATUS_CHECKSUM_MISMATCH: "checksum mismatch",
+    STATUS_ERROR: "receiver error",
+    STATUS_UNSUPPORTED: "unsupported by receiver",
+}
+
+# Hash algorithm identifiers used on the wire
+HASH_IDS = {"sha256": 1, "blake2b": 2, "blake2s": 3, "sha512": 4}
+HASH_NAMES = {hash_id: name for name, hash_id in HASH_IDS.items()}
+
+HEADER = struct.Struct("!4sBBHBHQ")
+FRAME = struct.Struct("!BI")
+TRAILER = struct.Struct("!B")
+ACK = struct.Struct("!4sB")
+BATCH_ACK = struct.Struct("!4sI")
+RANGE = struct.Struct("!16sQQ")
+RANGE_COUNT = struct.Struct("!I")
+RANGE_ENTRY = struct.Struct("!QQ")
+COMPRESSION = struct.Struct("!BB")
+RELAY_COUNT = struct.Struct("!B")
+RELAY_HOST = struct.Struct("!B")
+RELAY_PORT = struct.Struct("!H")
+
+FileHeader = namedtuple("FileHeader", "kind flags hash_algorithm filename file_size")
+
+class ProtocolError(Exception):
+    """Raised when the peer sends data that does not follow the wire format"""
+
+class TransferError(Exception):
+    """Raised by the sender when the receiver rejects a transfer"""
+
+    def __init__(self, status):
+        super().__init__(f"Transfer failed: {STATUS_MESSAGES.get(status, f'status {status}')}")
+        self.status = status
+
+def read_exact(reader, size):
+    """
+    Read exactly `size` bytes from a buffered reader
+
+    Raises:
+        ConnectionError: If the peer closes the connection first
+    """
+    data = reader.read(size)
+    if len(data) != size:
+        raise ConnectionError("Connection closed mid-transfer")
+    return data
+
+def read_into(reader, view):
+    """
+    Fill the whole of `view` from a buffered reader
+
+    Raises:
+        ConnectionError: If the peer closes the connection first
+    """
+    filled = 0
+    while filled < len(view):
+        length = reader.readinto(view[filled:])
+        if not length:
+            raise ConnectionError("Connection closed mid-transfer")
+        filled += length
+
+def pack_header(filename, file_size, hash_algorithm, kind=KIND_FILE, flags=0):
+    """
+    Build the header and file name that open a transfer
+
+    Returns:
+        Bytes ready to be sent
+    """
+    name = filename.encode()
+    return HEADER.pack(MAGIC, VERSION, kind, flags, HASH_IDS[hash_algorithm], len(name), file_size) + name
+
+def unpack_header(data):
+    """
+    Decode and validate the fixed-size part of a header
+
+    Returns:
+        Tuple of (kind, flags, hash_algorithm, name_length, file_size)
+    """
+    magic, version, kind, flags, hash_id, name_length, file_size = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Not a file transfer connection")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if hash_id not in HASH_NAMES:
+        raise ProtocolError(f"Unknown hash algorithm id {hash_id}")
+    return kind, flags, HASH_NAMES[hash_id], name_length, file_size
+
+def read_header(reader):
+    """
+    Read a transfer header
+
+    Returns:
+        FileHeader, or None if the peer closed the connection cleanly before sending one
+    """
+    data = reader.read(HEADER.size)
+    if not data:
+        return None
+    if len(data) != HEADER.size:
+        raise ConnectionError("Connection closed mid-header")
+
+    kind, flags, hash_algorithm, name_length, file_size = unpack_header(data)
+    filename = read_exact(reader, name_length).decode()
+    return FileHeader(kind, flags, hash_algorithm, filename, file_size)
+
+def pack_range(transfer_id, offset, length):
+    """Build the range extension that follows the name of a KIND_RANGE header"""
+    return RANGE.pack(transfer_id, offset, length)
+
+def read_range(reader):
+    """
+    Read the range extension of a KIND_RANGE header
+
+    Returns:
+        Tuple of (transfer_id, offset, length)
+    """
+    return RANGE.unpack(read_exact(reader, RANGE.size))
+
+def pack_missing_ranges(ranges):
+    """Build the receiver's list of (offset, length) ranges it still needs"""
+    return RANGE_COUNT.pack(len(ranges)) + b"".join(RANGE_ENTRY.pack(offset, length) for offset, length in ranges)
+
+def read_missing_ranges(reader):
+    """
+    Read the receiver's list of ranges it still needs
+
+    Returns:
+        List of (offset, length) tuples
+    """
+    (count,) = RANGE_COUNT.unpack(read_exact(reader, RANGE_COUNT.size))
+    data = read_exact(reader, count * RANGE_ENTRY.size)
+    return list(RANGE_ENTRY.iter_unpack(data))
+
+def pack_compression(codec_id, level):
+    """Build the compression extension that follows the name of a FLAG_COMPRESSED header"""
+    return COMPRESSION.pack(codec_id, level)
+
+def read_compression(reader):
+    """
+    Read the compression extension of a FLAG_COMPRESSED header
+
+    Returns:
+        Tuple of (codec_id, level)
+    """
+    return COMPRESSION.unpack(read_exact(reader, COMPRESSION.size))
+
+def pack_relay_hops(hops):
+    """Build the relay extension that follows the name of a FLAG_RELAY header"""
+    data = bytearray(RELAY_COUNT.pack(len(hops)))
+    for host, port in hops:
+        name = host.encode()
+        data += RELAY_HOST.pack(len(name)) + name + RELAY_PORT.pack(port)
+    return bytes(data)
+
+def read_relay_hops(reader):
+    """
+    Read the relay extension of a FLAG_RELAY header
+
+    Returns:
+        List of (host, port) tuples, next hop first
+    """
+    (count,) = RELAY_COUNT.unpack(read_exact(reader, RELAY_COUNT.size))
+    hops = []
+    for _ in range(count):
+        (length,) = RELAY_HOST.unpack(read_exact(reader, RELAY_HOST.size))
+        host = read_exact(reader, length).decode()
+        (port,) = RELAY_PORT.unpack(read_exact(reader, RELAY_PORT.size))
+        hops.append((host, port))
+    return hops
+
+def pack_frame_header(length, frame_type=FRAME_DATA):
+    """Build the header of a payload frame, a zero length marks the end of the payload"""
+    return FRAME.pack(frame_type, length)
+
+def read_payload(reader, buffer, decompress=None, on_hole=None):
+    """
+    Iterate over the payload frames of a transfer
+
+    Args:
+        reader: Buffered reader positioned at the first frame
+        buffer: Reusable bytearray that received data is read into
+        decompress: Function unpacking FRAME_COMPRESSED frames, or None if the
+            transfer is not compressed
+        on_hole: Function called with the length of each FRAME_HOLE frame, in payload
+            order with the data, or None if the transfer is not sparse
+
+    Yields:
+        memoryview slices of `buffer` (or of an unpacked frame), valid until the next iteration
+    """
+    view = memoryview(buffer)
+    while True:
+        frame_type, length = FRAME.unpack(read_exact(reader, FRAME.size))
+        if frame_type == FRAME_COMPRESSED and decompress and length:
+            yield memoryview(decompress(read_exact(reader, length)))
+            continue
+        if frame_type == FRAME_HOLE and on_hole and length:
+            on_hole(length)
+            continue
+        if frame_type != FRAME_DATA:
+            raise ProtocolError(f"Unexpected frame type {frame_type}")
+        if not length:
+            return
+        while length:
+            chunk = view[:min(length, len(buffer))]
+            read_into(reader, chunk)
+            length -= len(chunk)
+            yield chunk
+
+def pack_blob(data):
+    """Build a complete payload (frame and end marker) carrying a small in-memory value"""
+    return pack_frame_header(len(data)) + data + pack_frame_header(0)
+
+def read_blob(reader, limit=256 * 1024 * 1024):
+    """
+    Read a complete payload into memory
+
+    Args:
+        limit: Largest accepted payload size in bytes
+    """
+    data = bytearray()
+    while True:
+        frame_type, length = FRAME.unpack(read_exact(reader, FRAME.size))
+        if frame_type != FRAME_DATA:
+            raise ProtocolError(f"Unexpected frame type {frame_type}")
+        if not length:
+            return bytes(data)
+        if len(data) + length > limit:
+            raise ProtocolError("Payload too large")
+        data += read_exact(reader, length)
+
+def pack_trailer(digest):
+    """Build the trailer carrying the raw digest of the payload"""
+    return TRAILER.pack(len(digest)) + digest
+
+def read_trailer(reader):
+    """Read the trailer and return the raw digest"""
+    (length,) = TRAILER.unpack(read_exact(reader, TRAILER.size))
+    return read_exact(reader, length)
+
+# The digest announced up front by resumable transfers uses the trailer layout
+pack_digest = pack_trailer
+read_digest = read_trailer
+
+def pack_ack(status):
+    """Build the receiver's answer to a transfer"""
+    return ACK.pack(MAGIC, status)
+
+def read_ack(reader):
+    """
+    Read the receiver's answer to a transfer
+
+    Returns:
+        Status code (one of the STATUS_* constants)
+    """
+    magic, status = ACK.unpack(read_exact(reader, ACK.size))
+    if magic != MAGIC:
+        raise ProtocolError("Invalid acknowledgement from receiver")
+    return status
+
+def pack_batch_ack(statuses):
+    """Build the receiver's answer to a KIND_BATCH_ACK request"""
+    return BATCH_ACK.pack(MAGIC, len(statuses)) + bytes(statuses)
+
+def read_batch_ack(reader):
+    """
+    Read the receiver's answer to a KIND_BATCH_ACK request
+
+    Returns:
+        List of status codes, one per deferred transfer, in sending order
+    """
+    magic, count = BATCH_ACK.unpack(read_exact(reader, BATCH_ACK.size))
+    if magic != MAGIC:
+        raise ProtocolError("Invalid acknowledgement from receiver")
+    return list(read_exact(reader, count))
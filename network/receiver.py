@@ -5,17 +5,94 @@ File Receiver - Handles receiving files over network
 import socket
 import threading
 import os
-import hashlib
-from utils.helpers import get_local_ip
+import json
+import shutil
+import weakref
+from utils.helpers import get_local_ip, safe_filename
+from utils.hashing import create_hasher, hash_file, update_with_zeros
+from utils.progress import get_progress_bus
+from utils.stats import get_stats, NULL_TRANSFER
+from network.protocol import (
+    read_header, read_range, read_digest, read_payload, read_trailer, read_compression, read_relay_hops, read_ack,
+    read_batch_ack, pack_header, pack_relay_hops, pack_frame_header, pack_trailer, pack_ack, pack_batch_ack,
+    pack_missing_ranges, pack_blob, read_blob, KIND_FILE, KIND_RANGE, KIND_BATCH_ACK, KIND_ARCHIVE,
+    KIND_SYNC, KIND_DELTA, FLAG_RESUME, FLAG_DEFER_ACK, FLAG_DELETE, FLAG_COMPRESSED, FLAG_RELAY, FLAG_SPARSE,
+    STATUS_OK, STATUS_CHECKSUM_MISMATCH, STATUS_ERROR, STATUS_UNSUPPORTED, STATUS_MESSAGES, ProtocolError
+)
+from network.resume import PartialFile
+from network.discovery import Announcer
+from network.writer import (
+    WriteBehindFile, create_temp_file, sync_directory, sync_filesystem, FSYNC_NEVER, FSYNC_COMMIT, FSYNC_ALWAYS, FSYNC_POLICIES
+)
+from network.throttle import TokenBucket, Throttle, ThrottledReader
+from network.tuning import PROFILES, get_socket_profile
+from network.compression import CODEC_NAMES, available_codecs, chunk_decompressor
+from network.archive import FrameReader, extract_archive
+from network.delta import compute_signatures, pack_signatures, apply_delta
+from network.sync import build_manifest, encode_manifest, decode_manifest, load_index, save_index, delete_files
 
-def calculate_sha256(file_path):
-    sha256 = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+# Size of the socket read buffer and of the reusable payload buffer
+READ_BUFFER_SIZE = 256 * 1024
+
+# Largest accepted size of one decompressed payload frame
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Features announced in discovery replies, so senders can tell what this receiver supports
+FEATURES = ["batch_ack", "resume", "parallel", "archive", "sync", "delta", "compression", "relay", "sparse"]
+
+# Seconds to wait when connecting to the next hop of a relay chain
+RELAY_CONNECT_TIMEOUT = 10
+
+# Resumable transfers flush to disk and record their progress after this many bytes
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+
+class ParallelTransfer:
+    """
+    State of a file arriving as byte ranges over several connections. The ranges
+    are written into a preallocated temporary file next to the target, which is
+    only renamed into place once the whole file is verified.
+    """
+
+    def __init__(self, save_path, file_size, tracker):
+        self.save_path = save_path
+        self.file_size = file_size
+        self.tracker = tracker  # Progress of the whole file, shared by its ranges
+        file, self.temp_path = create_temp_file(save_path, file_size)
+        file.close()
+        self.ranges = {}        # offset -> length of every range fully written
+        self.connections = 0    # Range connections currently in progress
+        self.error = None       # Why the file can not be completed, once a range failed
+        self.committed = False
+
+    @property
+    def received(self):
+        return sum(self.ranges.values())
+
+    def commit(self, fsync_policy):
+        """
+        Move the verified file to its real name, replacing any file there
+
+        Raises:
+            OSError: If syncing or renaming fails
+        """
+        if fsync_policy != FSYNC_NEVER:
+            with open(self.temp_path, "r+b") as file:
+                os.fsync(file.fileno())
+        os.replace(self.temp_path, self.save_path)
+        self.committed = True
+        if fsync_policy == FSYNC_ALWAYS:
+            sync_directory(self.save_path)
+
+    def discard(self):
+        """Remove the temporary file. Does nothing once the file is committed."""
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
 
 class FileReceiver:
+    FEATURES = FEATURES
+
     def __init__(self):
         self.server_socket = None
         self.is_receiving = False
@@ -23,6 +100,19 @@ class FileReceiver:
         self.ui_callback = None   # Ensure attribute always exists
         self.udp_discovery_thread = None
         self.udp_discovery_running = False
+        self.announcer = None
+        self.save_dir = None
+        self.active_transfers = 0                   # Connections currently being served
+        self.active_lock = threading.Lock()
+        self.parallel_transfers = {}  # transfer_id -> ParallelTransfer
+        self.parallel_lock = threading.Lock()
+        self.rate_limiter = TokenBucket()           # Caps all connections together
+        self.transfer_rate_limit = None             # Caps each connection, in bytes per second
+        self.throttles = weakref.WeakSet()          # Throttles of connections being served
+        self.fsync_policy = FSYNC_COMMIT            # When received files are forced to disk
+        self.progress_bus = get_progress_bus()      # Where the progress of received files is published
+        self.stats = get_stats()                    # Per-stage timing, while enabled
+        self.socket_profile = PROFILES["default"]   # Buffers, timeouts and keepalive of connections
 
     def start_receiving(self, port, save_dir, log_callback=None, ui_callback=None):
         """
@@ -46,7 +136,7 @@ class FileReceiver:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind(("0.0.0.0", port))
-        self.server_socket.listen()
+        self.socket_profile.listen(self.server_socket)
 
         self.is_receiving = True
 
@@ -65,16 +155,25 @@ class FileReceiver:
         self.udp_discovery_thread = threading.Thread(target=self._udp_discovery_responder, args=(port,), daemon=True)
         self.udp_discovery_thread.start()
 
+        # Announce ourselves so senders can find us without asking
+        self.announcer = Announcer(port, info_callback=self.status)
+        self.announcer.start()
+
     def stop_receiving(self):
         """
         Stop the file receiver server
         """
 
+        self.is_receiving = False
+
         if self.server_socket:
+            # Closing alone does not wake a thread blocked in accept(), which would take one more connection
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.server_socket.close()
             self.server_socket = None
-        
-        self.is_receiving = False
 
         if self.log_callback:
             self.log_callback("Server stopped")
@@ -84,8 +183,84 @@ class FileReceiver:
         
         # Stop UDP discovery responder
         self.udp_discovery_running = False
+
+        if self.announcer:
+            self.announcer.stop()
+            self.announcer = None
         
 
+    def status(self):
+        """
+        Describe this receiver for discovery replies and beacons
+
+        Returns:
+            Dict with the TCP 'port', 'free_bytes' in the save directory, the number of
+            'active_transfers', the supported protocol 'features' and available 'codecs'
+        """
+
+        try:
+            free_bytes = shutil.disk_usage(self.save_dir).free if self.save_dir else None
+        except OSError:
+            free_bytes = None
+        return {
+            "port": self.server_socket.getsockname()[1] if self.server_socket else None,
+            "free_bytes": free_bytes,
+            "active_transfers": self.active_transfers,
+            "features": self.FEATURES,
+            "codecs": available_codecs(),
+        }
+
+    def _transfer_started(self):
+        with self.active_lock:
+            self.active_transfers += 1
+
+    def _transfer_finished(self):
+        with self.active_lock:
+            self.active_transfers -= 1
+
+    def set_fsync_policy(self, policy):
+        """
+        Choose when received files are forced to disk
+        Args:
+            policy: One of the FSYNC_* constants of network.writer
+        """
+
+        if policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {policy}")
+        self.fsync_policy = policy
+
+    def set_socket_profile(self, profile):
+        """
+        Choose the socket options of connections accepted from now on.
+        The listen backlog and inherited buffer sizes change on the next start_receiving().
+        Args:
+            profile: Name of one of the network.tuning PROFILES, or a SocketProfile
+        """
+
+        self.socket_profile = get_socket_profile(profile)
+
+    def set_rate_limit(self, rate):
+        """
+        Cap the combined receiving rate of all connections, taking effect immediately
+
+        Args:
+            rate: Bytes per second, or None for no limit
+        """
+
+        self.rate_limiter.set_rate(rate)
+
+    def set_transfer_rate_limit(self, rate):
+        """
+        Cap the receiving rate of each connection, including those already being served
+
+        Args:
+            rate: Bytes per second, or None for no limit
+        """
+
+        self.transfer_rate_limit = rate
+        for throttle in list(self.throttles):
+            throttle.set_rate(rate)
+
     def _receive_files_thread(self):
         """
         Thread to handle incoming file transfers
@@ -96,6 +271,11 @@ class FileReceiver:
                 client, addr = self.server_socket.accept()
                 if self.log_callback:
                     self.log_callback(f"Connection from {addr[0]}:{addr[1]}")
+                try:
+                    self.socket_profile.apply(client, addr[0])
+                except OSError:
+                    client.close()  # Gone before it could be served
+                    continue
 
                 # Handle client connection in a separate thread
                 threading.Thread(target=self._handle_client, args=(client,), daemon=True).start()
@@ -113,71 +293,683 @@ class FileReceiver:
             client: Connected client socket
         """
 
+        self._transfer_started()
+
+        # Reads are paced by the rate limits, TCP flow control then slows the sender down
+        throttle = Throttle(self.rate_limiter, self.transfer_rate_limit)
+        self.throttles.add(throttle)
+        reader = ThrottledReader(client.makefile("rb", buffering=READ_BUFFER_SIZE), throttle)
+        deferred = []  # Statuses of transfers sent with FLAG_DEFER_ACK, not yet reported
+
         try:
-            # Receive filenamd and filesize
-            filename = self._recv_line(client)
-            filesize = int(self._recv_line(client))
+            # A connection may carry any number of transfers back to back
+            while True:
+                header = read_header(reader)
+                if header is None:
+                    break
+
+                if header.kind == KIND_BATCH_ACK:
+                    client.sendall(self._batch_ack(deferred))
+                    deferred.clear()
+                    continue
+
+                chain = None  # Statuses down a relay chain, sent after the ack
+                flags = header.flags & ~FLAG_DEFER_ACK
+                # Ranges are timed on their own, once their length is known
+                timing = self.stats.transfer(header.filename, "receive", header.file_size) \
+                    if header.kind != KIND_RANGE else NULL_TRANSFER
+                with timing:
+                    if header.kind == KIND_FILE and header.flags == FLAG_RELAY:
+                        status, chain = self._receive_relay(reader, header)
+                    elif header.kind == KIND_FILE and flags == FLAG_RESUME:
+                        status = self._receive_resumable(client, reader, header)
+                    elif header.kind == KIND_SYNC and not flags & ~FLAG_DELETE:
+                        status = self._receive_sync(client, reader, header)
+                    elif flags == FLAG_COMPRESSED and header.kind in (KIND_FILE, KIND_ARCHIVE) or \
+                            flags == FLAG_COMPRESSED | FLAG_SPARSE and header.kind == KIND_FILE:
+                        decompress = self._read_compression(reader)
+                        if decompress is None:
+                            status = STATUS_UNSUPPORTED
+                        elif header.kind == KIND_FILE:
+                            status = self._receive_file(reader, header, decompress, timing)
+                        else:
+                            status = self._receive_archive(reader, header, decompress)
+                    elif header.kind == KIND_FILE and flags == FLAG_SPARSE:
+                        status = self._receive_file(reader, header, timing=timing)
+                    elif flags:
+                        status = STATUS_UNSUPPORTED
+                    elif header.kind == KIND_FILE:
+                        status = self._receive_file(reader, header, timing=timing)
+                    elif header.kind == KIND_RANGE:
+                        status = self._receive_range(reader, header)
+                    elif header.kind == KIND_ARCHIVE:
+                        status = self._receive_archive(reader, header)
+                    elif header.kind == KIND_DELTA:
+                        status = self._receive_delta(client, reader, header)
+                    else:
+                        status = STATUS_UNSUPPORTED
+                    if status != STATUS_OK:
+                        timing.fail(STATUS_MESSAGES.get(status, f"status {status}"))
 
+                if header.flags & FLAG_DEFER_ACK:
+                    deferred.append(status)
+                else:
+                    client.sendall(pack_ack(status) + (pack_batch_ack(chain) if chain is not None else b""))
+
+                if status in (STATUS_ERROR, STATUS_UNSUPPORTED):
+                    # The payload may not have been consumed, so the stream can not be followed any further
+                    if deferred:
+                        client.sendall(self._batch_ack(deferred))
+                    break
+        
+        except Exception as e:
             if self.log_callback:
-                self.log_callback(f"Receiving file '{filename}' ({filesize} bytes)")
-
-            # Create full path
-            save_path = os.path.join(self.save_dir, filename)
-
-            # Receive file data
-            with open(save_path, "wb") as file:
-                received = 0
-                while received < filesize:
-                    data = client.recv(1024)
-                    if not data:
-                        break
-                    file.write(data)
-                    received += len(data)
-
-                    # Update progress if UI callback is provided
-                    if self.log_callback:
-                        progress = (received / filesize) * 100
-                        if received == filesize or progress % 25 == 0:  # Log at 25% intervals
-                            self.log_callback(f"Progress for {filename}: {progress:.1f}%")
-            
+                self.log_callback(f"Error receiving file: {str(e)}")
+
+        finally:
+            reader.close()
+            client.close()
+            self._transfer_finished()
+
+    def _file_fsync_policy(self, header):
+        """
+        Returns:
+            Fsync policy for a file: under FSYNC_COMMIT, files whose ack is deferred are
+            committed without a sync of their own, see _batch_ack()
+        """
+
+        if self.fsync_policy == FSYNC_COMMIT and header.flags & FLAG_DEFER_ACK:
+            return FSYNC_NEVER
+        return self.fsync_policy
+
+    def _batch_ack(self, deferred):
+        """
+        Sync the files of a batch to disk with one call, then pack their batch ack
+        Args:
+            deferred: Statuses of the transfers sent with FLAG_DEFER_ACK since the last batch ack
+        """
+
+        if deferred and self.fsync_policy == FSYNC_COMMIT:
+            sync_filesystem()
+        return pack_batch_ack(deferred)
+
+    def _read_compression(self, reader):
+        """
+        Read the compression extension of a header
+        Args:
+            reader: Buffered reader positioned after the file name
+        Returns:
+            Function unpacking compressed frames, or None if the codec is not available here
+        """
+
+        codec_id, level = read_compression(reader)
+        codec = CODEC_NAMES.get(codec_id)
+        if codec not in available_codecs():
+            if self.log_callback:
+                self.log_callback(f"Rejected transfer compressed with unsupported codec {codec or codec_id}")
+            return None
+        return chunk_decompressor(codec, MAX_FRAME_SIZE)
+
+    def _receive_file(self, reader, header, decompress=None, timing=NULL_TRANSFER):
+        """
+        Receive the payload and trailer of a single file
+        Args:
+            reader: Buffered reader positioned after the header
+            header: FileHeader announced by the sender
+            decompress: Function unpacking compressed frames, if the sender compresses
+            timing: utils.stats Transfer to time the receive, write, hash and commit stages on
+        Returns:
+            Ack status code for the sender
+        """
+
+        filename = safe_filename(header.filename)
+        filesize = header.file_size
+        hasher = create_hasher(header.hash_algorithm)
+
+        if self.log_callback:
+            self.log_callback(f"Receiving file '{filename}' ({filesize} bytes)")
+
+        # Create full path
+        save_path = os.path.join(self.save_dir, filename)
+
+        # Receive file data into a temporary file, only given the real name once verified
+        sparse = bool(header.flags & FLAG_SPARSE)
+        with WriteBehindFile(save_path, filesize, self._file_fsync_policy(header), sparse=sparse) as file, \
+                self.progress_bus.track(filename, filesize, "receive") as tracker:
+            received = 0
+
+            def on_hole(length):
+                # Holes stay unallocated, but are hashed as the zeros they read as
+                nonlocal received
+                file.skip(length)
+                update_with_zeros(hasher, length)
+                self._log_progress(filename, received, received + length, filesize)
+                received += length
+                tracker.advance(length)
+
+            # Decompression happens inside read_payload and is part of the receive stage
+            t = timing.clock()
+            for data in read_payload(reader, bytearray(READ_BUFFER_SIZE), decompress, on_hole if sparse else None):
+                t = timing.record("receive", t, len(data))
+                file.write(data)
+                t = timing.record("write", t, len(data))
+                hasher.update(data)
+                t = timing.record("hash", t, len(data))
+                self._log_progress(filename, received, received + len(data), filesize)
+                received += len(data)
+                tracker.advance(len(data))
+
             # Receive checksum
-            received_checksum = self._recv_line(client)
-            local_checksum = calculate_sha256(save_path)
-            if received_checksum == local_checksum:
+            received_checksum = read_trailer(reader)
+            local_checksum = hasher.digest()
+            if received != filesize or received_checksum != local_checksum:
                 if self.log_callback:
-                    self.log_callback(f"Checksum OK for '{filename}'")
+                    self.log_callback(f"Checksum mismatch for '{filename}'!\nExpected: {received_checksum.hex()}\nGot: {local_checksum.hex()}")
+                tracker.fail("checksum mismatch")
+                return STATUS_CHECKSUM_MISMATCH
+            t = timing.clock()
+            file.commit()
+            timing.record("commit", t)
+
+        if self.log_callback:
+            self.log_callback(f"Checksum OK for '{filename}'")
+            self.log_callback(f"File '{filename}' received successfully")
+        return STATUS_OK
+
+    def _log_progress(self, filename, before, after, total):
+        """
+        Log progress each time a transfer crosses a quarter of its size
+        Args:
+            before: Bytes received before the latest chunk
+            after: Bytes received including it
+        """
+
+        if self.log_callback and total and after * 4 // total > before * 4 // total:
+            self.log_callback(f"Progress for {filename}: {after * 100 / total:.1f}%")
+
+    def _receive_relay(self, reader, header):
+        """
+        Receive a file while passing it on to the next hop of a relay chain. Every frame is
+        forwarded as soon as it arrives, so all nodes of the chain receive at the same time.
+        A failing downstream hop does not stop the local copy from being completed.
+        Args:
+            reader: Buffered reader positioned after the header
+            header: FileHeader announced by the sender
+        Returns:
+            Tuple of (ack status for the sender, statuses of this node and every node after it)
+        """
+
+        hops = read_relay_hops(reader)
+        filename = safe_filename(header.filename)
+        filesize = header.file_size
+        hasher = create_hasher(header.hash_algorithm)
+
+        if self.log_callback:
+            self.log_callback(f"Receiving file '{filename}' ({filesize} bytes), relaying to {len(hops)} more receiver(s)")
+
+        downstream = self._open_relay(header, hops) if hops else None
+
+        def forward(data):
+            nonlocal downstream
+            if not downstream:
+                return
+            try:
+                downstream.sendall(data)
+            except OSError as e:
+                if self.log_callback:
+                    self.log_callback(f"Relay to {hops[0][0]}:{hops[0][1]} failed: {e}")
+                downstream.close()
+                downstream = None
+
+        save_path = os.path.join(self.save_dir, filename)
+        with WriteBehindFile(save_path, filesize, self.fsync_policy) as file, \
+                self.progress_bus.track(filename, filesize, "receive") as tracker:
+            received = 0
+            for data in read_payload(reader, bytearray(READ_BUFFER_SIZE)):
+                forward(pack_frame_header(len(data)))
+                forward(data)
+                file.write(data)
+                hasher.update(data)
+                self._log_progress(filename, received, received + len(data), filesize)
+                received += len(data)
+                tracker.advance(len(data))
+
+            received_checksum = read_trailer(reader)
+            forward(pack_frame_header(0) + pack_trailer(received_checksum))
+
+            local_checksum = hasher.digest()
+            if received != filesize or received_checksum != local_checksum:
+                if self.log_callback:
+                    self.log_callback(f"Checksum mismatch for '{filename}'!\nExpected: {received_checksum.hex()}\nGot: {local_checksum.hex()}")
+                tracker.fail("checksum mismatch")
+                status = STATUS_CHECKSUM_MISMATCH
             else:
+                file.commit()
                 if self.log_callback:
-                    self.log_callback(f"Checksum mismatch for '{filename}'!\nExpected: {received_checksum}\nGot: {local_checksum}")
+                    self.log_callback(f"Checksum OK for '{filename}'")
+                    self.log_callback(f"File '{filename}' received successfully")
+                status = STATUS_OK
 
+        # Wait for the rest of the chain to report
+        downstream_statuses = [STATUS_ERROR] * len(hops)
+        if downstream:
+            try:
+                with downstream, downstream.makefile("rb") as downstream_reader:
+                    read_ack(downstream_reader)
+                    downstream_statuses = read_batch_ack(downstream_reader)
+            except (OSError, ProtocolError) as e:
+                if self.log_callback:
+                    self.log_callback(f"No result from {hops[0][0]}:{hops[0][1]}: {e}")
+
+        chain = [status] + downstream_statuses
+        return status, chain
+
+    def _open_relay(self, header, hops):
+        """
+        Connect to the next hop of a relay chain and send it the header
+        Returns:
+            Connected socket, or None if the next hop can not be reached
+        """
+
+        host, port = hops[0]
+        try:
+            downstream = self.socket_profile.connect(host, port, RELAY_CONNECT_TIMEOUT)
+            data = pack_header(header.filename, header.file_size, header.hash_algorithm, flags=FLAG_RELAY)
+            downstream.sendall(data + pack_relay_hops(hops[1:]))
+            return downstream
+        except OSError as e:
             if self.log_callback:
-                self.log_callback(f"File '{filename}' received successfully")
-        
-        except Exception as e:
-            if self.log_callback:
-                self.log_callback(f"Error receiving file: {str(e)}")
+                self.log_callback(f"Could not relay to {host}:{port}: {e}")
+            return None
+
+    def _receive_archive(self, reader, header, decompress=None):
+        """
+        Unpack a streamed directory archive into the save directory as it arrives
+        Args:
+            reader: Buffered reader positioned after the header
+            header: FileHeader announced by the sender
+            decompress: Function unpacking compressed frames, if the sender compresses
+        Returns:
+            Ack status code for the sender
+        """
+
+        dirname = safe_filename(header.filename)
+        hasher = create_hasher(header.hash_algorithm)
+
+        if self.log_callback:
+            self.log_callback(f"Receiving folder '{dirname}' ({header.file_size} bytes)")
+
+        with self.progress_bus.track(dirname, header.file_size, "receive") as tracker:
+            frame_reader = FrameReader(reader, hasher, decompress=decompress, on_read=tracker.advance)
+            staged = extract_archive(frame_reader, os.path.join(self.save_dir, dirname), self.log_callback, self.fsync_policy)
+            try:
+                received_checksum = read_trailer(reader)
+                local_checksum = hasher.digest()
+                if received_checksum != local_checksum:
+                    if self.log_callback:
+                        self.log_callback(f"Checksum mismatch for '{dirname}'!\nExpected: {received_checksum.hex()}\nGot: {local_checksum.hex()}")
+                    tracker.fail("checksum mismatch")
+                    return STATUS_CHECKSUM_MISMATCH
+                staged.commit()
+            finally:
+                staged.discard()
+
+        if self.log_callback:
+            self.log_callback(f"Checksum OK for '{dirname}'")
+            self.log_callback(f"Folder '{dirname}' received successfully ({staged.count} files)")
+        return STATUS_OK
+
+    def _receive_delta(self, client, reader, header):
+        """
+        Rebuild a file from the local copy and a delta: send the block signatures of the
+        local copy, assemble the new version in a temp file and rename it into place
+        Args:
+            client: Connected client socket, used to send the signatures
+            reader: Buffered reader positioned after the header
+            header: FileHeader announced by the sender
+        Returns:
+            Ack status code for the sender
+        """
+
+        filename = safe_filename(header.filename)
+        save_path = os.path.join(self.save_dir, filename)
+
+        basis_size = os.path.getsize(save_path) if os.path.isfile(save_path) else 0
+        block_size, signatures = compute_signatures(save_path, basis_size) if basis_size else (0, [])
+        client.sendall(pack_blob(pack_signatures(block_size, basis_size, signatures)))
+
+        if self.log_callback:
+            self.log_callback(f"Receiving delta for '{filename}' ({header.file_size} bytes, {len(signatures)} blocks known)")
+
+        hasher = create_hasher(header.hash_algorithm)
+        with self.progress_bus.track(filename, header.file_size, "receive") as tracker, \
+                WriteBehindFile(save_path, header.file_size, self._file_fsync_policy(header)) as target:
+            with open(save_path if basis_size else os.devnull, "rb") as basis:
+                written, literal = apply_delta(reader, basis, target, block_size, hasher, bytearray(READ_BUFFER_SIZE),
+                                               tracker.advance)
+
+            received_checksum = read_trailer(reader)
+            local_checksum = hasher.digest()
+            if written != header.file_size or received_checksum != local_checksum:
+                if self.log_callback:
+                    self.log_callback(f"Checksum mismatch for '{filename}'!\nExpected: {received_checksum.hex()}\nGot: {local_checksum.hex()}")
+                tracker.fail("checksum mismatch")
+                return STATUS_CHECKSUM_MISMATCH
+
+            target.commit()
+
+        if self.log_callback:
+            self.log_callback(f"Checksum OK for '{filename}'")
+            self.log_callback(f"File '{filename}' received successfully ({literal} of {written} bytes sent as new data)")
+        return STATUS_OK
+
+    def _receive_sync(self, client, reader, header):
+        """
+        Update a directory to match the sender's: answer with the manifest of what is
+        here, then apply the deletions and unpack the changed files the sender streams
+        Args:
+            client: Connected client socket, used to send the manifest
+            reader: Buffered reader positioned after the header
+            header: FileHeader announced by the sender
+        Returns:
+            Ack status code for the sender
+        """
+
+        dirname = safe_filename(header.filename)
+        root = os.path.join(self.save_dir, dirname)
+        algorithm = header.hash_algorithm
+        os.makedirs(root, exist_ok=True)
+
+        # The saved index spares rehashing files that have not changed since the last sync
+        manifest = build_manifest(root, algorithm, load_index(root, algorithm))
+        client.sendall(pack_blob(encode_manifest(manifest)))
+
+        plan = decode_manifest(read_blob(reader))
+        deleted = 0
+        if header.flags & FLAG_DELETE:
+            deleted = delete_files(root, plan["delete"])
+            for path in plan["delete"]:
+                manifest.pop(path, None)
+
+        if self.log_callback:
+            self.log_callback(f"Syncing folder '{dirname}': {len(plan['files'])} changed, {deleted} deleted")
+
+        hasher = create_hasher(algorithm)
+        with self.progress_bus.track(dirname, header.file_size, "receive") as tracker:
+            staged = extract_archive(FrameReader(reader, hasher, on_read=tracker.advance), root, self.log_callback,
+                                     self.fsync_policy, algorithm)
+            try:
+                received_checksum = read_trailer(reader)
+                local_checksum = hasher.digest()
+                if received_checksum != local_checksum:
+                    # None of the files that arrived replaced anything, so the index still describes what is here
+                    save_index(root, algorithm, manifest)
+                    if self.log_callback:
+                        self.log_callback(f"Checksum mismatch for '{dirname}'!\nExpected: {received_checksum.hex()}\nGot: {local_checksum.hex()}")
+                    tracker.fail("checksum mismatch")
+                    return STATUS_CHECKSUM_MISMATCH
+                staged.commit()
+            finally:
+                staged.discard()
 
+        # Index the files by the digests of what was actually unpacked, so the next sync does not read them again
+        for path, digest in staged.digests.items():
+            try:
+                stat_result = os.stat(os.path.join(root, *path.split("/")))
+            except OSError:
+                continue
+            manifest[path] = [stat_result.st_size, stat_result.st_mtime_ns, digest]
+        save_index(root, algorithm, manifest)
+
+        if self.log_callback:
+            self.log_callback(f"Folder '{dirname}' synced successfully")
+        return STATUS_OK
+
+    def _receive_resumable(self, client, reader, header):
+        """
+        Receive a file into a partial file, asking the sender only for the ranges
+        that an earlier interrupted transfer did not already deliver
+        Args:
+            client: Connected client socket, used to send the missing ranges
+            reader: Buffered reader positioned after the header
+            header: FileHeader announced by the sender
+        Returns:
+            Ack status code for the sender
+        """
+
+        filename = safe_filename(header.filename)
+        expected_checksum = read_digest(reader)
+
+        partial = PartialFile(
+            os.path.join(self.save_dir, filename), header.file_size, header.hash_algorithm, expected_checksum
+        )
+        present = partial.load()
+        missing = partial.missing_ranges()
+        client.sendall(pack_missing_ranges(missing))
+
+        if self.log_callback:
+            if present:
+                self.log_callback(f"Resuming file '{filename}' at {present} of {header.file_size} bytes")
+            else:
+                self.log_callback(f"Receiving file '{filename}' ({header.file_size} bytes)")
+
+        # Data can only be hashed as it arrives when the whole file is sent in order
+        hasher = None if present else create_hasher(header.hash_algorithm)
+
+        with self.progress_bus.track(filename, header.file_size, "receive") as tracker:
+            tracker.advance(present)
+            with open(partial.part_path, "r+b") as file:
+                received = self._write_missing_ranges(reader, file, missing, partial, hasher, tracker)
+
+            received_checksum = read_trailer(reader)
+            if received != sum(length for _, length in missing):
+                tracker.fail("transfer incomplete")
+                return STATUS_ERROR
+
+            local_checksum = hasher.digest() if hasher else hash_file(partial.part_path, header.hash_algorithm)
+            if local_checksum != expected_checksum or received_checksum != expected_checksum:
+                partial.discard()
+                if self.log_callback:
+                    self.log_callback(f"Checksum mismatch for '{filename}'!\nExpected: {expected_checksum.hex()}\nGot: {local_checksum.hex()}")
+                tracker.fail("checksum mismatch")
+                return STATUS_CHECKSUM_MISMATCH
+
+            partial.commit(self.fsync_policy)
+        if self.log_callback:
+            self.log_callback(f"Checksum OK for '{filename}'")
+            self.log_callback(f"File '{filename}' received successfully")
+        return STATUS_OK
+
+    def _write_missing_ranges(self, reader, file, missing, partial, hasher, tracker):
+        """
+        Write the payload into the missing ranges of a partial file, in order.
+        Progress is flushed and recorded every CHECKPOINT_INTERVAL bytes and
+        whenever the transfer stops, including when the connection drops. Under
+        FSYNC_NEVER the recorded data may not have reached the disk yet; if a crash
+        loses it, the digest check at the end of the resumed transfer catches it.
+        Returns:
+            Number of payload bytes written
+        """
+
+        ranges = iter(missing)
+        offset, remaining = 0, 0
+        unsaved = []   # (offset, length) spans written since the last checkpoint
+        unsaved_bytes = 0
+        received = 0
+
+        def checkpoint():
+            file.flush()
+            if self.fsync_policy != FSYNC_NEVER:
+                os.fsync(file.fileno())
+            for span_offset, span_length in unsaved:
+                partial.mark(span_offset, span_length)
+            partial.save()
+            unsaved.clear()
+
+        try:
+            for data in read_payload(reader, bytearray(READ_BUFFER_SIZE)):
+                position = 0
+                while position < len(data):
+                    if not remaining:
+                        offset, remaining = next(ranges)  # StopIteration: sender overran the missing ranges
+                        file.seek(offset)
+                    length = min(remaining, len(data) - position)
+                    file.write(data[position:position + length])
+                    unsaved.append((offset, length))
+                    offset += length
+                    remaining -= length
+                    position += length
+
+                if self.fsync_policy == FSYNC_ALWAYS:
+                    file.flush()
+                    os.fsync(file.fileno())
+                if hasher:
+                    hasher.update(data)
+                received += len(data)
+                tracker.advance(len(data))
+                unsaved_bytes += len(data)
+                if unsaved_bytes >= CHECKPOINT_INTERVAL:
+                    checkpoint()
+                    unsaved_bytes = 0
+        except StopIteration:
+            raise ValueError("Sender sent more data than requested")
         finally:
-            client.close()
+            checkpoint()
 
-    def _recv_line(self, sock):
-        """"Receive a line of text from the socket"""
+        return received
 
-        line = b""
-        while True:
-            char = sock.recv(1)
-            if char == b"\n" or char == b"":
-                break
-            line += char
-        return line.decode()
+    def _receive_range(self, reader, header):
+        """
+        Receive one byte range of a parallel transfer and write it at its offset.
+        The connection that completes the file verifies the hash of the whole file.
+        Args:
+            reader: Buffered reader positioned after the header
+            header: FileHeader announced by the sender
+        Returns:
+            Ack status code for the sender
+        """
+
+        transfer_id, offset, length = read_range(reader)
+        if offset + length > header.file_size:
+            return STATUS_ERROR
+
+        filename = safe_filename(header.filename)
+        transfer = self._join_parallel_transfer(transfer_id, filename, header.file_size)
+        status, error = STATUS_ERROR, "transfer aborted"
+        with self.stats.transfer(filename, "receive", length) as timing:
+            try:
+                # Each connection writes through its own handle, so seeking does not race
+                with open(transfer.temp_path, "r+b") as file:
+                    file.seek(offset)
+                    received = 0
+                    t = timing.clock()
+                    for data in read_payload(reader, bytearray(READ_BUFFER_SIZE)):
+                        t = timing.record("receive", t, len(data))
+                        if received + len(data) > length:
+                            error = "range overrun"
+                            timing.fail(error)
+                            return status
+                        file.write(data)
+                        t = timing.record("write", t, len(data))
+                        received += len(data)
+                        transfer.tracker.advance(len(data))
+
+                expected_checksum = read_trailer(reader)
+                if received != length:
+                    error = "range incomplete"
+                    timing.fail(error)
+                    return status
+
+                with self.parallel_lock:
+                    if transfer.error:
+                        error = transfer.error
+                        timing.fail(error)
+                        return status
+                    transfer.ranges[offset] = length
+                    complete = transfer.received == transfer.file_size
+                    if complete:
+                        del self.parallel_transfers[transfer_id]
+
+                if not complete:
+                    status = STATUS_OK
+                    return status
+
+                # Every range has arrived, check the file as a whole once
+                t = timing.clock()
+                local_checksum = hash_file(transfer.temp_path, header.hash_algorithm)
+                timing.record("hash", t, transfer.file_size)
+                if local_checksum != expected_checksum:
+                    if self.log_callback:
+                        self.log_callback(f"Checksum mismatch for '{filename}'!\nExpected: {expected_checksum.hex()}\nGot: {local_checksum.hex()}")
+                    error = "checksum mismatch"
+                    timing.fail(error)
+                    status = STATUS_CHECKSUM_MISMATCH
+                    return status
+
+                transfer.commit(self.fsync_policy)
+                if self.log_callback:
+                    self.log_callback(f"Checksum OK for '{filename}'")
+                    self.log_callback(f"File '{filename}' received successfully")
+                status = STATUS_OK
+                return status
+
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                raise
+
+            finally:
+                with self.parallel_lock:
+                    transfer.connections -= 1
+                    if status != STATUS_OK:
+                        transfer.error = transfer.error or error
+                    if transfer.connections:
+                        transfer = None  # Still being written by other ranges
+                    elif self.parallel_transfers.get(transfer_id) is transfer:
+                        # Every connection has ended without completing the file
+                        del self.parallel_transfers[transfer_id]
+                if transfer is not None:
+                    # The last connection of the file reports its outcome, once
+                    if not transfer.committed:
+                        transfer.discard()
+                    transfer.tracker.finish(None if transfer.committed else transfer.error or "transfer incomplete")
+
+    def _join_parallel_transfer(self, transfer_id, filename, file_size):
+        """
+        Look up the parallel transfer a range belongs to, creating its preallocated
+        temporary file when the first range arrives
+        """
+
+        with self.parallel_lock:
+            transfer = self.parallel_transfers.get(transfer_id)
+            if transfer is None:
+                tracker = self.progress_bus.track(filename, file_size, "receive")
+                try:
+                    transfer = ParallelTransfer(os.path.join(self.save_dir, filename), file_size, tracker)
+                except OSError as e:
+                    tracker.finish(str(e))
+                    raise
+                self.parallel_transfers[transfer_id] = transfer
+
+                if self.log_callback:
+                    self.log_callback(f"Receiving file '{filename}' ({file_size} bytes) over parallel streams")
+
+            transfer.connections += 1
+            return transfer
 
     def _udp_discovery_responder(self, tcp_port, broadcast_port=9999):
         """
-        Listen for UDP broadcast discovery messages and respond with the server's IP address.
+        Listen for UDP broadcast discovery messages and respond with the server's IP address,
+        or with a JSON description (see status()) when asked for DISCOVER_FILE_SERVER_INFO.
         """
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            s.bind(("", broadcast_port)) # Listen on all ips and the specified broadcast port
+            try:
+                s.bind(("", broadcast_port)) # Listen on all ips and the specified broadcast port
+            except OSError as e:
+                # Another receiver on this machine already answers discovery
+                if self.log_callback:
+                    self.log_callback(f"Discovery responder unavailable: {e}")
+                return
             s.settimeout(1)
             while self.udp_discovery_running:
                 try:
@@ -186,6 +978,9 @@ class FileReceiver:
                         # Respond with our IP address
                         ip = get_local_ip()
                         s.sendto(ip.encode(), addr)
+                    elif data == b"DISCOVER_FILE_SERVER_INFO":
+                        info = dict(self.status(), host=get_local_ip(), port=tcp_port)
+                        s.sendto(json.dumps(info).encode(), addr)
                 except socket.timeout:
                     continue
                 except Exception:
@@ -0,0 +1,134 @@
+"""
+Resume - Partial file tracking for resumable transfers
+"""
+
+import json
+import os
+from network.writer import sync_directory, FSYNC_COMMIT, FSYNC_ALWAYS
+
+# Suffixes of the partial data file and of its sidecar state file
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping or touching (start, end) ranges
+
+    Returns:
+        Sorted list of disjoint [start, end] ranges
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class PartialFile:
+    """
+    A file being received in pieces. Data goes to `<name>.part` and the byte ranges
+    already written and flushed to disk are recorded in the `<name>.part.json` sidecar,
+    so a later transfer of the same content only has to fill in the gaps.
+    """
+
+    def __init__(self, save_path, file_size, hash_algorithm, digest):
+        """
+        Args:
+            save_path: Final path of the file
+            file_size: Size of the complete file in bytes
+            hash_algorithm: Algorithm of `digest`
+            digest: Raw digest of the complete file, identifying its content
+        """
+        self.save_path = save_path
+        self.part_path = save_path + PART_SUFFIX
+        self.state_path = save_path + STATE_SUFFIX
+        self.file_size = file_size
+        self.hash_algorithm = hash_algorithm
+        self.digest = digest
+        self.ranges = []  # Disjoint [start, end] ranges safely on disk
+
+    def load(self):
+        """
+        Pick up the state left by an earlier interrupted transfer of the same content.
+        Any partial data for different content is discarded.
+
+        Returns:
+            Number of bytes already present
+        """
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+            same_content = (
+                state["file_size"] == self.file_size
+                and state["hash_algorithm"] == self.hash_algorithm
+                and state["digest"] == self.digest.hex()
+                and os.path.getsize(self.part_path) == self.file_size
+            )
+            if same_content:
+                self.ranges = merge_ranges(tuple(r) for r in state["ranges"])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.ranges = []
+
+        if not self.ranges:
+            with open(self.part_path, "wb") as file:
+                file.truncate(self.file_size)
+        return sum(end - start for start, end in self.ranges)
+
+    def missing_ranges(self):
+        """
+        Returns:
+            List of (offset, length) tuples not yet received, in file order
+        """
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append((position, start - position))
+            position = end
+        if position < self.file_size:
+            missing.append((position, self.file_size - position))
+        return missing
+
+    def mark(self, offset, length):
+        """Record that `length` bytes at `offset` have been written and flushed"""
+        if length:
+            self.ranges = merge_ranges(self.ranges + [[offset, offset + length]])
+
+    def save(self):
+        """Write the sidecar state file atomically"""
+        state = {
+            "file_size": self.file_size,
+            "hash_algorithm": self.hash_algorithm,
+            "digest": self.digest.hex(),
+            "ranges": self.ranges,
+        }
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(temp_path, self.state_path)
+
+    def commit(self, fsync_policy=FSYNC_COMMIT):
+        """
+        Move the completed file to its final name and drop the sidecar. Its data was
+        already synced, if the fsync policy asks for it, by the last checkpoint.
+
+        Args:
+            fsync_policy: One of the FSYNC_* constants of network.writer
+        """
+        os.replace(self.part_path, self.save_path)
+        if fsync_policy == FSYNC_ALWAYS:
+            sync_directory(self.save_path)
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def discard(self):
+        """Remove the partial data and its sidecar"""
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
@@ -2,22 +2,128 @@
 File Sender - Handles sending files over network
 """
 
-import socket
 import os
-import hashlib
-from utils.helpers import discover_file_server_ip
-
-def calculate_sha256(file_path):
-    sha256 = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from utils.helpers import discover_file_server_ip, data_extents
+from utils.hashing import create_hasher, hash_file, get_hash_cache, update_with_zeros, DEFAULT_HASH_ALGORITHM
+from utils.stats import get_stats, NULL_TRANSFER
+from network.throttle import TokenBucket, Throttle, ThrottledSocket, PRIORITY_NORMAL
+from network.tuning import get_socket_profile, observe_rate
+from network.compression import ChunkCompressor, validate_codec, transfer_summary
+from network.archive import FrameWriter, archive_members, content_size, write_archive
+from network.delta import DeltaEncoder, unpack_signatures
+from network.sync import build_manifest, diff_manifests, encode_manifest, decode_manifest
+from network.protocol import (
+    pack_header, pack_range, pack_digest, pack_blob, pack_frame_header, pack_trailer, pack_compression, pack_relay_hops,
+    read_ack, read_batch_ack, read_blob, read_missing_ranges, KIND_FILE, KIND_RANGE, KIND_BATCH_ACK, KIND_ARCHIVE, KIND_SYNC,
+    KIND_DELTA, FLAG_RESUME, FLAG_DEFER_ACK, FLAG_DELETE, FLAG_COMPRESSED, FLAG_RELAY, FLAG_SPARSE,
+    FRAME_DATA, FRAME_HOLE, STATUS_OK, TransferError, ProtocolError
+)
+
+# Size of the reusable read buffer used when the kernel sendfile path is unavailable
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Amount of data handed to sendfile per call, progress is reported after each slice
+SENDFILE_SLICE_SIZE = 8 * 1024 * 1024
+
+# Largest hole announced by a single FRAME_HOLE frame, progress is reported after each
+MAX_HOLE_FRAME = 1024 * 1024 * 1024
+
+# Parallel transfers: each stream gets at least this much data, and no more than MAX_STREAMS are opened
+MIN_RANGE_SIZE = 64 * 1024 * 1024
+MAX_STREAMS = 8
+
+# Files sent in a session before the sender asks for their acknowledgements
+DEFAULT_ACK_INTERVAL = 256
+
+def choose_stream_count(file_size, max_streams=MAX_STREAMS):
+    """
+    Pick the number of parallel streams for a file
+
+    Small files gain nothing from extra connections, so one stream is used per
+    MIN_RANGE_SIZE bytes up to max_streams.
+
+    Args:
+        file_size: Size of the file in bytes
+        max_streams: Upper bound on the number of streams
+
+    Returns:
+        Number of streams to use (at least 1)
+    """
+    return max(1, min(max_streams, file_size // MIN_RANGE_SIZE))
+
+def split_ranges(file_size, streams):
+    """
+    Split a file into contiguous byte ranges of roughly equal size
+
+    Returns:
+        List of (offset, length) tuples
+    """
+    base, extra = divmod(file_size, streams)
+    ranges = []
+    offset = 0
+    for index in range(streams):
+        length = base + (1 if index < extra else 0)
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
 class FileSender:
-    def __init__(self):
-        pass
+    def __init__(self, use_sendfile=True, buffer_size=DEFAULT_BUFFER_SIZE, hash_algorithm=DEFAULT_HASH_ALGORITHM,
+                 use_hash_cache=True, hash_cache=None, compression=None, compression_level=None, rate_limiter=None,
+                 sparse=True, socket_profile="default"):
+        """
+        Args:
+            use_sendfile: If True, use zero-copy kernel sendfile where the platform supports it
+            buffer_size: Read buffer size for the fallback path
+            hash_algorithm: Integrity hash announced to the receiver (see utils.hashing)
+            use_hash_cache: If True, remember file digests so unchanged files are never hashed twice
+            hash_cache: HashCache to use, defaults to the shared persistent cache
+            compression: Codec to compress single files and folders with ('zlib', 'bz2' or 'lzma'),
+                or None to send them as they are. Compression replaces the sendfile path.
+            compression_level: Codec level, or None for the codec's default
+            rate_limiter: TokenBucket capping the combined rate of every transfer made by this
+                sender (share one between senders to cap them together); unlimited by default
+            sparse: If True, files with holes are sent as their data extents plus a hole map,
+                and recreated sparsely on the receiver
+            socket_profile: Name of one of the network.tuning PROFILES, or a SocketProfile,
+                setting the buffers, timeouts and keepalive of every connection
+        """
+        self.use_sendfile = use_sendfile and hasattr(os, "sendfile")
+        self.buffer_size = buffer_size
+        self.hash_algorithm = hash_algorithm
+        create_hasher(hash_algorithm)  # Fail early on unsupported algorithms
+        self.hash_cache = (hash_cache or get_hash_cache()) if use_hash_cache else None
+        self.compression = None
+        self.compression_level = None
+        if compression:
+            self.compression, self.compression_level = validate_codec(compression, compression_level)
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.sparse = sparse
+        self.socket_profile = get_socket_profile(socket_profile)
+        self.stats = get_stats()  # Per-stage timing, while enabled
+
+    def create_throttle(self, rate=None, priority=PRIORITY_NORMAL):
+        """
+        Build the bandwidth limit for one transfer. Its rate can be changed
+        with set_rate() while the transfer runs.
 
-    def send_file(self, file_path, host, port, dest_filename, progress_callback=None, auto_discover=True):
+        Args:
+            rate: Cap for the transfer in bytes per second, or None for no cap
+            priority: One of the network.throttle PRIORITY_* constants, deciding which
+                transfer is served first when the sender's global limit is reached
+
+        Returns:
+            Throttle to pass to send_file, send_archive, sync_directory or open_session
+        """
+
+        return Throttle(self.rate_limiter, rate, priority)
+
+    def send_file(self, file_path, host, port, dest_filename, progress_callback=None, auto_discover=True, streams=1, resume=False, delta=False,
+                  throttle=None):
         """
         Send a file to a remote host
         
@@ -28,6 +134,24 @@ class FileSender:
             dest_filename: Filename to save as on receiver
             progress_callback: Function to call with progress updates (0-100)
             auto_discover: If True and host is 'auto', use UDP broadcast to find server
+            streams: Number of parallel connections to split the file over,
+                or None to choose one from the file size
+            resume: If True, ask the receiver which ranges it already holds from an
+                interrupted transfer and send only the rest (over a single connection)
+            delta: If True, send only the parts that differ from the receiver's existing
+                copy of dest_filename (over a single connection)
+            throttle: Throttle from create_throttle() limiting this transfer, shared by all of
+                its streams; by default only the sender's global limit applies
+
+        Returns:
+            Transfer summary of the data sent (see network.compression.transfer_summary).
+            Data the receiver already had is not part of it: resumed transfers add
+            'skipped_bytes', delta transfers 'literal_bytes' (new data sent) and
+            'skipped_bytes' (rebuilt from the receiver's copy). Files sent sparse add
+            'hole_bytes', the size of their holes.
+
+        Raises:
+            TransferError: If the receiver reports a failed transfer
         """
 
         if not os.path.isfile(file_path):
@@ -39,31 +163,794 @@ class FileSender:
         # if auto_discover and (host == 'auto' or not host or host.strip() == ''):
         #     host = discover_file_server_ip()
 
-        # Create socket and connect to the server
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((host, port))
+        throttle = throttle or self.create_throttle()
+        started = time.perf_counter()
+
+        with self.stats.transfer(dest_filename, "send", file_size) as timing:
+            if resume:
+                sent = self._send_resumable(file_path, file_size, host, port, dest_filename, progress_callback, throttle)
+                return dict(transfer_summary(sent, sent, time.perf_counter() - started), skipped_bytes=file_size - sent)
+
+            if delta:
+                literal = self._send_delta(file_path, file_size, host, port, dest_filename, progress_callback, throttle)
+                return dict(transfer_summary(literal, literal, time.perf_counter() - started),
+                            literal_bytes=literal, skipped_bytes=file_size - literal)
+
+            if streams is None:
+                streams = choose_stream_count(file_size)
+            # Files with holes go over a single connection, which can skip the holes
+            if streams > 1 and file_size >= streams and not self._has_holes(file_path, file_size):
+                self._send_parallel(file_path, file_size, host, port, dest_filename, streams, progress_callback, throttle, timing)
+                observe_rate(host, file_size, time.perf_counter() - started)
+                # Ranges are never compressed
+                return transfer_summary(file_size, file_size, time.perf_counter() - started)
+
+            # Create socket and connect to the server
+            t = timing.clock()
+            client = self._connect(host, port, throttle)
+            reader = client.makefile("rb")
+            timing.record("connect", t)
+
+            try:
+                data_bytes, wire_bytes, compress_seconds = self._send_whole_file(
+                    client, file_path, file_size, dest_filename, 0, progress_callback, timing=timing
+                )
+
+                # Wait for the receiver to confirm the checksum
+                t = timing.clock()
+                status = read_ack(reader)
+                timing.record("ack", t)
+                if status != STATUS_OK:
+                    raise TransferError(status)
+
+                observe_rate(host, wire_bytes, time.perf_counter() - started)
+                summary = transfer_summary(data_bytes, wire_bytes, time.perf_counter() - started, compress_seconds)
+                if data_bytes != file_size:
+                    summary["hole_bytes"] = file_size - data_bytes
+                return summary
+
+            finally:
+                reader.close()
+                client.close()
+
+    def send_archive(self, source, host, port, dest_name, progress_callback=None, throttle=None):
+        """
+        Send a directory tree, or several files and directories, as one streamed archive
+
+        Args:
+            source: Directory whose contents to send, or a list of files and directories
+            host: Target host address
+            port: Target port number
+            dest_name: Directory name to unpack into on the receiver
+            progress_callback: Function to call with progress updates (0-100)
+            throttle: Throttle from create_throttle() limiting this transfer
+
+        Returns:
+            Transfer summary of the archive stream (see network.compression.transfer_summary)
+
+        Raises:
+            TransferError: If the receiver reports a failed transfer
+        """
+
+        members = archive_members(source)
+        total = content_size(members)
+
+        started = time.perf_counter()
+        client = self._connect(host, port, throttle or self.create_throttle())
+        reader = client.makefile("rb")
+
+        try:
+            compressor = self._compressor()
+            client.sendall(self._pack_header(dest_name, total, KIND_ARCHIVE, 0, compressor))
+
+            hasher = create_hasher(self.hash_algorithm)
+            on_sent = self._progress_reporter(total, progress_callback) if total else None
+            frame_writer = FrameWriter(client, hasher, on_sent, compressor=compressor)
+            write_archive(frame_writer, members)
+
+            client.sendall(pack_frame_header(0) + pack_trailer(hasher.digest()))
+
+            status = read_ack(reader)
+            if status != STATUS_OK:
+                raise TransferError(status)
+
+            if compressor:
+                return transfer_summary(compressor.raw_bytes, compressor.wire_bytes, time.perf_counter() - started, compressor.seconds)
+            return transfer_summary(frame_writer.written, frame_writer.written, time.perf_counter() - started)
+
+        finally:
+            reader.close()
+            client.close()
+
+    def sync_directory(self, local_dir, host, port, dest_name, delete=False, progress_callback=None, throttle=None):
+        """
+        Bring a directory on the receiver up to date with a local one, sending only
+        files that are new or whose content changed
+
+        Args:
+            local_dir: Directory to mirror
+            host: Target host address
+            port: Target port number
+            dest_name: Directory name on the receiver
+            delete: If True, also remove files on the receiver that no longer exist locally
+            progress_callback: Function to call with progress updates (0-100)
+            throttle: Throttle from create_throttle() limiting this transfer
+
+        Returns:
+            Dict with the number of files 'sent', 'deleted' and 'unchanged'
+
+        Raises:
+            TransferError: If the receiver reports a failed transfer
+        """
+
+        if not os.path.isdir(local_dir):
+            raise NotADirectoryError(f"'{local_dir}' is not a directory.")
+
+        local = build_manifest(local_dir, self.hash_algorithm, hash_cache=self.hash_cache)
+
+        client = self._connect(host, port, throttle or self.create_throttle())
+        reader = client.makefile("rb")
+
+        try:
+            flags = FLAG_DELETE if delete else 0
+            client.sendall(pack_header(dest_name, 0, self.hash_algorithm, kind=KIND_SYNC, flags=flags))
+
+            # Compare against the receiver's manifest and announce what is about to change
+            remote = decode_manifest(read_blob(reader))
+            changed, deleted = diff_manifests(local, remote)
+            plan = {
+                "delete": deleted if delete else [],
+                "files": {path: local[path][2] for path in changed},
+            }
+            client.sendall(pack_blob(encode_manifest(plan)))
+
+            # Send the changed files as one archive
+            total = sum(local[path][0] for path in changed)
+            hasher = create_hasher(self.hash_algorithm)
+            on_sent = self._progress_reporter(total, progress_callback) if total else None
+            members = [(os.path.join(local_dir, *path.split("/")), path) for path in changed]
+            write_archive(FrameWriter(client, hasher, on_sent), members)
+
+            client.sendall(pack_frame_header(0) + pack_trailer(hasher.digest()))
+
+            status = read_ack(reader)
+            if status != STATUS_OK:
+                raise TransferError(status)
+
+            return {"sent": len(changed), "deleted": len(plan["delete"]), "unchanged": len(local) - len(changed)}
+
+        finally:
+            reader.close()
+            client.close()
+
+    def send_chain(self, file_path, hops, dest_filename, progress_callback=None, throttle=None):
+        """
+        Send a file to several receivers at once by chain replication: the file goes
+        to the first receiver only, which stores it and passes it on to the next,
+        and so on. Every receiver verifies the digest.
+
+        Args:
+            file_path: Path to the file to send
+            hops: List of (host, port) receivers, in chain order
+            dest_filename: Filename to save as on every receiver
+            progress_callback: Function to call with progress updates (0-100)
+            throttle: Throttle from create_throttle() limiting the transfer to the first receiver
+
+        Returns:
+            List of ((host, port), status) tuples, one per receiver, in chain order.
+            The first is always STATUS_OK, receivers the chain never reached report STATUS_ERROR.
+
+        Raises:
+            TransferError: If the first receiver reports a failed transfer
+            ProtocolError: If the chain's statuses do not start with the first receiver's ack
+        """
+
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"File '{file_path}' does not exist.")
+
+        hops = list(hops)
+        file_size = os.path.getsize(file_path)
+        host, port = hops[0]
+        client = self._connect(host, port, throttle or self.create_throttle())
+        reader = client.makefile("rb")
+
+        try:
+            self._send_whole_file(client, file_path, file_size, dest_filename, 0, progress_callback, relay_hops=hops[1:])
+            # The first receiver acks its own copy like any transfer, then reports the whole chain
+            status = read_ack(reader)
+            if status != STATUS_OK:
+                raise TransferError(status)
+            statuses = read_batch_ack(reader)
+            if not statuses or statuses[0] != status:
+                raise ProtocolError("Relay statuses do not match the first receiver's ack")
+            return list(zip(hops, statuses))
+
+        finally:
+            reader.close()
+            client.close()
+
+    def send_shared(self, source, host, port, dest_filename, progress_callback=None, throttle=None):
+        """
+        Send a file that is mapped into memory once and shared between several transfers
+
+        Args:
+            source: network.fanout.SharedSource, hashed with this sender's algorithm
+            host: Target host address
+            port: Target port number
+            dest_filename: Filename to save as on receiver
+            progress_callback: Function to call with progress updates (0-100)
+            throttle: Throttle from create_throttle() limiting this transfer
+
+        Returns:
+            Transfer summary (see network.compression.transfer_summary)
+
+        Raises:
+            TransferError: If the receiver reports a failed transfer
+        """
+
+        started = time.perf_counter()
+        client = self._connect(host, port, throttle or self.create_throttle())
+        reader = client.makefile("rb")
 
         try:
-            # Send filename and filesize
-            client.sendall((dest_filename + '\n').encode())
-            client.sendall((str(file_size) + '\n').encode())
+            compressor = self._compressor()
+            client.sendall(self._pack_header(dest_filename, source.size, KIND_FILE, 0, compressor))
 
-            # Send file data
+            on_sent = self._progress_reporter(source.size, progress_callback)
+            for offset in range(0, source.size, self.buffer_size):
+                chunk = source.view[offset:offset + self.buffer_size]
+                frame_type, data = compressor.compress(chunk) if compressor else (FRAME_DATA, chunk)
+                client.sendall(pack_frame_header(len(data), frame_type))
+                client.sendall(data)
+                on_sent(len(chunk))
+
+            client.sendall(pack_frame_header(0) + pack_trailer(source.digest))
+
+            status = read_ack(reader)
+            if status != STATUS_OK:
+                raise TransferError(status)
+
+            if compressor:
+                return transfer_summary(source.size, compressor.wire_bytes, time.perf_counter() - started, compressor.seconds)
+            return transfer_summary(source.size, source.size, time.perf_counter() - started)
+
+        finally:
+            reader.close()
+            client.close()
+
+    def open_session(self, host, port, ack_interval=None, throttle=None):
+        """
+        Open a connection that many files can be sent over back to back
+
+        Args:
+            host: Target host address
+            port: Target port number
+            ack_interval: Number of files between acknowledgement requests
+            throttle: Throttle from create_throttle() limiting the whole session
+
+        Returns:
+            SendSession, usable as a context manager
+        """
+
+        return SendSession(self, host, port, ack_interval or DEFAULT_ACK_INTERVAL, throttle or self.create_throttle())
+
+    def _send_whole_file(self, client, file_path, file_size, dest_filename, flags, progress_callback, relay_hops=None,
+                         timing=NULL_TRANSFER):
+        """
+        Send header, payload and trailer of a file, hashing it on the way out unless
+        its digest is cached. The caller is responsible for reading the acknowledgement.
+
+        Args:
+            relay_hops: For chain replication, the (host, port) receivers the first one
+                passes the file on to; relayed files are never compressed nor sent sparse
+            timing: utils.stats Transfer to time the stages on
+
+        Returns:
+            Tuple of (data bytes sent, which leaves out holes, payload bytes put on
+            the wire, seconds spent compressing)
+        """
+
+        # Unchanged files have a cached digest, the rest are hashed as they are sent
+        stat_result = os.stat(file_path)
+        digest = self.hash_cache.lookup(file_path, self.hash_algorithm, stat_result) if self.hash_cache else None
+        hasher = None if digest else create_hasher(self.hash_algorithm)
+
+        # Header, frames and trailer leave in full segments, whatever their sizes
+        with self.socket_profile.corked(client):
             with open(file_path, 'rb') as file:
-                sent = 0
-                while True:
-                    data = file.read(1024)
-                    if not data:
+                # Files with holes send only their data extents
+                extents = self._sparse_extents(file, file_size) if relay_hops is None else None
+                if extents is not None:
+                    flags |= FLAG_SPARSE
+
+                # Send header with filename, filesize and hash algorithm
+                if relay_hops is None:
+                    compressor = self._compressor()
+                    client.sendall(self._pack_header(dest_filename, file_size, KIND_FILE, flags, compressor))
+                else:
+                    compressor = None
+                    header = pack_header(dest_filename, file_size, self.hash_algorithm, flags=flags | FLAG_RELAY)
+                    client.sendall(header + pack_relay_hops(relay_hops))
+
+                # Send file data as frames
+                on_sent = self._progress_reporter(file_size, progress_callback)
+                if extents is None:
+                    self._send_payload(client, file, 0, file_size, hasher, on_sent, compressor, timing)
+                else:
+                    self._send_sparse(client, file, file_size, extents, hasher, on_sent, compressor, timing)
+
+            if hasher:
+                digest = hasher.digest()
+                if self.hash_cache:
+                    self.hash_cache.store(file_path, self.hash_algorithm, digest, stat_result)
+
+            client.sendall(pack_frame_header(0) + pack_trailer(digest))
+
+        data_bytes = sum(length for _, length in extents) if extents is not None else file_size
+        if compressor:
+            return data_bytes, compressor.wire_bytes, compressor.seconds
+        return data_bytes, data_bytes, 0.0
+
+    def _send_resumable(self, file_path, file_size, host, port, dest_filename, progress_callback, throttle):
+        """
+        Send a file that the receiver may already hold in part.
+        The whole-file digest identifies the content, so it is computed before connecting.
+
+        Returns:
+            Number of payload bytes sent
+        """
+
+        digest = self._hash_file(file_path)
+
+        client = self._connect(host, port, throttle)
+        reader = client.makefile("rb")
+
+        try:
+            header = pack_header(dest_filename, file_size, self.hash_algorithm, flags=FLAG_RESUME)
+            client.sendall(header + pack_digest(digest))
+
+            missing = read_missing_ranges(reader)
+            on_sent = self._progress_reporter(file_size, progress_callback)
+            present = file_size - sum(length for _, length in missing)
+            if present:
+                on_sent(present)
+
+            with open(file_path, 'rb') as file:
+                for offset, length in missing:
+                    self._send_payload(client, file, offset, length, None, on_sent)
+
+            client.sendall(pack_frame_header(0) + pack_trailer(digest))
+
+            status = read_ack(reader)
+            if status != STATUS_OK:
+                raise TransferError(status)
+
+            return file_size - present
+
+        finally:
+            reader.close()
+            client.close()
+
+    def _send_delta(self, file_path, file_size, host, port, dest_filename, progress_callback, throttle):
+        """
+        Send a file as a delta against the block signatures of the receiver's copy
+
+        Returns:
+            Number of bytes sent as new data
+        """
+
+        client = self._connect(host, port, throttle)
+        reader = client.makefile("rb")
+
+        try:
+            client.sendall(pack_header(dest_filename, file_size, self.hash_algorithm, kind=KIND_DELTA))
+
+            block_size, basis_size, signatures = unpack_signatures(read_blob(reader))
+            hasher = create_hasher(self.hash_algorithm)
+            on_sent = self._progress_reporter(file_size, progress_callback)
+
+            with open(file_path, 'rb') as file:
+                if signatures:
+                    encoder = DeltaEncoder(client, block_size, basis_size, signatures)
+                    encoder.encode(file, hasher, on_sent)
+                    literal_bytes = encoder.literal_bytes
+                else:
+                    # The receiver has nothing to build on
+                    self._send_payload(client, file, 0, file_size, hasher, on_sent)
+                    literal_bytes = file_size
+
+            client.sendall(pack_frame_header(0) + pack_trailer(hasher.digest()))
+
+            status = read_ack(reader)
+            if status != STATUS_OK:
+                raise TransferError(status)
+
+            return literal_bytes
+
+        finally:
+            reader.close()
+            client.close()
+
+    def _send_parallel(self, file_path, file_size, host, port, dest_filename, streams, progress_callback, throttle,
+                       timing=NULL_TRANSFER):
+        """
+        Send a file as byte ranges over several parallel connections.
+        The whole-file digest is computed alongside the transfer and sent in every range's trailer.
+
+        Args:
+            timing: utils.stats Transfer the stages of every stream are timed on
+        """
+
+        transfer_id = uuid.uuid4().bytes
+        on_sent = self._progress_reporter(file_size, progress_callback)
+
+        with ThreadPoolExecutor(max_workers=streams + 1) as pool:
+            digest = pool.submit(self._timed_hash_file, file_path, file_size, timing)
+            results = [
+                pool.submit(
+                    self._send_range, file_path, file_size, host, port, dest_filename,
+                    transfer_id, offset, length, digest, on_sent, throttle, timing
+                )
+                for offset, length in split_ranges(file_size, streams)
+            ]
+
+            for result in results:
+                result.result()
+
+    def _send_range(self, file_path, file_size, host, port, dest_filename, transfer_id, offset, length, digest, on_sent, throttle,
+                    timing=NULL_TRANSFER):
+        """
+        Send one byte range of a parallel transfer over its own connection
+
+        Args:
+            digest: Future resolving to the digest of the whole file
+            on_sent: Function to call with the number of bytes sent
+            throttle: Throttle shared by all ranges of the transfer
+            timing: utils.stats Transfer shared by all ranges of the transfer
+        """
+
+        t = timing.clock()
+        client = self._connect(host, port, throttle)
+        reader = client.makefile("rb")
+        timing.record("connect", t)
+
+        try:
+            with self.socket_profile.corked(client):
+                header = pack_header(dest_filename, file_size, self.hash_algorithm, kind=KIND_RANGE)
+                client.sendall(header + pack_range(transfer_id, offset, length))
+
+                with open(file_path, 'rb') as file:
+                    self._send_payload(client, file, offset, length, None, on_sent, timing=timing)
+
+                client.sendall(pack_frame_header(0) + pack_trailer(digest.result()))
+
+            t = timing.clock()
+            status = read_ack(reader)
+            timing.record("ack", t)
+            if status != STATUS_OK:
+                raise TransferError(status)
+
+        finally:
+            reader.close()
+            client.close()
+
+    def _hash_file(self, file_path):
+        """
+        Digest of a whole file, from the hash cache when the file is unchanged
+        """
+
+        if self.hash_cache:
+            return self.hash_cache.hash_file(file_path, self.hash_algorithm, self.buffer_size)
+        return hash_file(file_path, self.hash_algorithm, self.buffer_size)
+
+    def _timed_hash_file(self, file_path, file_size, timing):
+        """_hash_file, timed as the 'hash' stage"""
+
+        t = timing.clock()
+        digest = self._hash_file(file_path)
+        timing.record("hash", t, file_size)
+        return digest
+
+    def _compressor(self):
+        """
+        Fresh compression state for one transfer
+
+        Returns:
+            ChunkCompressor, or None if compression is disabled
+        """
+
+        if not self.compression:
+            return None
+        return ChunkCompressor(self.compression, self.compression_level)
+
+    def _pack_header(self, name, size, kind, flags, compressor):
+        """Build a header, announcing the codec when the payload is compressed"""
+
+        if not compressor:
+            return pack_header(name, size, self.hash_algorithm, kind=kind, flags=flags)
+        header = pack_header(name, size, self.hash_algorithm, kind=kind, flags=flags | FLAG_COMPRESSED)
+        return header + pack_compression(compressor.codec_id, compressor.level)
+
+    def _connect(self, host, port, throttle=None):
+        """
+        Open a TCP connection to the receiver
+
+        Args:
+            throttle: Throttle pacing everything sent over the connection, or None
+
+        Returns:
+            Connected socket
+        """
+
+        client = self.socket_profile.connect(host, port)
+        return ThrottledSocket(client, throttle) if throttle else client
+
+    def _progress_reporter(self, total, progress_callback):
+        """
+        Build a thread-safe function that accumulates sent byte counts
+        and forwards them to progress_callback as a percentage
+        """
+
+        lock = threading.Lock()
+        sent = [0]
+
+        def on_sent(count):
+            if not progress_callback:
+                return
+            with lock:
+                sent[0] += count
+                progress = min(100.0, (sent[0] / total) * 100)
+            progress_callback(progress)
+
+        return on_sent
+
+    def _has_holes(self, file_path, file_size):
+        """Tell from its allocated size whether a file has holes worth skipping"""
+        if not self.sparse:
+            return False
+        blocks = getattr(os.stat(file_path), "st_blocks", None)
+        return blocks is not None and blocks * 512 < file_size
+
+    def _sparse_extents(self, file, file_size):
+        """
+        Returns:
+            List of the (offset, length) data extents of a file with holes, or None to send
+            it whole (sparse sending is off, the file has no holes, or they can not be found)
+        """
+
+        if not self.sparse or not file_size:
+            return None
+        extents = data_extents(file, file_size)
+        if extents is None or sum(length for _, length in extents) == file_size:
+            return None
+        return extents
+
+    def _send_sparse(self, client, file, file_size, extents, hasher, on_sent, compressor=None, timing=NULL_TRANSFER):
+        """
+        Send the data extents of a file as payload frames, with FRAME_HOLE frames
+        standing in for the holes between them. Holes are hashed as the zeros they read as.
+        """
+
+        offset = 0
+        for start, length in extents + [(file_size, 0)]:
+            hole = start - offset
+            while hole > 0:
+                count = min(hole, MAX_HOLE_FRAME)
+                client.sendall(pack_frame_header(count, FRAME_HOLE))
+                if hasher:
+                    update_with_zeros(hasher, count)
+                hole -= count
+                on_sent(count)
+            if length:
+                self._send_payload(client, file, start, length, hasher, on_sent, compressor, timing)
+            offset = start + length
+
+    def _send_payload(self, client, file, offset, length, hasher, on_sent, compressor=None, timing=NULL_TRANSFER):
+        """
+        Send `length` bytes of the file starting at `offset` as payload frames
+
+        Args:
+            hasher: Hash object to update with the data sent, or None
+            on_sent: Function to call with the number of bytes sent after each frame
+            compressor: ChunkCompressor to pass every frame through, or None
+            timing: utils.stats Transfer to time the read, hash, compress and send stages on
+        """
+
+        if compressor:
+            self._send_compressed(client, file, offset, length, hasher, on_sent, compressor, timing)
+        elif self.use_sendfile:
+            self._send_with_sendfile(client, file, offset, length, hasher, on_sent, timing)
+        else:
+            self._send_buffered(client, file, offset, length, hasher, on_sent, timing)
+
+    def _send_with_sendfile(self, client, file, offset, length, hasher, on_sent, timing=NULL_TRANSFER):
+        """
+        Send the file contents with the kernel sendfile call, one large slice at a time.
+        Each slice is hashed straight after it is sent, while it is still in the page cache.
+        """
+
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        end = offset + length
+        t = timing.clock()
+        while offset < end:
+            count = min(SENDFILE_SLICE_SIZE, end - offset)
+            client.sendall(pack_frame_header(count))
+            slice_sent = client.sendfile(file, offset, count)
+            if slice_sent != count:
+                raise IOError(f"File '{file.name}' was truncated while sending")
+            # Disk reads happen inside sendfile and are part of the send stage
+            t = timing.record("send", t, slice_sent)
+
+            if hasher:
+                file.seek(offset)
+                remaining = slice_sent
+                while remaining:
+                    chunk_length = file.readinto(view[:min(remaining, len(buffer))])
+                    if not chunk_length:
                         break
-                    client.sendall(data)
-                    sent += len(data)
+                    t = timing.record("read", t, chunk_length)
+                    hasher.update(view[:chunk_length])
+                    t = timing.record("hash", t, chunk_length)
+                    remaining -= chunk_length
+            offset += slice_sent
 
-                    # Update progress if callback is provided
-                    if progress_callback:
-                        progress = (sent / file_size) * 100
-                        progress_callback(progress)
-        
+            on_sent(slice_sent)
+
+    def _send_buffered(self, client, file, offset, length, hasher, on_sent, timing=NULL_TRANSFER):
+        """
+        Send the file contents through a single reusable userspace buffer
+        """
+
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        file.seek(offset)
+        remaining = length
+        t = timing.clock()
+        while remaining:
+            chunk_length = file.readinto(view[:min(len(buffer), remaining)])
+            if not chunk_length:
+                raise IOError(f"File '{file.name}' was truncated while sending")
+            t = timing.record("read", t, chunk_length)
+            client.sendall(pack_frame_header(chunk_length))
+            client.sendall(view[:chunk_length])
+            t = timing.record("send", t, chunk_length)
+            if hasher:
+                hasher.update(view[:chunk_length])
+                t = timing.record("hash", t, chunk_length)
+            remaining -= chunk_length
+
+            # Update progress
+            on_sent(chunk_length)
+
+    def _send_compressed(self, client, file, offset, length, hasher, on_sent, compressor, timing=NULL_TRANSFER):
+        """
+        Send the file contents one buffer at a time, each compressed into its own frame
+        unless it does not shrink
+        """
+
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        file.seek(offset)
+        remaining = length
+        t = timing.clock()
+        while remaining:
+            chunk_length = file.readinto(view[:min(len(buffer), remaining)])
+            if not chunk_length:
+                raise IOError(f"File '{file.name}' was truncated while sending")
+            t = timing.record("read", t, chunk_length)
+            frame_type, data = compressor.compress(view[:chunk_length])
+            t = timing.record("compress", t, chunk_length)
+            client.sendall(pack_frame_header(len(data), frame_type))
+            client.sendall(data)
+            t = timing.record("send", t, len(data))
+            if hasher:
+                hasher.update(view[:chunk_length])
+                t = timing.record("hash", t, chunk_length)
+            remaining -= chunk_length
+
+            on_sent(chunk_length)
+
+class SendSession:
+    """
+    A long-lived connection that streams many files back to back.
+
+    Files are pipelined: the sender never waits for a file to be acknowledged
+    before starting the next one. Acknowledgements are requested in batches every
+    `ack_interval` files and collected one batch behind, so the connection never stalls.
+    """
+
+    def __init__(self, sender, host, port, ack_interval=DEFAULT_ACK_INTERVAL, throttle=None):
+        self.sender = sender
+        self.ack_interval = ack_interval
+        self.client = sender._connect(host, port, throttle)
+        self.reader = self.client.makefile("rb")
+        self.sent = []              # dest_filename of every file sent, in order
+        self.results = []           # (dest_filename, status) of every acknowledged file
+        self.unrequested = 0        # Files sent since the last acknowledgement request
+        self.outstanding = 0        # Acknowledgement requests not yet answered
+        self.started = time.perf_counter()
+        self.raw_bytes = 0          # Data bytes of every file sent, holes left out
+        self.hole_bytes = 0         # Bytes of holes skipped by sparse files
+        self.wire_bytes = 0         # Payload bytes actually put on the wire
+        self.compress_seconds = 0.0
+
+    def send(self, file_path, dest_filename, progress_callback=None):
+        """
+        Queue a file on the session
+
+        Args:
+            file_path: Path to the file to send
+            dest_filename: Filename to save as on receiver
+            progress_callback: Function to call with progress updates (0-100)
+        """
+
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"File '{file_path}' does not exist.")
+
+        file_size = os.path.getsize(file_path)
+        with self.sender.stats.transfer(dest_filename, "send", file_size) as timing:
+            data_bytes, wire_bytes, compress_seconds = self.sender._send_whole_file(
+                self.client, file_path, file_size, dest_filename, FLAG_DEFER_ACK, progress_callback, timing=timing
+            )
+        self.raw_bytes += data_bytes
+        self.hole_bytes += file_size - data_bytes
+        self.wire_bytes += wire_bytes
+        self.compress_seconds += compress_seconds
+        self.sent.append(dest_filename)
+        self.unrequested += 1
+
+        if self.unrequested >= self.ack_interval:
+            # Collect the previous batch before asking for this one, keeping one request in flight
+            if self.outstanding:
+                self._collect_batch()
+            self._request_batch()
+
+    def close(self):
+        """
+        Wait for every outstanding acknowledgement and close the connection
+
+        Returns:
+            List of (dest_filename, status) tuples, one per file sent
+        """
+
+        try:
+            if self.unrequested:
+                self._request_batch()
+            while self.outstanding:
+                self._collect_batch()
         finally:
-            checksum = calculate_sha256(file_path)
-            client.sendall((checksum + '\n').encode())
-            client.close()
\ No newline at end of file
+            self.reader.close()
+            self.client.close()
+        return self.results
+
+    def summary(self):
+        """
+        Transfer summary of everything sent on the session so far
+        (see network.compression.transfer_summary), with the 'hole_bytes' of sparse files
+        """
+
+        summary = transfer_summary(self.raw_bytes, self.wire_bytes, time.perf_counter() - self.started, self.compress_seconds)
+        summary["hole_bytes"] = self.hole_bytes
+        return summary
+
+    def _request_batch(self):
+        self.client.sendall(pack_header("", 0, self.sender.hash_algorithm, kind=KIND_BATCH_ACK))
+        self.unrequested = 0
+        self.outstanding += 1
+
+    def _collect_batch(self):
+        statuses = read_batch_ack(self.reader)
+        self.outstanding -= 1
+        start = len(self.results)
+        self.results.extend(zip(self.sent[start:start + len(statuses)], statuses))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.reader.close()
+            self.client.close()
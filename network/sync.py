@@ -0,0 +1,126 @@
+"""
+Sync - Directory manifests for sending only new or changed files
+"""
+
+import json
+import os
+import zlib
+from utils.hashing import hash_file
+from network.archive import safe_member_path
+
+# Index the receiver keeps in the root of every synced directory
+MANIFEST_NAME = ".fileshare-manifest.json"
+
+def iter_files(root):
+    """
+    Walk a directory tree
+
+    Yields:
+        Tuples of (relative_path, stat_result) for every regular file, with '/' separators.
+        Symlinks and the manifest index itself are left out.
+    """
+    pending = [("", root)]
+    while pending:
+        prefix, directory = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append((relative_path + "/", entry.path))
+                elif entry.is_file(follow_symlinks=False) and relative_path != MANIFEST_NAME:
+                    yield relative_path, entry.stat()
+
+def build_manifest(root, algorithm, index=None, hash_cache=None):
+    """
+    Describe every file below `root`
+
+    Args:
+        root: Directory to describe
+        algorithm: Hash algorithm for the content hashes
+        index: Earlier manifest of the same tree. Files whose size and mtime are
+            unchanged reuse its hash instead of being read again.
+        hash_cache: Optional HashCache consulted for files the index does not cover
+
+    Returns:
+        Dict mapping relative path to [size, mtime_ns, hex digest]
+    """
+    index = index or {}
+    manifest = {}
+    for relative_path, stat_result in iter_files(root):
+        size, mtime_ns = stat_result.st_size, stat_result.st_mtime_ns
+        known = index.get(relative_path)
+        if known and known[0] == size and known[1] == mtime_ns:
+            digest = known[2]
+        elif hash_cache:
+            digest = hash_cache.hash_file(os.path.join(root, relative_path), algorithm).hex()
+        else:
+            digest = hash_file(os.path.join(root, relative_path), algorithm).hex()
+        manifest[relative_path] = [size, mtime_ns, digest]
+    return manifest
+
+def diff_manifests(local, remote):
+    """
+    Compare the sender's manifest with the receiver's
+
+    Returns:
+        Tuple of (changed, deleted): sorted relative paths that are new or differ in
+        content, and sorted relative paths that only exist on the receiver
+    """
+    changed = sorted(path for path, entry in local.items() if path not in remote or remote[path][2] != entry[2])
+    deleted = sorted(path for path in remote if path not in local)
+    return changed, deleted
+
+def encode_manifest(manifest):
+    """Serialize a manifest (or any JSON value) compactly for the wire"""
+    return zlib.compress(json.dumps(manifest, separators=(",", ":")).encode())
+
+def decode_manifest(data):
+    """Inverse of encode_manifest"""
+    return json.loads(zlib.decompress(data).decode())
+
+def load_index(root, algorithm):
+    """
+    Returns:
+        The manifest saved by the last sync into `root`, or an empty dict if there is
+        none or it was made with a different hash algorithm
+    """
+    try:
+        with open(os.path.join(root, MANIFEST_NAME), "r", encoding="utf-8") as file:
+            state = json.load(file)
+        if state.get("hash_algorithm") == algorithm:
+            return state["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+def save_index(root, algorithm, manifest):
+    """Store a manifest as the index of `root`, atomically"""
+    path = os.path.join(root, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({"hash_algorithm": algorithm, "files": manifest}, file, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+
+def delete_files(root, relative_paths):
+    """
+    Remove files below `root` and any directories left empty by their removal
+
+    Returns:
+        Number of files removed
+    """
+    real_root = os.path.realpath(root)
+    removed = 0
+    for relative_path in relative_paths:
+        path = safe_member_path(real_root, relative_path)
+        if path is None or not os.path.isfile(path):
+            continue
+        os.remove(path)
+        removed += 1
+
+        directory = os.path.dirname(path)
+        while directory != real_root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break  # Not empty
+            directory = os.path.dirname(directory)
+    return removed
@@ -0,0 +1,251 @@
+"""
+Throttle - Token-bucket bandwidth limits and priority scheduling for concurrent transfers
+
+Every transfer draws from its own bucket (a per-transfer cap) and then from a
+bucket shared by all transfers (the global cap). When transfers compete for
+the shared bucket, the one with the highest priority is served first. Rates
+can be changed at any time, including while transfers are running.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+# Transfer priorities, lower values are served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+PRIORITIES = {"high": PRIORITY_HIGH, "normal": PRIORITY_NORMAL, "low": PRIORITY_LOW}
+
+# Tokens an idle bucket may save up, in seconds' worth of its rate
+BURST_SECONDS = 0.1
+
+# Data passed per token request while a limit is set, in seconds' worth of its rate,
+# so throttled transfers move in small steps instead of large bursts
+SLICE_SECONDS = 0.05
+MIN_SLICE_SIZE = 16 * 1024
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` bytes per second.
+
+    A request may take more tokens than are available; the bucket then goes into
+    debt and later requests wait until it is paid off, so the average rate holds
+    whatever the request sizes. Waiting requests are served in priority order.
+    """
+
+    def __init__(self, rate=None):
+        """
+        Args:
+            rate: Bytes per second, or None for no limit
+        """
+        self.condition = threading.Condition()
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.waiting = []  # Heap of (priority, sequence) tickets
+        self.sequence = itertools.count()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Change the rate, taking effect immediately for waiting requests
+
+        Args:
+            rate: Bytes per second, or None (or 0) for no limit
+        """
+        with self.condition:
+            self._refill()
+            if rate and not self.rate:
+                self.tokens = 0.0
+            self.rate = rate or None
+            if self.rate:
+                self.tokens = min(self.tokens, self.rate * BURST_SECONDS)
+            self.condition.notify_all()
+
+    def consume(self, count, priority=PRIORITY_NORMAL):
+        """
+        Take `count` tokens, blocking until this request's turn comes
+
+        Args:
+            count: Number of bytes about to be transferred
+            priority: One of the PRIORITY_* constants
+        """
+        with self.condition:
+            if self.rate is None and not self.waiting:
+                return
+
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self.waiting[0] == ticket:
+                        if self.rate is None or self.tokens >= 0:
+                            break
+                        timeout = -self.tokens / self.rate
+                    else:
+                        timeout = None
+                    self.condition.wait(timeout)
+
+                if self.rate:
+                    self.tokens -= count
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def reserve(self, count):
+        """
+        Take `count` tokens without blocking, for callers that wait by themselves,
+        such as an event loop. Reservations do not take part in the priority order.
+
+        Args:
+            count: Number of bytes about to be transferred
+
+        Returns:
+            Seconds to wait before transferring them, 0.0 if they may go at once
+        """
+        with self.condition:
+            if self.rate is None:
+                return 0.0
+            self._refill()
+            delay = max(0.0, -self.tokens / self.rate)
+            self.tokens -= count
+            return delay
+
+    def slice_size(self, limit):
+        """
+        Largest amount of data to pass per request at the current rate
+
+        Args:
+            limit: Size the caller would use without a limit
+        """
+        rate = self.rate
+        if not rate:
+            return limit
+        return min(limit, max(MIN_SLICE_SIZE, int(rate * SLICE_SECONDS)))
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class Throttle:
+    """
+    Bandwidth limit of one transfer: its own cap, plus its place in a shared bucket
+    """
+
+    def __init__(self, limiter=None, rate=None, priority=PRIORITY_NORMAL):
+        """
+        Args:
+            limiter: TokenBucket shared by all transfers, or None
+            rate: Cap for this transfer in bytes per second, or None
+            priority: One of the PRIORITY_* constants, used when the shared bucket is contended
+        """
+        self.limiter = limiter
+        self.bucket = TokenBucket(rate)
+        self.priority = priority
+
+    def set_rate(self, rate):
+        """Change this transfer's cap, in bytes per second or None for no cap"""
+        self.bucket.set_rate(rate)
+
+    def consume(self, count):
+        """Block until `count` bytes may be transferred"""
+        self.bucket.consume(count)
+        if self.limiter:
+            self.limiter.consume(count, self.priority)
+
+    def reserve(self, count):
+        """
+        Non-blocking consume(): take `count` bytes from both buckets
+
+        Returns:
+            Seconds to wait before transferring them
+        """
+        delay = self.bucket.reserve(count)
+        if self.limiter:
+            delay = max(delay, self.limiter.reserve(count))
+        return delay
+
+    def slice_size(self, limit):
+        """Largest amount of data to pass per consume() or reserve() call"""
+        size = self.bucket.slice_size(limit)
+        if self.limiter:
+            size = self.limiter.slice_size(size)
+        return size
+
+class ThrottledSocket:
+    """
+    Socket wrapper whose sendall and sendfile calls are paced by a Throttle.
+    Everything else is passed through to the wrapped socket.
+
+    Small sends such as frame headers are not paced on their own but charged
+    together with the next large one, so a transfer asks for bandwidth once per
+    slice and keeps its place ahead of lower priority transfers.
+    """
+
+    def __init__(self, sock, throttle):
+        self.sock = sock
+        self.throttle = throttle
+        self.uncharged = 0  # Bytes of small sends not yet paid for
+
+    def sendall(self, data):
+        view = memoryview(data)
+        if len(view) < MIN_SLICE_SIZE:
+            self.uncharged += len(view)
+            self.sock.sendall(view)
+            return
+        while len(view):
+            count = self.throttle.slice_size(len(view))
+            self._consume(count)
+            self.sock.sendall(view[:count])
+            view = view[count:]
+
+    def sendfile(self, file, offset=0, count=None):
+        total = 0
+        while count is None or total < count:
+            length = self.throttle.slice_size(count - total if count is not None else 1024 * 1024)
+            self._consume(length)
+            sent = self.sock.sendfile(file, offset + total, length)
+            total += sent
+            if sent < length:
+                break
+        return total
+
+    def _consume(self, count):
+        self.throttle.consume(count + self.uncharged)
+        self.uncharged = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class ThrottledReader:
+    """
+    Buffered reader wrapper whose reads are paced by a Throttle.
+    Slowing the reader down lets TCP flow control slow the sender down.
+    """
+
+    def __init__(self, reader, throttle):
+        self.reader = reader
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        if data:
+            self.throttle.consume(len(data))
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)
+        length = self.reader.readinto(view[:self.throttle.slice_size(len(view))])
+        if length:
+            self.throttle.consume(length)
+        return length
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
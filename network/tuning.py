@@ -0,0 +1,267 @@
+"""
+Socket Tuning - Socket option profiles for senders and receivers
+
+A profile sets the socket buffer sizes, Nagle's algorithm and corking, TCP
+keepalive, timeouts and the listen backlog. The 'auto' profile sizes the
+buffers from the bandwidth-delay product of each connection: the round-trip
+time measured by the kernel, times the throughput last seen to that peer.
+
+    PROFILES       buffers            use
+    system         OS defaults        sockets exactly as the OS creates them, no timeouts
+    default        OS autotuning      keepalive and timeouts, no delayed small writes
+    lan            4 MB               fast local networks
+    wan            32 MB              long or fast links whose default window is too small
+    auto           2 x RTT x rate     anything, sized per connection
+
+Buffer sizes above the system maximum (net.core.wmem_max / rmem_max on
+Linux) are capped by the kernel.
+"""
+
+import socket
+import struct
+import threading
+from contextlib import contextmanager
+
+# Seconds to wait for a connection to be established
+DEFAULT_CONNECT_TIMEOUT = 10
+
+# Seconds a blocked send or receive may wait before the peer is given up on.
+# Generous, since a receiver may hash or sync a large file before it answers.
+DEFAULT_TIMEOUT = 300
+
+# Keepalive: probe after this many idle seconds, then every interval, giving up after count probes
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 6
+
+# Connections the kernel queues until they are accepted. An event loop that is busy with
+# transfers accepts in bursts, so a short queue overflows when many clients connect at
+# once and some of them get reset. Capped by the system (net.core.somaxconn on Linux).
+DEFAULT_BACKLOG = 1024
+
+# Auto sizing: bounds of the buffers, and the throughput assumed for a peer not seen before
+AUTO_MIN_BUFFER = 256 * 1024
+AUTO_MAX_BUFFER = 64 * 1024 * 1024
+AUTO_DEFAULT_RATE = 125 * 1024 * 1024  # 1 Gbit/s
+
+# Transfers smaller than this are dominated by latency and say little about throughput
+RATE_SAMPLE_MIN = 8 * 1024 * 1024
+
+# Offset of tcpi_rtt (microseconds) in Linux's struct tcp_info
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
+
+_peer_rates = {}  # host -> latest observed throughput in bytes per second
+_peer_rates_lock = threading.Lock()
+
+def observe_rate(host, size, seconds):
+    """
+    Remember the throughput of a transfer, for auto-sized buffers to the same host
+
+    Args:
+        host: Peer address
+        size: Bytes transferred
+        seconds: Duration of the transfer
+    """
+    if size >= RATE_SAMPLE_MIN and seconds > 0:
+        with _peer_rates_lock:
+            _peer_rates[host] = size / seconds
+
+def peer_rate(host):
+    """
+    Returns:
+        Latest observed throughput to a host in bytes per second, or None
+    """
+    with _peer_rates_lock:
+        return _peer_rates.get(host)
+
+def measure_rtt(sock):
+    """
+    Returns:
+        Smoothed round-trip time of a connected TCP socket in seconds, or None where
+        the kernel does not report it
+    """
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size)
+    except OSError:
+        return None
+    if len(info) < TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size:
+        return None
+    (rtt,) = TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)
+    return rtt / 1000000 if rtt else None
+
+def autotune_limit(option):
+    """
+    Returns:
+        Largest size the kernel grows an untouched buffer to on its own (Linux
+        tcp_wmem / tcp_rmem), or None where buffers are not autotuned
+    """
+    name = "tcp_wmem" if option == socket.SO_SNDBUF else "tcp_rmem"
+    try:
+        with open(f"/proc/sys/net/ipv4/{name}") as file:
+            return int(file.read().split()[2])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def buffer_for(rtt, rate):
+    """
+    Buffer size that keeps a link full: twice its bandwidth-delay product, within the auto bounds
+
+    Args:
+        rtt: Round-trip time in seconds
+        rate: Throughput in bytes per second
+    """
+    return int(min(max(2 * rtt * rate, AUTO_MIN_BUFFER), AUTO_MAX_BUFFER))
+
+class SocketProfile:
+    """
+    A set of socket options, applied to listening, accepted and connecting sockets
+    """
+
+    def __init__(self, name, send_buffer=None, receive_buffer=None, nodelay=True, cork=True, keepalive=True,
+                 timeout=DEFAULT_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT, backlog=DEFAULT_BACKLOG,
+                 auto=False):
+        """
+        Args:
+            name: Profile name
+            send_buffer: SO_SNDBUF in bytes, or None to leave it to the OS
+            receive_buffer: SO_RCVBUF in bytes, or None to leave it to the OS
+            nodelay: If True, set TCP_NODELAY so small writes such as acks go out at once
+            cork: If True, hold back partial segments while a file is sent (TCP_CORK, Linux
+                only), so its header goes out in the same segment as the first data
+            keepalive: If True, probe idle connections to detect dead peers
+            timeout: Seconds a send or receive may block, or None to wait forever
+            connect_timeout: Seconds to wait for a connection, or None to wait forever
+            backlog: Listen backlog of receivers
+            auto: If True, size the buffers of each connection from its RTT and throughput
+        """
+        self.name = name
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.nodelay = nodelay
+        self.cork = cork and hasattr(socket, "TCP_CORK")
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.backlog = backlog
+        self.auto = auto
+
+    def connect(self, host, port, connect_timeout=None):
+        """
+        Open a tuned TCP connection
+
+        Args:
+            connect_timeout: Overrides the profile's connect timeout
+
+        Returns:
+            Connected socket
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # The receive window is negotiated with the handshake, so buffers are set first
+            self._set_buffers(sock)
+            sock.settimeout(connect_timeout or self.connect_timeout)
+            sock.connect((host, port))
+            self.apply(sock, host)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def listen(self, sock):
+        """
+        Tune a bound listening socket and start listening.
+        Accepted connections inherit its buffer sizes.
+        """
+        self._set_buffers(sock)
+        sock.listen(self.backlog)
+
+    def apply(self, sock, host=None, blocking=True):
+        """
+        Tune a connected socket
+
+        Args:
+            host: Peer address, used by auto sizing to look up the throughput last seen to it
+            blocking: False for sockets owned by an event loop, which must not get a timeout
+        """
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            set_keepalive(sock)
+        if self.auto:
+            self._size_buffers(sock, host)
+        if blocking:
+            sock.settimeout(self.timeout)
+
+    @contextmanager
+    def corked(self, sock):
+        """
+        Coalesce everything sent in the block into full segments,
+        flushing the remainder when the block ends
+        """
+        if not self.cork:
+            yield
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            yield
+        finally:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            except OSError:
+                pass  # The connection is already gone
+
+    def _set_buffers(self, sock):
+        if self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def _size_buffers(self, sock, host):
+        rtt = measure_rtt(sock)
+        if rtt is None:
+            return
+        size = buffer_for(rtt, peer_rate(host) or AUTO_DEFAULT_RATE)
+        # Setting a buffer stops the kernel from growing it, so it is only set
+        # when the link needs more than the kernel would grow it to
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            if (autotune_limit(option) or sock.getsockopt(socket.SOL_SOCKET, option)) < size:
+                sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+    def __repr__(self):
+        return f"SocketProfile({self.name!r})"
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """Turn on TCP keepalive, with the probe timing where the platform allows setting it"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+PROFILES = {
+    "system": SocketProfile("system", nodelay=False, cork=False, keepalive=False, timeout=None, connect_timeout=None,
+                            backlog=socket.SOMAXCONN),
+    "default": SocketProfile("default"),
+    "lan": SocketProfile("lan", send_buffer=4 * 1024 * 1024, receive_buffer=4 * 1024 * 1024),
+    "wan": SocketProfile("wan", send_buffer=32 * 1024 * 1024, receive_buffer=32 * 1024 * 1024),
+    "auto": SocketProfile("auto", auto=True),
+}
+
+def get_socket_profile(profile):
+    """
+    Args:
+        profile: SocketProfile, or the name of one of PROFILES
+
+    Returns:
+        SocketProfile
+
+    Raises:
+        ValueError: If there is no profile of that name
+    """
+    if isinstance(profile, SocketProfile):
+        return profile
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown socket profile '{profile}', expected one of {', '.join(PROFILES)}")
+    return PROFILES[profile]
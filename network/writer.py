@@ -0,0 +1,243 @@
+"""
+Writer - Receiver write path with preallocation, write-behind and atomic commit
+
+Received data is collected into a few large reusable buffers that a background
+thread writes out, so network reads and disk writes overlap. The file is
+written under a temporary name in the target directory, with its full size
+reserved up front, and only renamed to its real name once the transfer has
+been verified. A failed transfer never leaves a corrupt file behind.
+"""
+
+import os
+import queue
+import tempfile
+import threading
+from utils.helpers import preallocate
+
+# When received data is forced to disk:
+# never - leave it to the operating system (fastest, a crash may lose recent files)
+# commit - once per file, before it is renamed to its real name; files of a batch with
+#          deferred acks are synced together, once before their batch ack
+# always - after every buffer written, and the directory after the rename
+FSYNC_NEVER = "never"
+FSYNC_COMMIT = "commit"
+FSYNC_ALWAYS = "always"
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_COMMIT, FSYNC_ALWAYS)
+
+# Size of each write-behind buffer, and how many the network side may fill ahead of the disk
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_BUFFERS = 4
+
+def create_temp_file(save_path, size, sparse=False):
+    """
+    Create the temporary file a received file is written to, next to its final path,
+    with its full size reserved up front
+
+    Args:
+        save_path: Final path of the file
+        size: Announced size of the file
+        sparse: If True, the file will contain holes, so only its size is set
+
+    Returns:
+        Tuple (unbuffered file object opened for writing, temporary path)
+    """
+    directory, name = os.path.split(save_path)
+    fd, temp_path = tempfile.mkstemp(dir=directory or ".", prefix=f".{name}.", suffix=".part")
+    file = open(fd, "wb", buffering=0)
+    try:
+        if sparse:
+            file.truncate(size)
+        else:
+            preallocate(file, size)
+    except OSError:
+        pass  # Not enough room to reserve it all, writing will tell if the file really does not fit
+    return file, temp_path
+
+def sync_directory(path):
+    """Make a rename into the directory of `path` durable; not possible on every platform"""
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def sync_filesystem():
+    """
+    Force every written file to disk with a single call. Only possible on Unix;
+    elsewhere it does nothing and the operating system writes the data back on its own.
+    """
+    if hasattr(os, "sync"):
+        os.sync()
+
+class WriteBehindFile:
+    """
+    File being received: written by a background thread to a preallocated temporary
+    file, then either committed under its real name or discarded. Without write-behind,
+    data is written in the calling thread, for callers that already write from a
+    worker pool of their own.
+
+    Use as a context manager; a file not committed by the end of the block is discarded.
+    """
+
+    def __init__(self, save_path, size, fsync_policy=FSYNC_COMMIT, buffer_size=WRITE_BUFFER_SIZE, buffers=WRITE_BUFFERS,
+                 sparse=False, write_behind=True):
+        """
+        Args:
+            save_path: Final path of the file
+            size: Announced size of the file, reserved on disk up front unless sparse
+            fsync_policy: One of the FSYNC_* constants
+            buffer_size: Size of each write-behind buffer
+            buffers: Number of buffers, bounding the data held in memory
+            sparse: If True, the file will contain holes (see skip()), so only its size is set
+            write_behind: If False, write() writes directly instead of through buffers and a thread
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+
+        self.save_path = save_path
+        self.size = size
+        self.fsync_policy = fsync_policy
+        self.file, self.temp_path = create_temp_file(save_path, size, sparse)
+
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        self.current = None     # Buffer being filled
+        self.used = 0           # Bytes of it filled
+        self.written = 0        # Bytes handed to write()
+        self.error = None       # Exception raised by the writer thread
+        self.closed = False
+        self.thread = None
+
+        # A file that fits in one buffer is written directly, a thread would cost more than it saves
+        if write_behind and size > buffer_size:
+            for _ in range(buffers):
+                self.free.put(bytearray(buffer_size))
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def write(self, data):
+        """
+        Queue data to be written, blocking only while every buffer is waiting for the disk
+
+        Raises:
+            OSError: If an earlier write failed
+        """
+        view = memoryview(data).cast("B")
+        if self.thread is None:
+            self._write_out(view)
+            self.written += len(view)
+            return
+        while len(view):
+            if self.current is None:
+                self.current = self.free.get()
+                self.used = 0
+                self._check()
+            count = min(len(view), len(self.current) - self.used)
+            self.current[self.used:self.used + count] = view[:count]
+            self.used += count
+            self.written += count
+            view = view[count:]
+            if self.used == len(self.current):
+                self._hand_off()
+
+    def skip(self, length):
+        """
+        Leave a hole of `length` zero bytes at the current position, without writing them
+        """
+        if self.thread is None:
+            self.file.seek(length, os.SEEK_CUR)
+            self.written += length
+            return
+        self._hand_off()
+        self.filled.put((None, length))
+        self.written += length
+
+    def commit(self):
+        """
+        Wait for all data to reach the file, then move it to its real name, replacing any file there
+
+        Raises:
+            OSError: If writing, syncing or renaming fails; the temporary file is removed
+        """
+        try:
+            self._finish()
+            self._check()
+            if self.written != self.size:
+                self.file.truncate(self.written)
+            if self.fsync_policy != FSYNC_NEVER:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            os.replace(self.temp_path, self.save_path)
+            if self.fsync_policy == FSYNC_ALWAYS:
+                sync_directory(self.save_path)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        """
+        Drop the received data, leaving any existing file under the real name untouched.
+        Does nothing once the file is committed.
+        """
+        self._finish()
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def _hand_off(self):
+        if self.current is not None:
+            self.filled.put((self.current, self.used))
+            self.current = None
+
+    def _finish(self):
+        # Stop the writer thread once everything queued so far is written
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread is None:
+            return
+        self._hand_off()
+        self.filled.put(None)
+        self.thread.join()
+
+    def _check(self):
+        if self.error:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.filled.get()
+            if item is None:
+                return
+            buffer, length = item
+            if buffer is None:
+                try:
+                    self.file.seek(length, os.SEEK_CUR)
+                except Exception as e:
+                    self.error = self.error or e
+                continue
+            try:
+                if self.error is None:
+                    self._write_out(memoryview(buffer)[:length])
+            except Exception as e:
+                self.error = e  # Reported to the receiving side on its next write
+            finally:
+                self.free.put(buffer)
+
+    def _write_out(self, view):
+        while len(view):
+            view = view[self.file.write(view):]
+        if self.fsync_policy == FSYNC_ALWAYS:
+            os.fsync(self.file.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if os.path.exists(self.temp_path):
+            self.discard()
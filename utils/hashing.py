@@ -0,0 +1,209 @@
+"""
+Hashing - Streaming integrity hashes shared by sender and receiver
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# Algorithms a transfer may use, fastest first. All are guaranteed by hashlib.
+HASH_ALGORITHMS = ("blake2b", "blake2s", "sha256", "sha512")
+
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+def create_hasher(algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    Create a new incremental hash object
+
+    Args:
+        algorithm: Name of one of the supported HASH_ALGORITHMS
+
+    Returns:
+        hashlib hash object ready for update() calls
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm '{algorithm}'")
+    return hashlib.new(algorithm)
+
+def hash_file(file_path, algorithm=DEFAULT_HASH_ALGORITHM, buffer_size=1024 * 1024):
+    """
+    Hash a whole file from disk
+
+    Args:
+        file_path: Path of the file to hash
+        algorithm: Name of one of the supported HASH_ALGORITHMS
+        buffer_size: Size of the reusable read buffer
+
+    Returns:
+        Raw digest bytes
+    """
+    hasher = create_hasher(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb') as file:
+        while True:
+            length = file.readinto(buffer)
+            if not length:
+                break
+            hasher.update(view[:length])
+    return hasher.digest()
+
+_ZEROS = bytes(1024 * 1024)
+
+def update_with_zeros(hasher, length):
+    """
+    Feed `length` zero bytes to a hash object, as read back from a hole in a sparse file
+    """
+    view = memoryview(_ZEROS)
+    while length:
+        count = min(length, len(view))
+        hasher.update(view[:count])
+        length -= count
+
+# Files modified this recently are not cached: a write within the same mtime tick would go unnoticed
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+DEFAULT_CACHE_ENTRIES = 200000
+
+def default_cache_path():
+    """
+    Returns:
+        Per-user location of the persistent hash cache
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "fileshare", "hashes.sqlite3")
+
+def _signed64(value):
+    """Fold an unsigned 64-bit stat field into SQLite's signed integer range"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+class HashCache:
+    """
+    Persistent cache of file digests keyed by (device, inode, size, mtime_ns, algorithm).
+
+    Any change to a file alters its size or mtime and therefore misses the cache.
+    Entries are evicted least recently used first once there are more than
+    `max_entries`. All methods are safe to call from several threads.
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_CACHE_ENTRIES):
+        """
+        Args:
+            path: SQLite database file, ":memory:" for a cache that is not persisted,
+                or None for default_cache_path()
+            max_entries: Number of digests kept before the least recently used are evicted
+        """
+        self.path = path or default_cache_path()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.db:
+            if self.path != ":memory:":
+                self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, algorithm TEXT,"
+                " digest BLOB, last_used REAL,"
+                " PRIMARY KEY (dev, ino, size, mtime_ns, algorithm))"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+            (self.entries,) = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()
+
+    @staticmethod
+    def _key(stat_result, algorithm):
+        return (
+            _signed64(stat_result.st_dev), _signed64(stat_result.st_ino),
+            stat_result.st_size, stat_result.st_mtime_ns, algorithm,
+        )
+
+    def lookup(self, file_path, algorithm, stat_result=None):
+        """
+        Returns:
+            Cached raw digest of the file's current content, or None
+        """
+        key = self._key(stat_result or os.stat(file_path), algorithm)
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND algorithm=?", key
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE hashes SET last_used=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND algorithm=?",
+                (time.time(),) + key,
+            )
+        return bytes(row[0])
+
+    def store(self, file_path, algorithm, digest, stat_result):
+        """
+        Remember a digest computed from the file as it was when `stat_result` was taken.
+        Nothing is stored if the file has changed since, or was modified too recently
+        for its mtime to be trusted.
+        """
+        try:
+            current = os.stat(file_path)
+        except OSError:
+            return
+        key = self._key(stat_result, algorithm)
+        if self._key(current, algorithm) != key or time.time_ns() - current.st_mtime_ns < RACY_WINDOW_NS:
+            return
+
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", key + (digest, time.time())
+            )
+            self.entries += cursor.rowcount
+            if self.entries > self.max_entries:
+                # Evict a tenth at a time so eviction is not paid on every insert
+                excess = self.entries - self.max_entries + self.max_entries // 10
+                self.db.execute(
+                    "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                (self.entries,) = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()
+
+    def hash_file(self, file_path, algorithm=DEFAULT_HASH_ALGORITHM, buffer_size=1024 * 1024):
+        """
+        Hash a file, reading it only if its digest is not cached
+
+        Returns:
+            Raw digest bytes
+        """
+        stat_result = os.stat(file_path)
+        digest = self.lookup(file_path, algorithm, stat_result)
+        if digest is None:
+            digest = hash_file(file_path, algorithm, buffer_size)
+            self.store(file_path, algorithm, digest, stat_result)
+        return digest
+
+    def close(self):
+        """Close the underlying database"""
+        with self.lock:
+            self.db.close()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_hash_cache():
+    """
+    Returns:
+        The process-wide HashCache, opened on first use. Falls back to an in-memory
+        cache if the cache directory is not writable.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            try:
+                _default_cache = HashCache()
+            except (OSError, sqlite3.Error):
+                _default_cache = HashCache(":memory:")
+        return _default_cache
@@ -3,7 +3,10 @@ Helper Functions - Common utilities
 """
 
 import os
+import errno
+import json
 import socket
+import struct
 import time
 
 def format_file_size(size_bytes):
@@ -27,6 +30,40 @@ def format_file_size(size_bytes):
     
     return f"{size_bytes:.1f} {size_names[i]}"
 
+def format_duration(seconds):
+    """
+    Format a duration in human readable format
+
+    Args:
+        seconds: Duration in seconds, or None if unknown
+
+    Returns:
+        Formatted string (e.g., "1h 02m", "3m 05s", "12s" or "?")
+    """
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+def path_size(path):
+    """
+    Total size of a file, or of every file below a directory, in bytes
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+    return total
+
 def validate_port(port_str):
     """
     Validate port number
@@ -117,60 +154,176 @@ def get_local_ip():
     # As a last resort, return localhost
     return "127.0.0.1"
 
-def discover_file_server_ip(broadcast_port=9999, timeout=2):
+def _interface_addresses():
     """
-    Discover file server IP on the local network using UDP broadcast.
-    Returns the discovered IP address as a string, or None if not found.
+    Address and netmask of every IPv4 network interface, where the platform can tell
+
+    Returns:
+        List of (address, netmask) tuples, netmask None if unknown
     """
-    message = b"DISCOVER_FILE_SERVER"
-    server_ip = None
-    attempts = ["<broadcast>", "192.168.1.255"]  # fallback strategy
-    
-    # Set up UDP socket for broadcast
-    for attempt in attempts:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            s.settimeout(timeout)
+    try:
+        import fcntl
+    except ImportError:  # Not available on Windows
+        return []
+
+    interfaces = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            request = struct.pack("256s", name.encode()[:15])
             try:
-                s.sendto(message, (attempt, broadcast_port))
-                # Wait for a response
-                server_ip, _ = s.recvfrom(1024)
-                server_ip = server_ip.decode()
-                break
-            except socket.timeout:
+                address = socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915, request)[20:24])  # SIOCGIFADDR
+            except OSError:
                 continue
-            except Exception as e:
-                # No response, do not fallback to local IP
-                print(f"[DEBUG] Discovery attempt to {attempt} failed: {e}")
-                server_ip = None
+            try:
+                netmask = socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x891B, request)[20:24])  # SIOCGIFNETMASK
+            except OSError:
+                netmask = None
+            interfaces.append((address, netmask))
+    return interfaces
 
-    return server_ip
+def local_ipv4_addresses():
+    """
+    Every non-loopback IPv4 address of this machine that can be found,
+    one per network interface where the platform allows listing them
+    """
+    addresses = [address for address, _ in _interface_addresses()]
+    try:
+        addresses += socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        pass
+    addresses.append(get_local_ip())
+    return [ip for ip in dict.fromkeys(addresses) if not ip.startswith("127.")]
+
+def broadcast_addresses():
+    """
+    Broadcast addresses to reach every local network: the limited broadcast address
+    plus the directed broadcast address of each interface (assuming a /24 network
+    where the netmask is unknown)
+    """
+    netmasks = dict(_interface_addresses())
+    addresses = ["<broadcast>"]
+    for ip in local_ipv4_addresses():
+        netmask = netmasks.get(ip) or "255.255.255.0"
+        host_bits = ~struct.unpack("!I", socket.inet_aton(netmask))[0] & 0xFFFFFFFF
+        network = struct.unpack("!I", socket.inet_aton(ip))[0]
+        addresses.append(socket.inet_ntoa(struct.pack("!I", network | host_bits)))
+    return list(dict.fromkeys(addresses))
+
+def discover_file_server_ip(broadcast_port=9999, timeout=2):
+    """
+    Discover file server IP on the local network using UDP broadcast.
+    Returns the discovered IP address as a string, or None if not found.
+    """
+    servers = _broadcast_discovery(b"DISCOVER_FILE_SERVER", broadcast_port, timeout, first_only=True)
+    return servers[0] if servers else None
 
 def discover_all_file_servers(broadcast_port=9999, timeout=2):
     """
     Discover all file servers on the local network using UDP broadcast.
     Returns a list of discovered IP addresses.
     """
-    message = b"DISCOVER_FILE_SERVERS"
-    discovered_ips = set()
-    attempts = ["<broadcast>", "192.168.1.255"]
+    return _broadcast_discovery(b"DISCOVER_FILE_SERVERS", broadcast_port, timeout)
+
+def discover_file_servers_info(broadcast_port=9999, timeout=2):
+    """
+    Discover all file servers on the local network, asking each to describe itself.
+    Returns a list of dicts with the server's 'host', TCP 'port', 'free_bytes',
+    'active_transfers' and supported 'features'.
+    """
+    servers = []
+    for reply in _broadcast_discovery(b"DISCOVER_FILE_SERVER_INFO", broadcast_port, timeout):
+        try:
+            info = json.loads(reply)
+        except ValueError:
+            continue  # Older receivers do not know the request
+        if isinstance(info, dict) and "host" in info:
+            servers.append(info)
+    return servers
 
-    for attempt in attempts:
-        # Set up UDP socket for broadcast
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            s.settimeout(timeout)
-            
+def _broadcast_discovery(message, broadcast_port, timeout, first_only=False):
+    """
+    Broadcast a discovery request on every local network at once and collect the replies
+
+    Returns:
+        List of replies, each decoded and without duplicates, in arrival order
+    """
+    replies = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for address in broadcast_addresses():
             try:
-                s.sendto(message, (attempt, broadcast_port))
-                while True:
-                    try:
-                        server_ip, _ = s.recvfrom(1024)
-                        discovered_ips.add(server_ip.decode())
-                    except socket.timeout:
-                        break
-            except Exception as e:
+                s.sendto(message, (address, broadcast_port))
+            except OSError as e:
+                print(f"[DEBUG] Discovery attempt to {address} failed: {e}")
+
+        # The same server usually answers on several networks, keep each reply once
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            s.settimeout(remaining)
+            try:
+                reply, _ = s.recvfrom(1024)
+            except socket.timeout:
+                break
+            except OSError as e:
                 print(f"[DEBUG] Discovery failed: {e}")
-                continue
-    
-    return list(discovered_ips)
\ No newline at end of file
+                break
+            reply = reply.decode()
+            if reply not in replies:
+                replies.append(reply)
+            if first_only:
+                break
+    return replies
+
+def data_extents(file, size):
+    """
+    List the parts of a sparse file that hold data, using SEEK_DATA and SEEK_HOLE
+
+    Args:
+        file: File object opened for reading
+        size: Size of the file in bytes
+
+    Returns:
+        List of (offset, length) tuples in file order, or None if the platform
+        or filesystem can not tell data from holes
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        return None
+    fd = file.fileno()
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break  # Only a hole left
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            if end <= start:
+                break
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+def preallocate(file, size):
+    """
+    Reserve disk space for a file of the given size
+
+    Args:
+        file: File object opened for writing
+        size: Final size of the file in bytes
+    """
+    file.truncate(size)
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+        except OSError:
+            pass  # Filesystem does not support fallocate, the truncate is enough
@@ -0,0 +1,129 @@
+"""
+Log Buffer - Bounded in-memory log with an optional rotating file spill
+
+Only the most recent lines are kept in memory, so a log that runs for days
+stays the same size. Every line can also be written to a rotating log file,
+so the full history is still available on disk.
+"""
+
+import itertools
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from collections import deque
+
+# Lines kept in memory
+DEFAULT_MAX_LINES = 5000
+
+# Size at which the spill file is rotated, and how many rotated files are kept
+DEFAULT_SPILL_BYTES = 5 * 1024 * 1024
+DEFAULT_SPILL_BACKUPS = 3
+
+def default_log_path():
+    """
+    Returns:
+        Per-user location of the receive log file
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.path.join(base, "fileshare", "receive.log")
+
+class LogBuffer:
+    """
+    Thread-safe ring buffer of timestamped log lines.
+
+    Lines are numbered from the first line ever appended; once the buffer is
+    full the oldest are dropped, so the first line held is number `first`.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, max_lines=DEFAULT_MAX_LINES, spill_path=None, spill_bytes=DEFAULT_SPILL_BYTES,
+                 spill_backups=DEFAULT_SPILL_BACKUPS):
+        """
+        Args:
+            max_lines: Lines kept in memory
+            spill_path: File every line is also written to, or None
+            spill_bytes: Size at which the spill file is rotated
+            spill_backups: Rotated spill files kept
+        """
+        self.lock = threading.Lock()
+        self.lines = deque(maxlen=max_lines)
+        self.appended = 0  # Lines ever appended
+        self.spill = None
+        self.spill_path = None
+        if spill_path:
+            self.set_spill(spill_path, spill_bytes, spill_backups)
+
+    @property
+    def first(self):
+        """Number of the oldest line still held"""
+        return self.appended - len(self.lines)
+
+    def append(self, message):
+        """
+        Add a message, one line per line of text, stamped with the current time
+        """
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        lines = str(message).split("\n")
+        entries = [f"[{timestamp}] {lines[0]}"] + [f"    {line}" for line in lines[1:]]
+        with self.lock:
+            self.lines.extend(entries)
+            self.appended += len(entries)
+            spill = self.spill
+        if spill:
+            for entry in entries:
+                spill.info(entry)
+
+    def window(self, first, count):
+        """
+        Returns:
+            Up to `count` lines starting at line number `first` (see the class docstring)
+        """
+        with self.lock:
+            start = max(first - (self.appended - len(self.lines)), 0)
+            return list(itertools.islice(self.lines, start, start + count))
+
+    def set_max_lines(self, max_lines):
+        """Change the number of lines kept in memory, dropping the oldest if needed"""
+        with self.lock:
+            self.lines = deque(self.lines, maxlen=max_lines)
+
+    def set_spill(self, spill_path, spill_bytes=DEFAULT_SPILL_BYTES, spill_backups=DEFAULT_SPILL_BACKUPS):
+        """
+        Start or stop writing every line to a rotating log file
+
+        Args:
+            spill_path: File to write to, or None to stop
+
+        Raises:
+            OSError: If the file can not be opened
+        """
+        spill = None
+        if spill_path:
+            os.makedirs(os.path.dirname(spill_path) or ".", exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                spill_path, maxBytes=spill_bytes, backupCount=spill_backups, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            spill = logging.getLogger(f"fileshare.log_buffer.{next(self._ids)}")
+            spill.propagate = False
+            spill.setLevel(logging.INFO)
+            spill.addHandler(handler)
+
+        with self.lock:
+            previous, self.spill, self.spill_path = self.spill, spill, spill_path
+        if previous:
+            for handler in list(previous.handlers):
+                previous.removeHandler(handler)
+                handler.close()
+
+    def close(self):
+        self.set_spill(None)
+
+    def __len__(self):
+        return len(self.lines)
@@ -0,0 +1,132 @@
+"""
+Metrics - Local HTTP endpoint for transfer stats and profiling
+
+Serves a StageStats on 127.0.0.1:
+
+    GET /metrics                    stage and transfer totals as Prometheus text
+    GET /stats                      snapshot() as JSON
+    GET /profile/start?mode=sample  start profiling ('sample' or 'cprofile')
+    GET /profile/stop               stop profiling and return the report
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_METRICS_PORT = 9998
+
+def metrics_text(snapshot):
+    """
+    Format a StageStats snapshot as Prometheus text exposition
+
+    Returns:
+        str
+    """
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append(f"# HELP fileshare_{name} {description}")
+        lines.append(f"# TYPE fileshare_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"fileshare_{name}{{{label_text}}} {value}")
+
+    stages = snapshot["stages"]
+    for key, name, description in (
+        ("seconds", "stage_seconds_total", "Time spent in each transfer stage"),
+        ("bytes", "stage_bytes_total", "Bytes handled by each transfer stage"),
+        ("calls", "stage_calls_total", "Operations timed in each transfer stage"),
+        ("stalls", "stage_stalls_total", "Operations of each stage slower than the stall threshold"),
+    ):
+        metric(name, "counter", description,
+               [({"direction": stage["direction"], "stage": stage["stage"]}, stage[key]) for stage in stages])
+
+    totals = snapshot["totals"]
+    metric("transfers_total", "counter", "Transfers finished",
+           [({"direction": direction}, values["transfers"]) for direction, values in totals.items()])
+    metric("transfers_failed_total", "counter", "Transfers that failed",
+           [({"direction": direction}, values["failed"]) for direction, values in totals.items()])
+    metric("transfer_bytes_total", "counter", "Bytes of the transfers that succeeded",
+           [({"direction": direction}, values["bytes"]) for direction, values in totals.items()])
+
+    active = {}
+    for transfer in snapshot["active"]:
+        active[transfer["direction"]] = active.get(transfer["direction"], 0) + 1
+    metric("active_transfers", "gauge", "Transfers in progress",
+           [({"direction": direction}, count) for direction, count in active.items()])
+
+    last = {}
+    for transfer in snapshot["recent"]:
+        if transfer["mb_per_s"] is not None and not transfer["error"]:
+            last[transfer["direction"]] = transfer["mb_per_s"] * 1024 * 1024
+    metric("last_transfer_bytes_per_second", "gauge", "Throughput of the latest successful transfer",
+           [({"direction": direction}, round(rate)) for direction, rate in last.items()])
+    return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    """
+    Serves stats over HTTP from a background thread
+    """
+
+    def __init__(self, stats, port=DEFAULT_METRICS_PORT, host="127.0.0.1"):
+        """
+        Args:
+            stats: StageStats to serve, enabled when the server starts
+            port: Port to listen on, 0 for any free port
+            host: Address to listen on; keep it local, the endpoint has no authentication
+        """
+        self.stats = stats
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def start(self):
+        """
+        Raises:
+            OSError: If the port can not be bound
+        """
+        stats = self.stats
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    if url.path == "/metrics":
+                        self._reply(200, metrics_text(stats.snapshot()), "text/plain; version=0.0.4")
+                    elif url.path == "/stats":
+                        self._reply(200, json.dumps(stats.snapshot(), indent=2), "application/json")
+                    elif url.path == "/profile/start":
+                        mode = parse_qs(url.query).get("mode", ["sample"])[0]
+                        stats.start_profiling(mode)
+                        self._reply(200, f"Profiling ({mode})\n")
+                    elif url.path == "/profile/stop":
+                        report = stats.stop_profiling()
+                        self._reply(200, (report or "Profiling was not running") + "\n")
+                    else:
+                        self._reply(404, "Not found\n")
+                except ValueError as e:
+                    self._reply(400, f"{e}\n")
+
+            def _reply(self, code, text, content_type="text/plain"):
+                body = text.encode()
+                self.send_response(code)
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes every few seconds would flood stderr
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        stats.enable()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
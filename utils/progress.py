@@ -0,0 +1,208 @@
+"""
+Progress - Coalescing progress event bus between transfers and their observers
+
+Transfers publish progress by bumping a counter on their Tracker, which only
+holds the tracker's lock for the addition, so several threads can share one. A ticker thread turns the counters into progress events at a fixed
+rate, with the transfer rate and ETA, and hands them to every subscriber, so
+an observer gets at most one update per tick however fast data moves. The
+same bus serves the Send and Receive tabs and headless consumers alike.
+"""
+
+import itertools
+import threading
+import time
+
+# Seconds between progress events
+TICK_INTERVAL = 0.1
+
+# Weight of the latest tick in the smoothed transfer rate
+RATE_SMOOTHING = 0.3
+
+class Tracker:
+    """
+    Progress of one transfer, published to a ProgressBus.
+
+    Calling the tracker with a percentage makes it usable wherever a
+    progress_callback is expected. Used as a context manager, the tracker is
+    finished on exit, as failed if the block raises.
+    """
+
+    def __init__(self, bus, transfer_id, name, total, direction):
+        self.bus = bus
+        self.id = transfer_id
+        self.name = name
+        self.total = total
+        self.direction = direction
+        self.done = 0
+        self.lock = threading.Lock()  # Guards `done`, e.g. for the range threads of a parallel transfer
+        self.finished = False
+        self.error = None
+        self.started = time.monotonic()
+        # Tick bookkeeping, only touched by the bus
+        self.reported = None
+        self.rate = 0.0
+        self.last_done = 0
+        self.last_time = self.started
+
+    def advance(self, count):
+        """Record `count` more bytes transferred; safe to call from several threads"""
+        with self.lock:
+            self.done += count
+
+    def __call__(self, percent):
+        """Record progress given as a percentage (0-100)"""
+        with self.lock:
+            self.done = int(self.total * percent / 100)
+
+    def finish(self, error=None):
+        """
+        Mark the transfer as finished
+
+        Args:
+            error: Message describing why it failed, or None if it succeeded
+        """
+        self.error = error
+        self.finished = True
+        self.bus._finished(self)
+
+    def fail(self, error):
+        """Mark the transfer as failed once it finishes"""
+        self.error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.finished:
+            self.finish(str(exc_value) if exc_value else self.error)
+
+class ProgressBus:
+    """
+    Collects progress from any number of transfers and delivers it to subscribers
+    every `interval` seconds, from a background thread.
+    """
+
+    def __init__(self, interval=TICK_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.trackers = {}      # transfer id -> Tracker
+        self.subscribers = []
+        self.ids = itertools.count(1)
+        self.thread = None
+
+    def track(self, name, total, direction="send"):
+        """
+        Start tracking a transfer
+
+        Args:
+            name: File or folder name shown to the user
+            total: Size of the transfer in bytes
+            direction: 'send' or 'receive'
+
+        Returns:
+            Tracker to publish the transfer's progress to
+        """
+        tracker = Tracker(self, next(self.ids), name, total, direction)
+        with self.lock:
+            self.trackers[tracker.id] = tracker
+        return tracker
+
+    def subscribe(self, callback):
+        """
+        Receive progress events
+
+        Args:
+            callback: Function called from the bus thread with a list of event dicts
+                (see snapshot()) for every transfer that changed since the last tick.
+                It should return quickly, e.g. by scheduling a GUI update.
+        """
+        with self.lock:
+            self.subscribers.append(callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def snapshot(self):
+        """
+        Returns:
+            List of event dicts with 'id', 'name', 'direction', 'bytes', 'total',
+            'percent', 'rate' (bytes per second), 'eta' (seconds, or None if unknown),
+            'finished' and 'error', one per transfer being tracked
+        """
+        with self.lock:
+            return [self._event(tracker) for tracker in self.trackers.values()]
+
+    def _event(self, tracker):
+        done = tracker.done
+        remaining = max(tracker.total - done, 0)
+        return {
+            "id": tracker.id,
+            "name": tracker.name,
+            "direction": tracker.direction,
+            "bytes": done,
+            "total": tracker.total,
+            "percent": min(100.0, done * 100 / tracker.total) if tracker.total else 100.0,
+            "rate": tracker.rate,
+            "eta": remaining / tracker.rate if tracker.rate else (0.0 if not remaining else None),
+            "finished": tracker.finished,
+            "error": tracker.error,
+        }
+
+    def _finished(self, tracker):
+        # Without subscribers nobody will collect the final event
+        with self.lock:
+            if not self.subscribers:
+                self.trackers.pop(tracker.id, None)
+
+    def _tick(self):
+        """Build the events of every transfer that changed, dropping finished ones"""
+        now = time.monotonic()
+        events = []
+        with self.lock:
+            for tracker in list(self.trackers.values()):
+                elapsed = now - tracker.last_time
+                if elapsed > 0:
+                    latest = (tracker.done - tracker.last_done) / elapsed
+                    tracker.rate = latest if not tracker.last_done else \
+                        RATE_SMOOTHING * latest + (1 - RATE_SMOOTHING) * tracker.rate
+                tracker.last_done, tracker.last_time = tracker.done, now
+
+                state = (tracker.done, tracker.finished)
+                if state != tracker.reported:
+                    tracker.reported = state
+                    events.append(self._event(tracker))
+                if tracker.finished:
+                    del self.trackers[tracker.id]
+            subscribers = list(self.subscribers)
+        return events, subscribers
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            events, subscribers = self._tick()
+            if not events:
+                continue
+            for callback in subscribers:
+                try:
+                    callback(events)
+                except Exception:
+                    pass  # A failing observer must not stop the others
+
+_default_bus = None
+_default_bus_lock = threading.Lock()
+
+def get_progress_bus():
+    """
+    Returns:
+        The process-wide ProgressBus, created on first use
+    """
+    global _default_bus
+    with _default_bus_lock:
+        if _default_bus is None:
+            _default_bus = ProgressBus()
+        return _default_bus
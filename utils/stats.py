@@ -0,0 +1,337 @@
+"""
+Stats - Per-stage timing of transfers, and profiling hooks
+
+Transfers split their work into stages (disk read, hashing, compression,
+socket send, socket receive, disk write, ...) and report the time and bytes
+of each to a StageStats. Totals per stage, stall counts and the throughput
+of recent transfers are available from snapshot() and as metrics text (see
+utils.metrics). While stats are disabled, transfers get a shared object
+whose methods do nothing, so the cost is one no-op call per chunk.
+
+Profiling can be switched on at runtime, either by sampling the stacks of
+every thread or with cProfile around each transfer.
+"""
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import deque
+
+# A single operation taking longer than this counts as a stall of its stage
+STALL_SECONDS = 0.05
+
+# Finished transfers kept for snapshot()
+RECENT_TRANSFERS = 50
+
+# Seconds between stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+PROFILE_MODES = ("sample", "cprofile")
+
+class Transfer:
+    """
+    Timing of one transfer.
+
+    Stages are timed by threading a clock value through the work:
+
+        t = transfer.clock()
+        count = file.readinto(view)
+        t = transfer.record("read", t, count)
+        client.sendall(view[:count])
+        t = transfer.record("send", t, count)
+
+    Used as a context manager, the transfer is finished on exit, as failed if the block raises.
+    """
+
+    def __init__(self, stats, name, direction, total):
+        self.stats = stats
+        self.name = name
+        self.direction = direction
+        self.total = total
+        self.error = None
+        self.stages = {}        # stage -> seconds spent in it by this transfer
+        self.started = time.perf_counter()
+        self.profile = None
+
+    def clock(self):
+        return time.perf_counter()
+
+    def record(self, stage, started, count=0):
+        """
+        Add the time since `started` to a stage
+
+        Args:
+            stage: Stage name, e.g. 'read', 'hash', 'send', 'receive', 'write'
+            started: clock() value when the operation began
+            count: Bytes the operation handled
+
+        Returns:
+            Current clock() value, to start the next operation from
+        """
+        now = time.perf_counter()
+        self.stats._record(self, stage, now - started, count)
+        return now
+
+    def fail(self, error):
+        """Mark the transfer as failed once it finishes"""
+        self.error = error
+
+    def __enter__(self):
+        self.stats._started(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value and not self.error:
+            self.error = str(exc_value) or exc_type.__name__
+        self.stats._finished(self, time.perf_counter() - self.started)
+
+class _NullTransfer:
+    """Stands in for Transfer while stats are disabled"""
+
+    def clock(self):
+        return 0.0
+
+    def record(self, stage, started, count=0):
+        return 0.0
+
+    def fail(self, error):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_TRANSFER = _NullTransfer()
+
+class SamplingProfiler:
+    """
+    Samples the innermost frames of every thread at a fixed interval. Unlike
+    cProfile it sees threads that were already running when it started.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.running = False
+        self.thread = None
+        self.samples = 0
+        self.own = {}           # function -> samples where it was running
+        self.total = {}         # function -> samples where it was on the stack
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while self.running:
+            time.sleep(self.interval)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self.samples += 1
+                seen = set()
+                innermost = True
+                while frame is not None:
+                    code = frame.f_code
+                    function = f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+                    if innermost:
+                        self.own[function] = self.own.get(function, 0) + 1
+                        innermost = False
+                    if function not in seen:
+                        seen.add(function)
+                        self.total[function] = self.total.get(function, 0) + 1
+                    frame = frame.f_back
+
+    def report(self, limit=30):
+        """
+        Returns:
+            Text table of the functions seen most often
+        """
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f} ms", "", "   own%  total%  function"]
+        for function, count in sorted(self.own.items(), key=lambda item: -item[1])[:limit]:
+            lines.append(f"{count * 100 / self.samples:7.1f} {self.total[function] * 100 / self.samples:7.1f}  {function}")
+        return "\n".join(lines)
+
+class StageStats:
+    """
+    Process-wide collection of stage timings, keyed by direction and stage
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = {}        # (direction, stage) -> {'seconds', 'bytes', 'calls', 'stalls'}
+        self.totals = {}        # direction -> {'transfers', 'failed', 'bytes', 'seconds'}
+        self.active = set()
+        self.recent = deque(maxlen=RECENT_TRANSFERS)
+        self.profile_mode = None
+        self.sampler = None
+        self.profile_stats = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.totals.clear()
+            self.recent.clear()
+
+    def transfer(self, name, direction, total):
+        """
+        Start timing a transfer
+
+        Args:
+            name: File or folder name
+            direction: 'send' or 'receive'
+            total: Size of the transfer in bytes
+
+        Returns:
+            Transfer, or NULL_TRANSFER while stats are disabled
+        """
+        if not self.enabled:
+            return NULL_TRANSFER
+        return Transfer(self, name, direction, total)
+
+    def snapshot(self):
+        """
+        Returns:
+            Dict with 'enabled', 'profiling' (mode or None), 'stages' (list of per-stage
+            totals with 'direction', 'stage', 'seconds', 'bytes', 'calls', 'stalls' and
+            'mb_per_s'), 'totals' per direction, 'active' transfers and 'recent' finished
+            transfers with their throughput and per-stage seconds
+        """
+        with self.lock:
+            stages = []
+            for (direction, stage), values in sorted(self.stages.items()):
+                rate = values["bytes"] / 1024 / 1024 / values["seconds"] if values["bytes"] and values["seconds"] else None
+                stages.append(dict(values, direction=direction, stage=stage, mb_per_s=round(rate, 3) if rate else None))
+            return {
+                "enabled": self.enabled,
+                "profiling": self.profile_mode,
+                "stages": stages,
+                "totals": {direction: dict(values) for direction, values in self.totals.items()},
+                "active": [{"name": transfer.name, "direction": transfer.direction, "total": transfer.total,
+                            "seconds": round(time.perf_counter() - transfer.started, 3)} for transfer in self.active],
+                "recent": list(self.recent),
+            }
+
+    def start_profiling(self, mode="sample"):
+        """
+        Start profiling, replacing any profile in progress
+
+        Args:
+            mode: 'sample' to sample the stacks of all threads, or 'cprofile' to run
+                cProfile in the thread of every transfer started from now on
+
+        Raises:
+            ValueError: If the mode is unknown
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profiling mode '{mode}', expected one of {', '.join(PROFILE_MODES)}")
+        self.stop_profiling()
+        with self.lock:
+            self.profile_stats = None
+            self.profile_mode = mode
+            if mode == "sample":
+                self.sampler = SamplingProfiler()
+                self.sampler.start()
+
+    def stop_profiling(self, limit=30):
+        """
+        Returns:
+            Text report of the profile, or None if profiling was off
+        """
+        with self.lock:
+            mode, sampler, profile_stats = self.profile_mode, self.sampler, self.profile_stats
+            self.profile_mode = self.sampler = self.profile_stats = None
+        if mode == "sample":
+            sampler.stop()
+            return sampler.report(limit)
+        if mode == "cprofile":
+            if profile_stats is None:
+                return "No transfers ran while profiling"
+            output = io.StringIO()
+            profile_stats.stream = output
+            profile_stats.sort_stats("cumulative").print_stats(limit)
+            return output.getvalue()
+        return None
+
+    def _started(self, transfer):
+        with self.lock:
+            self.active.add(transfer)
+            profile = self.profile_mode == "cprofile"
+        if profile:
+            transfer.profile = cProfile.Profile()
+            try:
+                transfer.profile.enable()
+            except ValueError:
+                transfer.profile = None  # Another profiler is already active in this thread
+
+    def _record(self, transfer, stage, seconds, count):
+        with self.lock:
+            values = self.stages.get((transfer.direction, stage))
+            if values is None:
+                values = self.stages[(transfer.direction, stage)] = {"seconds": 0.0, "bytes": 0, "calls": 0, "stalls": 0}
+            values["seconds"] += seconds
+            values["bytes"] += count
+            values["calls"] += 1
+            if seconds > STALL_SECONDS:
+                values["stalls"] += 1
+            transfer.stages[stage] = transfer.stages.get(stage, 0.0) + seconds
+
+    def _finished(self, transfer, seconds):
+        profile = transfer.profile
+        if profile:
+            profile.disable()
+        with self.lock:
+            self.active.discard(transfer)
+            totals = self.totals.setdefault(transfer.direction, {"transfers": 0, "failed": 0, "bytes": 0, "seconds": 0.0})
+            totals["transfers"] += 1
+            if transfer.error:
+                totals["failed"] += 1
+            else:
+                totals["bytes"] += transfer.total
+            totals["seconds"] += seconds
+            self.recent.append({
+                "name": transfer.name,
+                "direction": transfer.direction,
+                "bytes": transfer.total,
+                "seconds": round(seconds, 6),
+                "mb_per_s": round(transfer.total / 1024 / 1024 / seconds, 3) if seconds else None,
+                "stages": {stage: round(value, 6) for stage, value in transfer.stages.items()},
+                "error": transfer.error,
+            })
+            if profile and self.profile_mode == "cprofile":
+                if self.profile_stats is None:
+                    self.profile_stats = pstats.Stats(profile)
+                else:
+                    self.profile_stats.add(profile)
+
+_default_stats = None
+_default_stats_lock = threading.Lock()
+
+def get_stats():
+    """
+    Returns:
+        The process-wide StageStats, created (disabled) on first use
+    """
+    global _default_stats
+    with _default_stats_lock:
+        if _default_stats is None:
+            _default_stats = StageStats()
+        return _default_stats